@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+"""
+Анализ производительности бота по bot.log
+
+Читает лог потоком (блоками, в том числе ротированные bot.log.1, bot.log.2.gz
+и bot.log.2025-01-01) и восстанавливает:
+- пропускную способность: полученные и обработанные updates по интервалам
+- задержку update: от "Processing update" до первого успешного ответа в чат
+  пользователя (отправка или редактирование сообщения)
+- долю ошибок отправки и редактирования и время ответа MAX API
+
+В логе нет общего идентификатора update и запроса к API, поэтому связь
+восстанавливается эвристически: результат запроса ("Message sent
+successfully", "Send message error") относится к самому раннему ожидающему
+запросу того же вида, а чат - к пользователю, у которого есть update без
+ответа (в диалогах MAX chat_id обычно равен user_id). Незавершенные update
+и запросы старше --window секунд считаются оставшимися без ответа.
+
+Память ограничена: в ней только незавершенные update и запросы за окно
+--window, гистограммы по интервалам и соответствие чатов пользователям
+(не больше --max-chats), поэтому размер лога не важен.
+
+Запуск:
+    python analyze_logs.py bot.log
+    python analyze_logs.py /var/log/bot/bot.log --bucket 300 --since "2025-01-01 00:00"
+    python analyze_logs.py bot.log.3.gz bot.log.2.gz --no-rotated
+"""
+
+import argparse
+import bisect
+import gzip
+import os
+import re
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# Границы корзин гистограммы задержек (мс): от 1 мс до 2 минут с шагом 10%
+LATENCY_BOUNDS_MS = tuple(round(1.1 ** power, 1) for power in range(0, 124))
+
+# 2025-01-01 12:00:00,123 - logger - LEVEL - message. Регулярное выражение ищет по всему блоку
+# только нужные строки (ERROR и строки о updates и запросах), остальные Python не видит
+_LINE = re.compile(
+    rb'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),(\d{3}) - [^ \n]+ - '
+    rb'(?:(ERROR) - |[A-Z]+ - (?=Processing update|User ID|bot_started:|Received|Sending message|'
+    rb'Editing message|Message |Failed to edit))(.*?)\r?$',
+    re.M
+)
+
+_RECEIVED = re.compile(rb'Received (\d+) updates')
+_PROCESSING = re.compile(rb'Processing update: ([^,]*), type: (\S+)')
+_USER = re.compile(rb'User ID: (-?\d+)')
+_BOT_STARTED = re.compile(rb"bot_started: chat_id=(-?\d+), user=\{'user_id': (-?\d+)")
+_SENDING = re.compile(rb'Sending message to chat_id=(-?\d+)')
+_EDITING = re.compile(rb'Editing message \S+ in chat_id=(-?\d+)')
+_SENT = b'Message sent successfully'
+_SEND_ERROR = b'Send message error'
+_EDITED = re.compile(rb'Message \S+ edited successfully')
+_EDIT_FAILED = b'Failed to edit message'
+
+_ROTATED_NUMBER = re.compile(r'\.(\d+)(\.gz)?$')
+_ROTATED_DATE = re.compile(r'\.\d{4}-\d\d-\d\d[\d_-]*(\.gz)?$')
+
+
+def rotated_files(path: str) -> List[str]:
+    """A log file with its rotations, oldest first (bot.log.3.gz, bot.log.2, bot.log.1, bot.log)."""
+    directory = os.path.dirname(path) or '.'
+    base = os.path.basename(path)
+    numbered, dated = [], []
+    for name in os.listdir(directory):
+        if not name.startswith(base + '.'):
+            continue
+        suffix = name[len(base):]
+        match = _ROTATED_NUMBER.match(suffix)
+        if match:
+            numbered.append((int(match.group(1)), name))
+        elif _ROTATED_DATE.match(suffix):
+            # TimedRotatingFileHandler: bot.log.2025-01-01 (суффикс сортируется как дата)
+            dated.append(name)
+    names = [name for _, name in sorted(numbered, reverse=True)] + sorted(dated)
+    files = [os.path.join(directory, name) for name in names]
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+
+def read_blocks(path: str, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """Blocks of whole lines of a plain or gzip file, read in chunks without loading the file."""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as file:
+        tail = b''
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            block = tail + chunk
+            end = block.rfind(b'\n') + 1
+            tail = block[end:]
+            if end:
+                yield block[:end]
+        if tail:
+            yield tail + b'\n'
+
+
+class Histogram:
+    """Fixed-bucket latency histogram (ms)."""
+    
+    __slots__ = ('counts', 'total', 'sum', 'min', 'max')
+    
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BOUNDS_MS) + 1)
+        self.total = 0
+        self.sum = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+    
+    def add(self, value_ms: float) -> None:
+        self.counts[bisect.bisect_left(LATENCY_BOUNDS_MS, value_ms)] += 1
+        self.total += 1
+        self.sum += value_ms
+        if value_ms < self.min:
+            self.min = value_ms
+        if value_ms > self.max:
+            self.max = value_ms
+    
+    def quantile(self, fraction: float) -> Optional[float]:
+        """
+        Quantile interpolated inside its bucket.
+        
+        Границы корзины сужаются до наблюдаемых min/max, поэтому квантиль
+        никогда не выходит за реальный диапазон значений (p50 <= max).
+        """
+        if not self.total:
+            return None
+        rank = fraction * self.total
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = LATENCY_BOUNDS_MS[index - 1] if index else 0.0
+                upper = LATENCY_BOUNDS_MS[index] if index < len(LATENCY_BOUNDS_MS) else self.max
+                lower, upper = max(lower, self.min), min(upper, self.max)
+                return lower + (upper - lower) * max(rank - seen, 0) / count
+            seen += count
+        return self.max
+
+
+class Bucket:
+    """Counters of one time interval."""
+    
+    __slots__ = ('received', 'processed', 'sends', 'send_errors', 'edits', 'edit_errors', 'errors',
+                 'update_latency')
+    
+    def __init__(self):
+        self.received = 0
+        self.processed = 0
+        self.sends = 0
+        self.send_errors = 0
+        self.edits = 0
+        self.edit_errors = 0
+        self.errors = 0
+        self.update_latency = Histogram()
+
+
+class LogAnalyzer:
+    """Reconstructs update latency, API errors and throughput from log lines."""
+    
+    def __init__(self, bucket_seconds: int = 3600, window: float = 60.0, max_chats: int = 100_000,
+                 since: Optional[float] = None, until: Optional[float] = None):
+        self.bucket_seconds = bucket_seconds
+        self.window = window
+        self.max_chats = max_chats
+        self.since = since
+        self.until = until
+        
+        self.buckets: Dict[int, Bucket] = {}
+        self.lines = 0
+        self.parsed = 0
+        self.first: Optional[float] = None
+        self.last: Optional[float] = None
+        self.batches = 0
+        
+        self.update_latency = Histogram()
+        self.send_latency = Histogram()
+        self.edit_latency = Histogram()
+        self.unanswered = 0
+        self.unmatched_results = 0
+        
+        # Update, ожидающий строку "User ID" или "bot_started:" (пишется в той же задаче без await)
+        self._awaiting_user: Optional[float] = None
+        # user_id -> время начала update без ответа
+        self._open_updates: 'OrderedDict[int, float]' = OrderedDict()
+        # Запросы без результата: (время, chat_id)
+        self._sends: Deque[Tuple[float, int]] = deque()
+        self._edits: Deque[Tuple[float, int]] = deque()
+        # chat_id -> user_id (LRU)
+        self._chat_users: 'OrderedDict[int, int]' = OrderedDict()
+        
+        self._second_cache: Tuple[bytes, float] = (b'', 0.0)
+    
+    def _timestamp(self, second: bytes, millis: bytes) -> float:
+        cached, value = self._second_cache
+        if second != cached:
+            value = time.mktime(time.strptime(second.decode('ascii'), '%Y-%m-%d %H:%M:%S'))
+            self._second_cache = (second, value)
+            # Незавершенные update и запросы проверяются раз в секунду лога
+            self._expire(value)
+        return value + int(millis) / 1000
+    
+    def _bucket(self, timestamp: float) -> Bucket:
+        key = int(timestamp // self.bucket_seconds)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = Bucket()
+        return bucket
+    
+    def feed(self, block: bytes) -> None:
+        """Process a block of whole log lines."""
+        self.lines += block.count(b'\n')
+        for match in _LINE.finditer(block):
+            self._line(match)
+    
+    def _line(self, match: 're.Match') -> None:
+        timestamp = self._timestamp(match.group(1), match.group(2))
+        if (self.since is not None and timestamp < self.since) or (self.until is not None and timestamp >= self.until):
+            return
+        self.parsed += 1
+        if self.first is None:
+            self.first = timestamp
+        self.last = timestamp
+        
+        message = match.group(4)
+        bucket = self._bucket(timestamp)
+        if match.group(3):
+            bucket.errors += 1
+        
+        if message.startswith(b'Processing update'):
+            bucket.processed += 1
+            self._awaiting_user = timestamp
+        elif message.startswith(b'User ID'):
+            self._open_update(int(_USER.match(message).group(1)))
+        elif message.startswith(b'bot_started:'):
+            started = _BOT_STARTED.match(message)
+            if started:
+                self._remember_chat(int(started.group(1)), int(started.group(2)))
+                self._open_update(int(started.group(2)))
+        elif message.startswith(b'Received'):
+            received = _RECEIVED.match(message)
+            if received:
+                bucket.received += int(received.group(1))
+                self.batches += 1
+        elif message.startswith(b'Sending message'):
+            bucket.sends += 1
+            self._sends.append((timestamp, int(_SENDING.match(message).group(1))))
+        elif message.startswith(b'Editing message'):
+            editing = _EDITING.match(message)
+            if editing:
+                bucket.edits += 1
+                self._edits.append((timestamp, int(editing.group(1))))
+        elif message.startswith(_SENT):
+            self._complete(self._sends, self.send_latency, timestamp, True)
+        elif message.startswith(_SEND_ERROR):
+            bucket.send_errors += 1
+            self._complete(self._sends, self.send_latency, timestamp, False)
+        elif message.startswith(_EDIT_FAILED):
+            bucket.edit_errors += 1
+            self._complete(self._edits, self.edit_latency, timestamp, False)
+        elif message.startswith(b'Message ') and _EDITED.match(message):
+            self._complete(self._edits, self.edit_latency, timestamp, True)
+    
+    def _open_update(self, user_id: int) -> None:
+        if self._awaiting_user is None:
+            return
+        # Предыдущий update пользователя остался без ответа (например, отправка не удалась)
+        if self._open_updates.pop(user_id, None) is not None:
+            self.unanswered += 1
+        self._open_updates[user_id] = self._awaiting_user
+        self._awaiting_user = None
+    
+    def _remember_chat(self, chat_id: int, user_id: int) -> None:
+        self._chat_users[chat_id] = user_id
+        self._chat_users.move_to_end(chat_id)
+        if len(self._chat_users) > self.max_chats:
+            self._chat_users.popitem(last=False)
+    
+    def _complete(self, pending: Deque[Tuple[float, int]], latency: Histogram, timestamp: float, success: bool) -> None:
+        if not pending:
+            self.unmatched_results += 1
+            return
+        started, chat_id = pending.popleft()
+        latency.add((timestamp - started) * 1000)
+        if success:
+            self._reply(timestamp, chat_id)
+    
+    def _reply(self, timestamp: float, chat_id: int) -> None:
+        user_id = self._chat_users.get(chat_id)
+        if user_id is None:
+            if chat_id in self._open_updates:
+                user_id = chat_id
+            elif self._open_updates:
+                # Чат еще не встречался: самый давний update без ответа
+                user_id = next(iter(self._open_updates))
+            else:
+                return
+        self._remember_chat(chat_id, user_id)
+        
+        started = self._open_updates.pop(user_id, None)
+        if started is not None:
+            self._update_done(started, timestamp)
+    
+    def _update_done(self, started: float, timestamp: float) -> None:
+        latency = (timestamp - started) * 1000
+        self.update_latency.add(latency)
+        self._bucket(started).update_latency.add(latency)
+    
+    def _expire(self, now: float) -> None:
+        deadline = now - self.window
+        while self._open_updates:
+            user_id, started = next(iter(self._open_updates.items()))
+            if started >= deadline:
+                break
+            del self._open_updates[user_id]
+            self.unanswered += 1
+        for pending in (self._sends, self._edits):
+            while pending and pending[0][0] < deadline:
+                pending.popleft()
+    
+    def finish(self) -> None:
+        self.unanswered += len(self._open_updates)
+        self._open_updates.clear()
+
+
+def _ms(value: Optional[float]) -> str:
+    if value is None:
+        return '-'
+    return f"{value:.0f}ms" if value < 10_000 else f"{value / 1000:.0f}s"
+
+
+def _rate(part: int, total: int) -> str:
+    return f"{part / total * 100:.1f}%" if total else '-'
+
+
+def print_report(analyzer: LogAnalyzer, files: List[str], elapsed: float, size: int) -> None:
+    print(f"Files: {len(files)}, {size / 2**20:,.1f} MiB, {analyzer.lines:,} lines "
+          f"({analyzer.parsed:,} relevant) in {elapsed:.1f}s ({size / 2**20 / max(elapsed, 1e-9):,.0f} MiB/s)")
+    if analyzer.first is None:
+        print("No bot activity found")
+        return
+    
+    span = max(analyzer.last - analyzer.first, 1e-9)
+    buckets = [analyzer.buckets[key] for key in sorted(analyzer.buckets)]
+    received = sum(bucket.received for bucket in buckets)
+    processed = sum(bucket.processed for bucket in buckets)
+    sends = sum(bucket.sends for bucket in buckets)
+    send_errors = sum(bucket.send_errors for bucket in buckets)
+    edits = sum(bucket.edits for bucket in buckets)
+    edit_errors = sum(bucket.edit_errors for bucket in buckets)
+    peak = max(buckets, key=lambda bucket: bucket.processed)
+    
+    print(f"Period: {datetime.fromtimestamp(analyzer.first):%Y-%m-%d %H:%M:%S} - "
+          f"{datetime.fromtimestamp(analyzer.last):%Y-%m-%d %H:%M:%S}")
+    print(f"\nUpdates: received {received:,} in {analyzer.batches:,} batches, processed {processed:,}")
+    print(f"Throughput: {processed / span:.2f} updates/s average, "
+          f"{peak.processed / analyzer.bucket_seconds:.2f} updates/s in the busiest interval")
+    
+    latency = analyzer.update_latency
+    print(f"\nUpdate latency to first reply: {latency.total:,} updates, "
+          f"p50 {_ms(latency.quantile(0.5))}, p90 {_ms(latency.quantile(0.9))}, "
+          f"p99 {_ms(latency.quantile(0.99))}, max {_ms(latency.max if latency.total else None)}")
+    print(f"Updates without reply within {analyzer.window:g}s: {analyzer.unanswered:,}")
+    
+    print(f"\nSend message: {sends:,} requests, {send_errors:,} errors ({_rate(send_errors, sends)}), "
+          f"p50 {_ms(analyzer.send_latency.quantile(0.5))}, p99 {_ms(analyzer.send_latency.quantile(0.99))}")
+    print(f"Edit message: {edits:,} requests, {edit_errors:,} failed ({_rate(edit_errors, edits)}), "
+          f"p50 {_ms(analyzer.edit_latency.quantile(0.5))}, p99 {_ms(analyzer.edit_latency.quantile(0.99))}")
+    if analyzer.unmatched_results:
+        print(f"Results without a matching request: {analyzer.unmatched_results:,}")
+    
+    time_format = '%Y-%m-%d %H:%M' if analyzer.bucket_seconds % 60 == 0 else '%Y-%m-%d %H:%M:%S'
+    print(f"\n{'interval':<19} {'recv':>7} {'proc':>7} {'upd/s':>7} {'sends':>7} {'err':>6} "
+          f"{'edits':>7} {'err':>6} {'p50':>7} {'p90':>7} {'ERRORs':>7}")
+    for key in sorted(analyzer.buckets):
+        bucket = analyzer.buckets[key]
+        start = datetime.fromtimestamp(key * analyzer.bucket_seconds).strftime(time_format)
+        print(f"{start:<19} {bucket.received:>7,} {bucket.processed:>7,} "
+              f"{bucket.processed / analyzer.bucket_seconds:>7.2f} {bucket.sends:>7,} "
+              f"{_rate(bucket.send_errors, bucket.sends):>6} {bucket.edits:>7,} "
+              f"{_rate(bucket.edit_errors, bucket.edits):>6} {_ms(bucket.update_latency.quantile(0.5)):>7} "
+              f"{_ms(bucket.update_latency.quantile(0.9)):>7} {bucket.errors:>7,}")
+
+
+def parse_time(value: str) -> float:
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError(f"Invalid time: {value} (expected YYYY-MM-DD [HH:MM[:SS]])")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Analyze bot performance from bot.log')
+    parser.add_argument('paths', nargs='+', help='log files (.gz supported)')
+    parser.add_argument('--no-rotated', action='store_true', help='do not include rotated files next to each log')
+    parser.add_argument('--bucket', type=int, default=3600, help='timeline interval, seconds')
+    parser.add_argument('--window', type=float, default=60.0, help='seconds to wait for a reply or API result')
+    parser.add_argument('--max-chats', type=int, default=100_000, help='remembered chat to user mappings')
+    parser.add_argument('--since', type=parse_time, help='start time, local (YYYY-MM-DD [HH:MM[:SS]])')
+    parser.add_argument('--until', type=parse_time, help='end time, local')
+    parser.add_argument('--chunk-mb', type=int, default=CHUNK_SIZE // 2**20, help='read chunk size, MiB')
+    args = parser.parse_args()
+    
+    files: List[str] = []
+    for path in args.paths:
+        for file in ([path] if args.no_rotated or path.endswith('.gz') else rotated_files(path)):
+            if file not in files:
+                files.append(file)
+    missing = [file for file in files if not os.path.exists(file)]
+    if missing:
+        parser.error(f"File not found: {', '.join(missing)}")
+    
+    analyzer = LogAnalyzer(args.bucket, args.window, args.max_chats, args.since, args.until)
+    started = time.perf_counter()
+    for file in files:
+        for block in read_blocks(file, args.chunk_mb * 2**20):
+            analyzer.feed(block)
+    analyzer.finish()
+    
+    print_report(analyzer, files, time.perf_counter() - started, sum(os.path.getsize(file) for file in files))
+
+
+if __name__ == '__main__':
+    main()
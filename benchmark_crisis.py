@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк поиска кризисных фраз (bot/crisis.py)
+
+Прогоняет N синтетических сообщений через автомат Aho-Corasick и через
+наивный поиск (каждый вариант фразы лексикона ищется отдельно подстрокой
+в нормализованном тексте), сверяет результаты и печатает пропускную способность.
+Нормализация слов у обоих способов общая и кэшируется.
+
+--extra-phrases добавляет к лексикону случайные фразы: наивный поиск
+замедляется пропорционально размеру лексикона, автомат - нет.
+
+Запуск:
+    python benchmark_crisis.py --messages 100000
+    python benchmark_crisis.py --messages 100000 --extra-phrases 2000
+"""
+
+import argparse
+import random
+import time
+
+from bot.crisis import DEFAULT_LEXICON, CrisisDetector
+
+# Типичные ответы пользователей в текстовых шагах диалога
+ORDINARY_TEXTS = (
+    '25',
+    'Москва',
+    'Анонимные алкоголики на Таганке',
+    'Иванова Мария Петровна',
+    'Как помочь мужу, если он не признает, что пьет?',
+    'Сколько длится реабилитация после лечения в клинике?',
+    'Можно ли посещать группу онлайн, если я живу в маленьком городе?',
+    'Брат играет в автоматы каждый день и берет кредиты, что делать',
+    'Спасибо, все понятно',
+    'Я срываюсь каждые выходные и потом очень стыдно перед семьей',
+)
+CRISIS_TEXTS = (
+    'Я больше не хочу жить так',
+    'иногда думаю покончить с собой',
+    'у сына был передоз на прошлой неделе',
+    'хочу умерееееть',
+)
+LETTERS = 'абвгдежзиклмнопрстуфхцчшщэюя'
+
+
+def make_messages(count: int, crisis_share: float, rng: random.Random):
+    messages = []
+    for _ in range(count):
+        texts = CRISIS_TEXTS if rng.random() < crisis_share else ORDINARY_TEXTS
+        messages.append(rng.choice(texts))
+    return messages
+
+
+def make_phrases(count: int, rng: random.Random):
+    return [' '.join(''.join(rng.choice(LETTERS) for _ in range(rng.randint(4, 9)))
+                     for _ in range(rng.randint(1, 3))) for _ in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark crisis phrase detection')
+    parser.add_argument('--messages', type=int, default=100_000, help='number of messages to scan')
+    parser.add_argument('--crisis-share', type=float, default=0.01, help='share of messages with crisis phrases')
+    parser.add_argument('--extra-phrases', type=int, default=0, help='random phrases added to the lexicon')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    
+    rng = random.Random(args.seed)
+    lexicon = list(DEFAULT_LEXICON) + make_phrases(args.extra_phrases, rng)
+    messages = make_messages(args.messages, args.crisis_share, rng)
+    characters = sum(len(message) for message in messages)
+    
+    started = time.perf_counter()
+    detector = CrisisDetector(lexicon, exclusions=())
+    build_time = time.perf_counter() - started
+    print(f"Lexicon: {len(lexicon)} phrases, automaton {len(detector._delta)} nodes, built in {build_time * 1000:.1f} ms")
+    print(f"Messages: {len(messages):,}, {characters / len(messages):.0f} characters on average\n")
+    
+    started = time.perf_counter()
+    found = [detector.find(message) is not None for message in messages]
+    automaton_time = time.perf_counter() - started
+    
+    # Исключения в лексиконе бенчмарка не участвуют
+    patterns = [' ' + ' '.join(tokens) + ' ' for tokens, _, exclusion in detector._patterns if not exclusion]
+    started = time.perf_counter()
+    naive = []
+    for message in messages:
+        text = ' ' + ' '.join(token or '' for token in detector.tokens(message)) + ' '
+        naive.append(any(pattern in text for pattern in patterns))
+    naive_time = time.perf_counter() - started
+    
+    for label, elapsed in (('Aho-Corasick', automaton_time), ('Naive per-phrase', naive_time)):
+        print(f"{label:<18} {len(messages) / elapsed:>10,.0f} msg/s  {characters / elapsed / 2**20:>6.2f} MiB/s  "
+              f"{elapsed / len(messages) * 1e6:>6.1f} us/msg")
+    
+    print(f"\nFlagged: {sum(found):,} messages")
+    print(f"Mismatches with naive search: {sum(1 for a, b in zip(found, naive) if a != b)}")
+
+
+if __name__ == '__main__':
+    main()
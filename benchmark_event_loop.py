@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк цикла событий для MAX бота (bot/runtime.py)
+
+Прогоняет одинаковый синтетический поток updates через MaxBotApplication
+на каждой доступной реализации цикла событий:
+- asyncio
+- asyncio + eager tasks (Python 3.12+)
+- uvloop (если установлен)
+- uvloop + eager tasks (Python 3.12+, если установлен uvloop)
+
+Фейковый MAX API работает в отдельном процессе на стандартном asyncio,
+поэтому разница в результатах относится только к стороне бота.
+
+Запуск:
+    python benchmark_event_loop.py --users 500
+    python benchmark_event_loop.py --users 500 --concurrency 8
+"""
+
+import argparse
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import statistics
+import time
+
+from aiohttp import web
+
+from bot.max_adapter import MaxBot
+from bot.runtime import EAGER_TASKS_SUPPORTED, get_loop_factory, run as run_event_loop
+
+
+def serve_fake_api(port: int, ready):
+    """Minimal MAX API: accepts sends, edits and callback answers."""
+    message_ids = itertools.count(1)
+    
+    async def handle(request):
+        if request.can_read_body:
+            await request.read()
+        if request.path == '/messages' and request.method == 'POST':
+            return web.json_response({'message': {'body': {'mid': f'mid{next(message_ids)}'}}})
+        return web.json_response({'success': True})
+    
+    async def main():
+        app = web.Application()
+        app.router.add_route('*', '/{tail:.*}', handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        ready.set()
+        await asyncio.Event().wait()
+    
+    asyncio.run(main())
+
+
+def make_updates(users: int):
+    """Each user walks /start -> dependency -> timezone -> city."""
+    timestamps = itertools.count(1)
+    per_user = []
+    for user_id in range(1, users + 1):
+        chat_id = user_id * 10
+        steps = [{
+            'update_type': 'message_created',
+            'timestamp': next(timestamps),
+            'message': {
+                'recipient': {'chat_id': chat_id, 'chat_type': 'dialog'},
+                'sender': {'user_id': user_id, 'first_name': 'User'},
+                'body': {'mid': f'user{user_id}', 'text': '/start'},
+            },
+        }]
+        for payload in ('dep_alcohol', 'timezone_msk', 'city_moscow'):
+            steps.append({
+                'update_type': 'message_callback',
+                'timestamp': next(timestamps),
+                'callback': {'callback_id': f'cb{user_id}_{payload}', 'payload': payload,
+                             'user': {'user_id': user_id, 'first_name': 'User'}},
+                'message': {'recipient': {'chat_id': chat_id}, 'body': {'mid': f'bot{user_id}', 'text': ''}},
+            })
+        per_user.append([MaxBot.parse_update(data) for data in steps])
+    return per_user
+
+
+async def run_workload(base_url: str, users: int, concurrency: int):
+    """Process the synthetic updates and return (updates, seconds, per-update latencies)."""
+    from main_max import MaxBotApplication
+    
+    app = MaxBotApplication('benchmark', base_url, verify_ssl=False)
+    per_user = make_updates(users)
+    latencies = []
+    
+    async def worker(group):
+        for updates in group:
+            for max_update in updates:
+                started = time.perf_counter()
+                await app.process_update(max_update)
+                latencies.append(time.perf_counter() - started)
+    
+    groups = [per_user[index::concurrency] for index in range(concurrency)]
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(group) for group in groups))
+    elapsed = time.perf_counter() - started
+    
+    await app.bot.session.close()
+    return len(latencies), elapsed, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark event loop implementations for the MAX bot')
+    parser.add_argument('--users', type=int, default=500, help='number of simulated users (4 updates each)')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='users processed in parallel (1 - as the polling loop does)')
+    parser.add_argument('--port', type=int, default=18765)
+    args = parser.parse_args()
+    
+    # Логирование каждого update замерялось бы вместо цикла событий
+    logging.disable(logging.CRITICAL)
+    
+    context = multiprocessing.get_context('spawn')
+    ready = context.Event()
+    server = context.Process(target=serve_fake_api, args=(args.port, ready), daemon=True)
+    server.start()
+    ready.wait(10)
+    base_url = f'http://127.0.0.1:{args.port}'
+    
+    configurations = [('asyncio', 'asyncio', False)]
+    if EAGER_TASKS_SUPPORTED:
+        configurations.append(('asyncio + eager tasks', 'asyncio', True))
+    if get_loop_factory('auto') is not None:
+        configurations.append(('uvloop', 'uvloop', False))
+        if EAGER_TASKS_SUPPORTED:
+            configurations.append(('uvloop + eager tasks', 'uvloop', True))
+    else:
+        print("uvloop is not installed - install it with `pip install uvloop` to compare\n")
+    
+    try:
+        # Прогрев: соединения, импорты, кэши шаблонов
+        run_event_loop(run_workload(base_url, min(args.users, 50), args.concurrency),
+                       event_loop='asyncio', eager_tasks=False)
+        
+        print(f"{args.users} users x 4 updates, concurrency {args.concurrency}\n")
+        print(f"{'runtime':<24} {'updates/s':>10} {'mean ms':>9} {'p50 ms':>8} {'p99 ms':>8}")
+        for label, event_loop, eager_tasks in configurations:
+            count, elapsed, latencies = run_event_loop(
+                run_workload(base_url, args.users, args.concurrency),
+                event_loop=event_loop, eager_tasks=eager_tasks
+            )
+            latencies.sort()
+            print(f"{label:<24} {count / elapsed:>10.0f} {statistics.mean(latencies) * 1000:>9.2f} "
+                  f"{latencies[len(latencies) // 2] * 1000:>8.2f} {latencies[int(len(latencies) * 0.99)] * 1000:>8.2f}")
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк компактного представления сессий (bot/session.py)
+
+Сравнивает память и скорость сериализации для N смоделированных сессий:
+- dict user_data (как сейчас хранят обработчики)
+- SessionRecord (слоты + коды)
+- SessionRecord.to_bytes() (упакованная форма: в ней хранятся снимок, а в памяти -
+  восстановленные при запуске сессии до первого update пользователя, см. main_max.py)
+
+Запуск:
+    python benchmark_sessions.py --sessions 1000000
+"""
+
+import argparse
+import json
+import random
+import time
+import tracemalloc
+
+from bot.session import (
+    SessionRecord,
+    STATE_VALUES,
+    DEPENDENCY_VALUES,
+    TIMEZONE_VALUES,
+    CITY_VALUES,
+    HELP_TYPE_VALUES,
+    GENDER_VALUES,
+    AGE_USER_VALUES,
+    DISCOVERY_SOURCE_VALUES,
+)
+
+
+def make_user_data(rng: random.Random) -> dict:
+    """Создает user_data, похожий на данные реального пользователя."""
+    # Обработчики получают значения через query.data.replace(...),
+    # поэтому у каждого пользователя свои экземпляры строк
+    def pick(table):
+        return ''.join(rng.choice(table[1:]))
+    
+    preferences = {
+        'dependency': pick(DEPENDENCY_VALUES),
+        'timezone': pick(TIMEZONE_VALUES),
+        'city': pick(CITY_VALUES),
+        'help_type': pick(HELP_TYPE_VALUES),
+    }
+    if rng.random() < 0.5:
+        preferences['consultation_type'] = 'specialist'
+        preferences['gender'] = pick(GENDER_VALUES)
+        preferences['age_user'] = pick(AGE_USER_VALUES)
+    if rng.random() < 0.3:
+        preferences['wants_support'] = rng.random() < 0.5
+    
+    user_data = {
+        'preferences': preferences,
+        'current_state': pick(STATE_VALUES),
+    }
+    if rng.random() < 0.4:
+        user_data['discovery_source'] = pick(DISCOVERY_SOURCE_VALUES)
+    return user_data
+
+
+def measure(label: str, build, count: int, baseline: float = 0.0):
+    """Измеряет память и время построения count объектов; возвращает (объекты, байт на сессию)."""
+    tracemalloc.start()
+    started = time.perf_counter()
+    items = build()
+    elapsed = time.perf_counter() - started
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    per_session = current / count
+    ratio = f"  {baseline / per_session:>5.1f}x smaller" if baseline else ''
+    print(f"{label:<28} {per_session:>8.1f} B/session  {current / 2**20:>9.1f} MiB  build {elapsed:>6.2f}s{ratio}")
+    return items, per_session
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark compact session records')
+    parser.add_argument('--sessions', type=int, default=1_000_000, help='number of simulated sessions')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    count = args.sessions
+    
+    print(f"Simulating {count:,} sessions\n")
+    
+    rng = random.Random(args.seed)
+    user_data, baseline = measure('dict user_data', lambda: [make_user_data(rng) for _ in range(count)], count)
+    records, _ = measure('SessionRecord', lambda: [SessionRecord.from_user_data(d) for d in user_data], count, baseline)
+    packed, _ = measure('SessionRecord.to_bytes()', lambda: [r.to_bytes() for r in records], count, baseline)
+    
+    print()
+    
+    started = time.perf_counter()
+    json_size = sum(len(json.dumps(d, ensure_ascii=False).encode('utf-8')) for d in user_data)
+    json_time = time.perf_counter() - started
+    packed_size = sum(len(p) for p in packed)
+    
+    started = time.perf_counter()
+    for p in packed:
+        SessionRecord.from_bytes(p)
+    unpack_time = time.perf_counter() - started
+    
+    print(f"JSON serialization:   {json_size / count:>6.1f} B/session, {json_time:.2f}s total")
+    print(f"Binary serialization: {packed_size / count:>6.1f} B/session, unpack {unpack_time:.2f}s total")
+    
+    mismatches = sum(1 for d, r in zip(user_data, records) if r.to_user_data() != d)
+    print(f"\nRound-trip mismatches: {mismatches}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,399 @@
+"""
+Funnel analytics for the dependency counseling bot.
+State transitions are appended to size-rotated binary segments off the hot path and folded into constant-memory funnel counters.
+"""
+
+import asyncio
+import bisect
+import logging
+import os
+import struct
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .session import STATE_VALUES, DEPENDENCY_VALUES, TIMEZONE_VALUES
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_MAGIC = b'BEV1'
+SEGMENT_SUFFIX = '.bin'
+
+# Коды состояний, зависимостей и часовых поясов - из bot/session.py (0 - нет значения).
+# t, user_id, из состояния, в состояние, зависимость/пояс до перехода и после,
+# время на предыдущем шаге (сек, -1 - неизвестно), длина payload кнопки
+_EVENT = struct.Struct('<dqBBBBBBfB')
+
+_STATE_CODES = {value: code for code, value in enumerate(STATE_VALUES)}
+_DEPENDENCY_CODES = {value: code for code, value in enumerate(DEPENDENCY_VALUES)}
+_TIMEZONE_CODES = {value: code for code, value in enumerate(TIMEZONE_VALUES)}
+
+Cohort = Tuple[Optional[str], Optional[str]]  # (зависимость, часовой пояс)
+
+
+@dataclass(frozen=True)
+class TransitionEvent:
+    """One state transition of a user."""
+    
+    t: float
+    user_id: int
+    from_state: Optional[str]
+    to_state: Optional[str]  # None - диалог завершен
+    cohort_before: Cohort
+    cohort: Cohort  # после перехода
+    dwell: float  # секунд на предыдущем шаге, -1 если неизвестно
+    choice: str = ''  # payload нажатой кнопки (текст пользователя не сохраняется)
+
+
+def _code(codes: Dict[Optional[str], int], value: Optional[str]) -> int:
+    return codes.get(value, 0)
+
+
+def _value(values: Tuple, code: int) -> Optional[str]:
+    return values[code] if code < len(values) else None
+
+
+def encode_event(event: TransitionEvent) -> bytes:
+    choice = event.choice.encode('utf-8')[:255]
+    return _EVENT.pack(
+        event.t, event.user_id,
+        _code(_STATE_CODES, event.from_state), _code(_STATE_CODES, event.to_state),
+        _code(_DEPENDENCY_CODES, event.cohort_before[0]), _code(_TIMEZONE_CODES, event.cohort_before[1]),
+        _code(_DEPENDENCY_CODES, event.cohort[0]), _code(_TIMEZONE_CODES, event.cohort[1]),
+        event.dwell, len(choice)
+    ) + choice
+
+
+class EventLog:
+    """
+    Append-only binary log of transition events.
+    
+    record() только дописывает запись в буфер в памяти; фоновая задача раз в
+    flush_interval секунд пишет буфер в файл в отдельном потоке. Сегмент
+    закрывается по размеру, имя содержит pid - несколько процессов могут
+    писать в общий каталог. max_segments ограничивает число хранимых
+    сегментов этого процесса (0 - без ограничения).
+    """
+    
+    def __init__(self, directory: str, segment_max_bytes: int = 64 * 1024 * 1024,
+                 flush_interval: float = 1.0, max_segments: int = 0):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.flush_interval = flush_interval
+        self.max_segments = max_segments
+        
+        started = datetime.now().strftime('%Y%m%d-%H%M%S')
+        self._prefix = f"events-{started}-{os.getpid()}"
+        self._segment_index = 0
+        self._segments: List[str] = []
+        self._file = None
+        self._segment_bytes = 0
+        
+        self._buffer = bytearray()
+        self.events_recorded = 0
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        
+        os.makedirs(directory, exist_ok=True)
+    
+    def record(self, event: TransitionEvent) -> None:
+        self._buffer += encode_event(event)
+        self.events_recorded += 1
+    
+    def start(self) -> None:
+        """Start the background flush task."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self) -> None:
+        """Stop the background task, write the buffer and close the segment."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+    
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error writing analytics events: {e}", exc_info=True)
+    
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self._buffer:
+                return
+            data, self._buffer = bytes(self._buffer), bytearray()
+            await asyncio.to_thread(self._write, data)
+    
+    def _write(self, data: bytes) -> None:
+        if self._file is not None and self._segment_bytes >= self.segment_max_bytes:
+            self._file.close()
+            self._file = None
+        if self._file is None:
+            self._open_segment()
+        self._file.write(data)
+        self._file.flush()
+        self._segment_bytes += len(data)
+    
+    def _open_segment(self) -> None:
+        # Новый процесс с тем же pid в ту же секунду не должен дописывать в чужой сегмент
+        while True:
+            path = os.path.join(self.directory, f"{self._prefix}-{self._segment_index:04d}{SEGMENT_SUFFIX}")
+            self._segment_index += 1
+            if not os.path.exists(path):
+                break
+        self._file = open(path, 'wb')
+        self._file.write(SEGMENT_MAGIC)
+        self._segment_bytes = len(SEGMENT_MAGIC)
+        self._segments.append(path)
+        logger.info(f"Writing analytics events to {path}")
+        
+        while self.max_segments and len(self._segments) > self.max_segments:
+            old = self._segments.pop(0)
+            try:
+                os.remove(old)
+            except OSError as e:
+                logger.warning(f"Could not remove old analytics segment {old}: {e}")
+
+
+def event_files(paths: Iterable[str]) -> List[str]:
+    """Expand directories to their segment files, oldest first."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(
+                os.path.join(path, name) for name in os.listdir(path) if name.endswith(SEGMENT_SUFFIX)
+            ))
+        else:
+            files.append(path)
+    return files
+
+
+def read_events(paths: Iterable[str], chunk_size: int = 1024 * 1024) -> Iterator[TransitionEvent]:
+    """
+    Stream events from segment files or directories.
+    
+    Файлы читаются блоками по chunk_size, в памяти держится только текущий блок.
+    Оборванная последняя запись (процесс упал во время записи) пропускается.
+    """
+    for path in event_files(paths):
+        with open(path, 'rb') as file:
+            if file.read(len(SEGMENT_MAGIC)) != SEGMENT_MAGIC:
+                logger.warning(f"Not an analytics segment: {path}")
+                continue
+            
+            buffer = b''
+            offset = 0
+            while True:
+                chunk = file.read(chunk_size)
+                if not chunk:
+                    break
+                buffer = buffer[offset:] + chunk
+                offset = 0
+                while len(buffer) - offset >= _EVENT.size:
+                    fields = _EVENT.unpack_from(buffer, offset)
+                    end = offset + _EVENT.size + fields[9]
+                    if end > len(buffer):
+                        break
+                    choice = buffer[offset + _EVENT.size:end].decode('utf-8', errors='replace')
+                    offset = end
+                    yield TransitionEvent(
+                        t=fields[0],
+                        user_id=fields[1],
+                        from_state=_value(STATE_VALUES, fields[2]),
+                        to_state=_value(STATE_VALUES, fields[3]),
+                        cohort_before=(_value(DEPENDENCY_VALUES, fields[4]), _value(TIMEZONE_VALUES, fields[5])),
+                        cohort=(_value(DEPENDENCY_VALUES, fields[6]), _value(TIMEZONE_VALUES, fields[7])),
+                        dwell=fields[8],
+                        choice=choice,
+                    )
+            if offset < len(buffer):
+                logger.warning(f"Truncated event at the end of {path}")
+
+
+# Границы корзин гистограммы времени на шаге (сек)
+DWELL_BUCKETS = (1, 2, 5, 10, 20, 30, 60, 120, 300, 600, 1800, 3600, 4 * 3600, 24 * 3600)
+
+
+@dataclass
+class StepStats:
+    """Counters of one funnel step."""
+    
+    entered: int = 0
+    left: int = 0
+    dwell_count: int = 0
+    dwell_total: float = 0.0
+    dwell_histogram: List[int] = field(default_factory=lambda: [0] * (len(DWELL_BUCKETS) + 1))
+    
+    def add_dwell(self, seconds: float) -> None:
+        self.dwell_count += 1
+        self.dwell_total += seconds
+        self.dwell_histogram[bisect.bisect_left(DWELL_BUCKETS, seconds)] += 1
+    
+    def dwell_quantile(self, fraction: float) -> Optional[float]:
+        """Upper bound of the histogram bucket holding the quantile (None - no data)."""
+        if not self.dwell_count:
+            return None
+        rank = fraction * self.dwell_count
+        seen = 0
+        for index, count in enumerate(self.dwell_histogram):
+            seen += count
+            if seen >= rank and count:
+                return DWELL_BUCKETS[index] if index < len(DWELL_BUCKETS) else float('inf')
+        return float('inf')
+    
+    def merge(self, other: 'StepStats') -> None:
+        self.entered += other.entered
+        self.left += other.left
+        self.dwell_count += other.dwell_count
+        self.dwell_total += other.dwell_total
+        self.dwell_histogram = [a + b for a, b in zip(self.dwell_histogram, other.dwell_histogram)]
+
+
+class FunnelAggregator:
+    """
+    Incremental funnel counters per cohort (dependency, timezone).
+    
+    Память ограничена числом когорт и состояний (таблицы кодов bot/session.py),
+    а не числом пользователей или событий. Вход в шаг учитывается в когорте
+    после перехода, выход - в когорте до него: пользователь, выбравший
+    зависимость, уходит из шага выбора в той же когорте, в которой вошел.
+    """
+    
+    def __init__(self):
+        self._cohorts: Dict[Cohort, Dict[str, StepStats]] = {}
+        self.events = 0
+    
+    def _step(self, cohort: Cohort, state: str) -> StepStats:
+        steps = self._cohorts.setdefault(cohort, {})
+        step = steps.get(state)
+        if step is None:
+            step = steps[state] = StepStats()
+        return step
+    
+    def add(self, event: TransitionEvent) -> None:
+        self.events += 1
+        if event.to_state is not None:
+            self._step(event.cohort, event.to_state).entered += 1
+        if event.from_state is not None:
+            step = self._step(event.cohort_before, event.from_state)
+            step.left += 1
+            if event.dwell >= 0:
+                step.add_dwell(event.dwell)
+    
+    def add_many(self, events: Iterable[TransitionEvent]) -> None:
+        for event in events:
+            self.add(event)
+    
+    def merge(self, other: 'FunnelAggregator') -> None:
+        for cohort, steps in other._cohorts.items():
+            for state, step in steps.items():
+                self._step(cohort, state).merge(step)
+        self.events += other.events
+    
+    def cohorts(self) -> List[Cohort]:
+        return list(self._cohorts)
+    
+    def steps(self, dependency: Optional[str] = None, timezone: Optional[str] = None) -> Dict[str, StepStats]:
+        """Step counters merged over cohorts matching the filter (None - any value)."""
+        merged: Dict[str, StepStats] = {}
+        for (cohort_dependency, cohort_timezone), steps in self._cohorts.items():
+            if dependency is not None and cohort_dependency != dependency:
+                continue
+            if timezone is not None and cohort_timezone != timezone:
+                continue
+            for state, step in steps.items():
+                merged.setdefault(state, StepStats()).merge(step)
+        return merged
+
+
+def _format_seconds(value: Optional[float]) -> str:
+    if value is None:
+        return '-'
+    if value == float('inf'):
+        return '>1d'
+    if value < 60:
+        return f"{value:.0f}s"
+    if value < 3600:
+        return f"{value / 60:.0f}m"
+    return f"{value / 3600:.0f}h"
+
+
+def format_funnel(steps: Dict[str, StepStats], title: str) -> str:
+    """Funnel table in the order of conversation states."""
+    lines = [title, '', 'шаг: вошли / ушли дальше / отвал, время на шаге p50..p90']
+    for state in STATE_VALUES:
+        step = steps.get(state)
+        if step is None or not step.entered:
+            continue
+        stayed = max(step.entered - step.left, 0)
+        lines.append(
+            f"{state}: {step.entered} / {step.left} / {stayed / step.entered:.0%}, "
+            f"{_format_seconds(step.dwell_quantile(0.5))}..{_format_seconds(step.dwell_quantile(0.9))}"
+        )
+    if len(lines) == 3:
+        lines.append('нет данных')
+    return '\n'.join(lines)
+
+
+# Пользователей, для которых помнится время входа в текущий шаг (самые давние вытесняются)
+STEP_START_USERS = 100_000
+
+
+class FunnelAnalytics:
+    """Aggregates transitions in memory and appends them to the event log."""
+    
+    def __init__(self, log: Optional[EventLog] = None, max_users: int = STEP_START_USERS):
+        self.log = log
+        self.aggregator = FunnelAggregator()
+        # user_id -> время входа в текущий шаг. Хранится здесь, а не в user_data:
+        # сессия не должна меняться (и сохраняться) из-за одной метки времени
+        self.max_users = max_users
+        self._step_started: 'OrderedDict[int, float]' = OrderedDict()
+    
+    def enter_step(self, user_id: int, t: float, in_dialog: bool) -> float:
+        """
+        Remember when the user entered a new step.
+        
+        Returns seconds spent on the previous step, -1 if unknown (например,
+        после перезапуска). in_dialog=False - диалог завершен, метка удаляется.
+        """
+        started = self._step_started.pop(user_id, None)
+        if in_dialog:
+            self._step_started[user_id] = t
+            if len(self._step_started) > self.max_users:
+                self._step_started.popitem(last=False)
+        return t - started if started is not None else -1.0
+    
+    def record(self, event: TransitionEvent) -> None:
+        self.aggregator.add(event)
+        if self.log is not None:
+            self.log.record(event)
+    
+    async def start(self) -> None:
+        """Rebuild counters from existing segments and start writing new events."""
+        if self.log is None:
+            return
+        started = time.perf_counter()
+        restored = FunnelAggregator()
+        await asyncio.to_thread(restored.add_many, read_events([self.log.directory]))
+        # События, пришедшие во время чтения, уже учтены в текущем агрегаторе
+        self.aggregator.merge(restored)
+        logger.info(f"Funnel analytics restored from {restored.events} events "
+                    f"in {time.perf_counter() - started:.1f}s")
+        self.log.start()
+    
+    async def stop(self) -> None:
+        if self.log is not None:
+            await self.log.stop()
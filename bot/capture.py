@@ -0,0 +1,305 @@
+"""
+Traffic capture and replay for the MAX bot.
+Records /updates payloads with PII redacted to gzip JSONL segments and feeds them back into the bot.
+"""
+
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import secrets
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, Any, Iterable, Iterator, List, Optional
+
+from .max_adapter import MaxBot
+
+logger = logging.getLogger(__name__)
+
+CAPTURE_FORMAT_VERSION = 1
+SEGMENT_SUFFIX = '.jsonl.gz'
+
+# Идентификаторы заменяются псевдонимами: связь updates одного пользователя сохраняется
+ID_KEYS = frozenset({'user_id', 'chat_id'})
+# Персональные данные профиля удаляются
+PROFILE_KEYS = frozenset({'name', 'last_name', 'username', 'avatar_url', 'full_avatar_url', 'description'})
+# Тексты пользователей заменяются маской той же длины (кроме команд)
+TEXT_KEYS = frozenset({'text'})
+
+_WORD_CHARACTERS = re.compile(r'\w')
+
+
+def pseudonymize(value: Any, salt: bytes) -> int:
+    """Stable positive int64 pseudonym of an id within one capture salt."""
+    digest = hashlib.blake2b(str(value).encode('utf-8'), digest_size=7, key=salt).digest()
+    return int.from_bytes(digest, 'big')
+
+
+def redact_text(text: str) -> str:
+    """Keep bot commands, mask everything else preserving length and whitespace."""
+    if text.startswith('/'):
+        return text.split(maxsplit=1)[0]
+    return _WORD_CHARACTERS.sub('x', text)
+
+
+def redact_update(data: Any, salt: bytes) -> Any:
+    """
+    Return a copy of a raw update with personal data removed.
+    
+    user_id/chat_id заменяются псевдонимами, имя - на "User", прочие поля профиля
+    удаляются, тексты маскируются, у вложений остается только тип. Payload кнопок,
+    mid и callback_id формирует бот/платформа - они сохраняются для воспроизведения.
+    """
+    if isinstance(data, list):
+        return [redact_update(item, salt) for item in data]
+    if not isinstance(data, dict):
+        return data
+    
+    redacted = {}
+    for key, value in data.items():
+        if key in ID_KEYS and isinstance(value, int):
+            redacted[key] = pseudonymize(value, salt)
+        elif key in PROFILE_KEYS:
+            continue
+        elif key == 'first_name':
+            redacted[key] = 'User'
+        elif key in TEXT_KEYS and isinstance(value, str):
+            redacted[key] = redact_text(value)
+        elif key == 'attachments' and isinstance(value, list):
+            redacted[key] = [{'type': item.get('type')} for item in value if isinstance(item, dict)]
+        else:
+            redacted[key] = redact_update(value, salt)
+    return redacted
+
+
+class CaptureWriter:
+    """
+    Appends polled updates to gzip-compressed JSONL segments.
+    
+    Первая строка сегмента - заголовок {"capture": версия, "started_at": ...},
+    далее по строке на update: {"t": секунды от начала записи, "batch": номер
+    опроса, "update": {...}}. Сегмент закрывается по размеру или по времени.
+    """
+    
+    def __init__(self, directory: str, segment_max_bytes: int = 16 * 1024 * 1024,
+                 segment_max_seconds: float = 3600.0, redact: bool = True,
+                 salt: Optional[str] = None, flush_interval: float = 5.0):
+        """
+        Args:
+            directory: Directory for segment files
+            segment_max_bytes: Uncompressed size after which a new segment starts
+            segment_max_seconds: Age after which a new segment starts
+            redact: Remove personal data before writing
+            salt: Pseudonymization key; random per capture if not set, so ids
+                cannot be linked between captures
+            flush_interval: Seconds between gzip flushes (data loss window on crash)
+        """
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.segment_max_seconds = segment_max_seconds
+        self.redact = redact
+        self.salt = salt.encode('utf-8') if salt else secrets.token_bytes(16)
+        self.flush_interval = flush_interval
+        
+        self.started_at = time.time()
+        self._started_monotonic = time.monotonic()
+        # pid различает реплики, пишущие в общий каталог
+        started = datetime.fromtimestamp(self.started_at).strftime('%Y%m%d-%H%M%S')
+        self._prefix = f"updates-{started}-{os.getpid()}"
+        
+        self._file = None
+        self._segment_index = 0
+        self._segment_bytes = 0
+        self._segment_opened = 0.0
+        self._last_flush = 0.0
+        self._batch = 0
+        self.updates_written = 0
+        
+        os.makedirs(directory, exist_ok=True)
+    
+    def _open_segment(self):
+        path = os.path.join(self.directory, f"{self._prefix}-{self._segment_index:04d}{SEGMENT_SUFFIX}")
+        self._segment_index += 1
+        self._file = gzip.open(path, 'wt', encoding='utf-8')
+        self._segment_bytes = 0
+        self._segment_opened = time.monotonic()
+        self._write({
+            'capture': CAPTURE_FORMAT_VERSION,
+            'started_at': self.started_at,
+            'redacted': self.redact,
+        })
+        logger.info(f"Capturing updates to {path}")
+    
+    def _write(self, record: Dict[str, Any]):
+        line = json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n'
+        self._file.write(line)
+        self._segment_bytes += len(line)
+    
+    def record(self, updates: List[Dict[str, Any]]) -> None:
+        """Write raw updates received by one poll."""
+        if not updates:
+            return
+        
+        now = time.monotonic()
+        if self._file is not None and (self._segment_bytes >= self.segment_max_bytes
+                                       or now - self._segment_opened >= self.segment_max_seconds):
+            self._file.close()
+            self._file = None
+        if self._file is None:
+            self._open_segment()
+        
+        offset = round(now - self._started_monotonic, 6)
+        self._batch += 1
+        for update in updates:
+            self._write({
+                't': offset,
+                'batch': self._batch,
+                'update': redact_update(update, self.salt) if self.redact else update,
+            })
+        self.updates_written += len(updates)
+        
+        # gzip буферизует данные: сбрасываем периодически, а не на каждый опрос
+        if now - self._last_flush >= self.flush_interval:
+            self._file.flush()
+            self._last_flush = now
+    
+    def close(self) -> None:
+        """Finish the current segment."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            logger.info(f"Capture closed, {self.updates_written} updates written")
+
+
+@dataclass
+class CapturedUpdate:
+    """One update read back from a capture."""
+    
+    t: float  # секунды от начала первой записи
+    batch: int  # номер опроса (сквозной для всех прочитанных записей)
+    update: Dict[str, Any]
+
+
+def capture_files(paths: Iterable[str]) -> List[str]:
+    """Expand directories to their segment files, in recording order."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(
+                os.path.join(path, name) for name in os.listdir(path) if name.endswith(SEGMENT_SUFFIX)
+            ))
+        else:
+            files.append(path)
+    return files
+
+
+def read_capture(paths: Iterable[str]) -> Iterator[CapturedUpdate]:
+    """
+    Read captured updates from segment files or directories.
+    
+    Время всех записей отсчитывается от начала самой первой, поэтому паузы
+    между отдельными запусками захвата сохраняются. Оборванный хвост
+    сегмента (процесс упал до сброса gzip) пропускается с предупреждением.
+    """
+    first_started_at = None
+    batch_offset = 0
+    last_key = None
+    
+    for path in capture_files(paths):
+        shift = 0.0
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logger.warning(f"Truncated record in {path}, skipping rest of segment")
+                        break
+                    
+                    if 'capture' in record:
+                        if first_started_at is None:
+                            first_started_at = record['started_at']
+                        shift = record['started_at'] - first_started_at
+                        continue
+                    
+                    # Номера опросов сквозные: у каждого запуска захвата они начинаются с 1
+                    key = (shift, record['batch'])
+                    if key != last_key:
+                        batch_offset += 1
+                        last_key = key
+                    yield CapturedUpdate(t=shift + record['t'], batch=batch_offset, update=record['update'])
+        except (EOFError, OSError) as e:
+            logger.warning(f"Incomplete segment {path}: {e}")
+
+
+@dataclass
+class ReplayStats:
+    """Result of a replay run."""
+    
+    updates: int = 0
+    batches: int = 0
+    elapsed: float = 0.0
+    max_lag: float = 0.0  # максимальное отставание начала пакета от расписания
+    latencies: List[float] = field(default_factory=list)
+    update_types: Counter = field(default_factory=Counter)
+
+
+async def replay(app, records: Iterable[CapturedUpdate], speed: float = 1.0,
+                 max_gap: Optional[float] = None) -> ReplayStats:
+    """
+    Feed captured updates into a MaxBotApplication.
+    
+    Updates одного опроса обрабатываются вместе, как в цикле опроса
+    (coalesce_updates, затем последовательно process_update).
+    
+    Args:
+        app: MaxBotApplication to process updates
+        records: Captured updates in recording order
+        speed: 1 - real time, N - N times faster, 0 - as fast as possible
+        max_gap: Longest pause between batches in capture time (None - keep original)
+    """
+    stats = ReplayStats()
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    schedule = 0.0  # время пакета в шкале захвата (с учетом max_gap)
+    previous_t = None
+    
+    async def run_batch(batch: List[Dict[str, Any]], due: float):
+        if speed > 0:
+            delay = started + due / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            stats.max_lag = max(stats.max_lag, -delay)
+        
+        stats.batches += 1
+        for max_update in app.coalesce_updates([MaxBot.parse_update(data) for data in batch]):
+            update_started = time.perf_counter()
+            await app.process_update(max_update)
+            stats.latencies.append(time.perf_counter() - update_started)
+            stats.update_types[max_update.update_type] += 1
+            stats.updates += 1
+    
+    batch: List[Dict[str, Any]] = []
+    batch_id = None
+    batch_due = 0.0
+    for record in records:
+        if record.batch != batch_id:
+            if batch:
+                await run_batch(batch, batch_due)
+            gap = record.t - previous_t if previous_t is not None else 0.0
+            if max_gap is not None:
+                gap = min(gap, max_gap)
+            schedule += max(gap, 0.0)
+            previous_t = record.t
+            batch, batch_id, batch_due = [], record.batch, schedule
+        batch.append(record.update)
+    if batch:
+        await run_batch(batch, batch_due)
+    
+    stats.elapsed = loop.time() - started
+    return stats
@@ -7,6 +7,7 @@ from typing import Dict, List, Any, Optional
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
 from .states import BotStates
+from .faq import FaqEntry
 
 class ConversationFlow:
     """Manages the conversation flow and decision tree logic."""
@@ -204,6 +205,29 @@ class ConversationFlow:
             'support_group': 'Группа поддержки',
             'other': 'Другое'
         }
+        
+        # Ответы на популярные вопросы (индексируются для поиска в bot/faq.py)
+        self.faq_entries = [
+            FaqEntry(
+                'Вредно ли опохмеляться?',
+                'Да, опохмеление лишь усугубляет пагубное воздействие на организм'
+            ),
+            FaqEntry(
+                'Алкоголь является фактором риска развития онкологических заболеваний?',
+                'Да, этанол, содержащийся в любом спиртном напитке, повышает вероятность возникновения '
+                'онкологических заболеваний.'
+            ),
+            FaqEntry(
+                'Могу ли я сам, своей силой воли, избавиться от зависимости?',
+                'Если стадия лёгкая, попробовать можно, но при более тяжёлой степени зависимости без '
+                'посторонние помощи и поддержки вы не справитесь'
+            ),
+            FaqEntry(
+                'Без чего (кого) не справиться с зависимостью?',
+                'Полноценно справиться с зависимостью поможет правильный подход, основанный на программе '
+                '12 шагов, поддержка со стороны и если требуется, обращение за медикаментозным лечением в клинике'
+            ),
+        ]
     
     def get_dependency_keyboard(self) -> InlineKeyboardMarkup:
         """Create keyboard for dependency type selection."""
@@ -0,0 +1,285 @@
+"""
+Crisis signal detection for free-text messages.
+Phrases of a lexicon are compiled once into a word-level Aho-Corasick automaton and every inbound text is scanned in one pass.
+"""
+
+import logging
+import re
+from bisect import bisect_left
+from collections import deque
+from functools import lru_cache
+from itertools import product
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .faq import stem
+
+logger = logging.getLogger(__name__)
+
+# Фразы, при которых пользователю сразу показываются экстренные контакты.
+# Сравнение идет по основам целых слов (bot/faq.py), поэтому формы слова перечислять не нужно.
+DEFAULT_LEXICON = (
+    'суицид',
+    'самоубийство',
+    'покончить с собой',
+    'убить себя',
+    'убью себя',
+    'не хочу жить',
+    'не хочется жить',
+    'не хочу больше жить',
+    'жить не хочу',
+    'жить не хочется',
+    'нехочу жить',
+    'жить нехочу',
+    'хочу умереть',
+    'лучше бы я умер',
+    'незачем жить',
+    'нет смысла жить',
+    'свести счеты с жизнью',
+    'уйти из жизни',
+    'повеситься',
+    'повешусь',
+    'вскрыть вены',
+    'вскрою вены',
+    'вскрыл вены',
+    'выпрыгнуть из окна',
+    'спрыгнуть с крыши',
+    'наглотаться таблеток',
+    'передозировка',
+    'передоз',
+    'причинить себе вред',
+    'режу себя',
+    'порезать себя',
+    'белая горячка',
+    'угрожает убить',
+)
+
+# Исключения: найденная фраза, которая пересекается с исключением, не считается кризисной
+DEFAULT_EXCLUSIONS = (
+    'из жизни наркотиков',
+    'из жизни алкоголя',
+    'из жизни зависимости',
+)
+
+# Латинские буквы, похожие на кириллические, и цифры вместо букв
+_HOMOGLYPHS = str.maketrans({
+    'a': 'а', 'b': 'в', 'c': 'с', 'e': 'е', 'h': 'н', 'k': 'к', 'm': 'м', 'o': 'о', 'p': 'р', 't': 'т',
+    'x': 'х', 'y': 'у', '0': 'о', '3': 'з', 'ё': 'е', 'ъ': 'ь',
+})
+_WORD = re.compile(r'[а-я]+')
+_REPEATS = re.compile(r'(.)\1+')
+# Частые ошибки: безударные о/а, -ться/-тся, жы/шы
+_MISSPELLINGS = (
+    (re.compile(r'ться'), 'тся'),
+    (re.compile(r'([жш])ы'), r'\1и'),
+    (re.compile(r'о'), 'а'),
+)
+
+
+# Короткие слова не сводятся к основе: иначе "себе" совпадает с "себя", "режу" - с "резать"
+MIN_STEM_WORD_LENGTH = 5
+# Слово лексикона такой длины (после нормализации) совпадает и с началом слова
+# текста ("суицид" - "суицидальные"), более короткое - только целиком
+MIN_PREFIX_LENGTH = 6
+_REFLEXIVE = ('ся', 'сь')
+# Размер кэша слово -> токен автомата
+_TOKEN_CACHE_SIZE = 65536
+
+
+@lru_cache(maxsize=65536)
+def _normalize_word(word: str) -> str:
+    word = _REPEATS.sub(r'\1', word)
+    if len(word) >= MIN_STEM_WORD_LENGTH:
+        reflexive = word.endswith(_REFLEXIVE)
+        word = stem(word)
+        # Основа Snowball отбрасывает -ся: "повесила" и "повеситься" должны различаться
+        if reflexive:
+            word += 'ся'
+    for pattern, replacement in _MISSPELLINGS:
+        word = pattern.sub(replacement, word)
+    return word
+
+
+def normalize(text: str) -> List[str]:
+    """
+    Split text into normalized words.
+    
+    Регистр, ё/е, похожие латинские буквы, повторы букв ("умереееть"), формы
+    слов (основа по Snowball, возвратность сохраняется) и частые ошибки
+    приводятся к одному виду.
+    """
+    return [_normalize_word(word) for word in _WORD.findall(text.lower().translate(_HOMOGLYPHS))]
+
+
+def load_lexicon(path: str) -> Tuple[List[str], List[str]]:
+    """
+    Read phrases and exclusions from a text file.
+    
+    Одна фраза в строке, # начинает комментарий. Строка с "-" в начале -
+    исключение: найденная фраза, которая пересекается с исключением,
+    не считается кризисной ("- из жизни наркотиков").
+    """
+    phrases, exclusions = [], []
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            phrase = line.split('#', 1)[0].strip()
+            if phrase.startswith('-'):
+                exclusions.append(phrase[1:].strip())
+            elif phrase:
+                phrases.append(phrase)
+    return phrases, [phrase for phrase in exclusions if phrase]
+
+
+class CrisisDetector:
+    """
+    Aho-Corasick automaton over normalized lexicon phrases.
+    
+    Алфавит автомата - нормализованные слова, поэтому фраза совпадает только
+    с целыми словами, а сканирование - один поиск в словаре на слово текста.
+    Слово лексикона длиной от MIN_PREFIX_LENGTH совпадает и с более длинными
+    словами текста: такое слово текста заранее сводится к самому длинному
+    подходящему слову лексикона (токену), а в бор добавляются варианты фраз
+    со всеми словами лексикона, которые начинаются с этого слова.
+    
+    Переходы заранее вычислены (DFA): сканирование идет без возвратов по
+    суффиксным ссылкам, отсутствующий в таблице переход ведет в корень.
+    """
+    
+    def __init__(self, phrases: Iterable[str] = DEFAULT_LEXICON, exclusions: Iterable[str] = DEFAULT_EXCLUSIONS):
+        self.phrases: List[str] = []
+        self.exclusions: List[str] = []
+        normalized: List[Tuple[List[str], bool]] = []
+        for phrase_list, exclusion in ((phrases, False), (exclusions, True)):
+            for phrase in phrase_list:
+                words = normalize(phrase)
+                if words:
+                    (self.exclusions if exclusion else self.phrases).append(phrase)
+                    normalized.append((words, exclusion))
+        
+        self._vocabulary = {word for words, _ in normalized for word in words}
+        self._sorted_vocabulary = sorted(self._vocabulary)
+        self._tokens: Dict[str, Optional[str]] = {}
+        
+        # Варианты фраз в токенах: (токены, индекс фразы, исключение)
+        self._patterns: List[Tuple[Tuple[str, ...], int, bool]] = []
+        counters = {False: 0, True: 0}
+        for words, exclusion in normalized:
+            index = counters[exclusion]
+            counters[exclusion] += 1
+            alternatives = [self._extensions(word) for word in words]
+            for tokens in product(*alternatives):
+                self._patterns.append((tokens, index, exclusion))
+        
+        # Бор
+        goto: List[Dict[str, int]] = [{}]
+        own_output: List[List[int]] = [[]]
+        for pattern_index, (tokens, _, _) in enumerate(self._patterns):
+            node = 0
+            for token in tokens:
+                next_node = goto[node].get(token)
+                if next_node is None:
+                    next_node = len(goto)
+                    goto[node][token] = next_node
+                    goto.append({})
+                    own_output.append([])
+                node = next_node
+            own_output[node].append(pattern_index)
+        
+        # Суффиксные ссылки и таблица переходов (обход в ширину). Переходы в корень
+        # не хранятся: узел наследует переходы своей суффиксной ссылки и добавляет свои.
+        # Совпадения в узле: свои варианты и варианты узлов по цепочке суффиксных ссылок.
+        fail = [0] * len(goto)
+        self._output: List[Tuple[int, ...]] = [tuple(output) for output in own_output]
+        self._delta: List[Dict[str, int]] = [dict() for _ in goto]
+        self._delta[0] = dict(goto[0])
+        
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            link = fail[node]
+            self._output[node] += self._output[link]
+            for token, child in goto[node].items():
+                fail[child] = self._delta[link].get(token, 0)
+                queue.append(child)
+            if node:
+                self._delta[node] = {**self._delta[link], **goto[node]}
+    
+    def _extensions(self, word: str) -> List[str]:
+        """Lexicon words a phrase word matches: itself and, for long words, words that start with it."""
+        if len(word) < MIN_PREFIX_LENGTH:
+            return [word]
+        vocabulary = self._sorted_vocabulary
+        extensions = []
+        for position in range(bisect_left(vocabulary, word), len(vocabulary)):
+            if not vocabulary[position].startswith(word):
+                break
+            extensions.append(vocabulary[position])
+        return extensions
+    
+    def _token(self, word: str) -> Optional[str]:
+        """Automaton token of a raw lowercase word, None if no lexicon word matches it."""
+        normalized = _normalize_word(word)
+        if normalized in self._vocabulary:
+            return normalized
+        # Самое длинное слово лексикона, с которого начинается слово текста
+        for length in range(len(normalized) - 1, MIN_PREFIX_LENGTH - 1, -1):
+            if normalized[:length] in self._vocabulary:
+                return normalized[:length]
+        return None
+    
+    def tokens(self, text: str) -> List[Optional[str]]:
+        """Text as automaton tokens, one per word."""
+        cache = self._tokens
+        result = []
+        for word in _WORD.findall(text.lower().translate(_HOMOGLYPHS)):
+            try:
+                token = cache[word]
+            except KeyError:
+                if len(cache) >= _TOKEN_CACHE_SIZE:
+                    cache.clear()
+                token = cache[word] = self._token(word)
+            result.append(token)
+        return result
+    
+    def find_all(self, text: str) -> List[str]:
+        """All lexicon phrases found in the text, in order of their end position."""
+        delta = self._delta
+        output = self._output
+        state = 0
+        matches = []
+        for position, token in enumerate(self.tokens(text)):
+            state = delta[state].get(token, 0)
+            if output[state]:
+                matches.extend((position, pattern_index) for pattern_index in output[state])
+        if not matches:
+            return []
+        
+        # Исключения гасят пересекающиеся с ними фразы
+        excluded = []
+        for end, pattern_index in matches:
+            tokens, _, exclusion = self._patterns[pattern_index]
+            if exclusion:
+                excluded.append((end - len(tokens) + 1, end))
+        found = []
+        for end, pattern_index in matches:
+            tokens, index, exclusion = self._patterns[pattern_index]
+            start = end - len(tokens) + 1
+            if exclusion or any(start <= excluded_end and excluded_start <= end
+                                for excluded_start, excluded_end in excluded):
+                continue
+            if self.phrases[index] not in found:
+                found.append(self.phrases[index])
+        return found
+    
+    def find(self, text: str) -> Optional[str]:
+        """First lexicon phrase found in the text, or None."""
+        found = self.find_all(text)
+        return found[0] if found else None
+
+
+def create_crisis_detector(lexicon_path: Optional[str] = None) -> CrisisDetector:
+    """Detector for a lexicon file, or for the built-in lexicon if no file is set."""
+    if not lexicon_path:
+        return CrisisDetector()
+    phrases, exclusions = load_lexicon(lexicon_path)
+    logger.info(f"Loaded crisis lexicon: {len(phrases)} phrases, {len(exclusions)} exclusions from {lexicon_path}")
+    return CrisisDetector(phrases, exclusions)
@@ -0,0 +1,265 @@
+"""
+Columnar export of user answers from the funnel event log.
+Button choices are decoded into (field, value) rows and streamed into date-partitioned CSV or Parquet files.
+"""
+
+import csv
+import logging
+import os
+import secrets
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .analytics import TransitionEvent
+from .capture import pseudonymize
+from .session import (
+    AGE_SPECIALIST_VALUES, AGE_USER_VALUES, CITY_VALUES, DEPENDENCY_VALUES, DISCOVERY_SOURCE_VALUES,
+    GENDER_VALUES, HELP_TYPE_VALUES, LITERATURE_VALUES, SOS_CHOICE_VALUES, TIMEZONE_VALUES,
+)
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('csv', 'parquet')
+
+# Префикс payload кнопки -> (колонка field, допустимые значения).
+# Значения берутся только из таблиц кодов bot/session.py: произвольный текст в выгрузку не попадает.
+ANSWER_PREFIXES = (
+    ('dep_', 'dependency', DEPENDENCY_VALUES),
+    ('timezone_', 'timezone', TIMEZONE_VALUES),
+    ('city_', 'city', CITY_VALUES),
+    ('help_', 'help_type', HELP_TYPE_VALUES),
+    ('sos_', 'sos_choice', SOS_CHOICE_VALUES),
+    ('gender_', 'gender', GENDER_VALUES),
+    ('ageu_', 'age_user', AGE_USER_VALUES),
+    ('ages_', 'age_specialist', AGE_SPECIALIST_VALUES),
+    ('lit_', 'literature', LITERATURE_VALUES),
+    ('found_', 'discovery_source', DISCOVERY_SOURCE_VALUES),
+)
+
+COLUMNS = ('time', 'user', 'step', 'field', 'value', 'dependency', 'timezone')
+
+# Строк в буфере партиции до записи и одновременно открытых файлов партиций
+DEFAULT_BATCH_ROWS = 10_000
+DEFAULT_MAX_OPEN_PARTITIONS = 16
+
+
+@dataclass(frozen=True)
+class AnswerRow:
+    """One answer of a user."""
+    
+    time: datetime  # UTC
+    user: int  # псевдоним
+    step: Optional[str]  # состояние, в котором нажата кнопка
+    field: str
+    value: str
+    dependency: Optional[str]  # когорта после ответа
+    timezone: Optional[str]
+
+
+def parse_choice(choice: str) -> Optional[Tuple[str, str]]:
+    """(field, value) for a button payload with a known answer, or None."""
+    for prefix, name, values in ANSWER_PREFIXES:
+        if choice.startswith(prefix):
+            value = choice[len(prefix):]
+            return (name, value) if value in values else None
+    return None
+
+
+def answer_rows(events: Iterable[TransitionEvent], salt: bytes) -> Iterator[AnswerRow]:
+    """Answers contained in transition events, with pseudonymized user ids."""
+    for event in events:
+        answer = parse_choice(event.choice) if event.choice else None
+        if answer is None:
+            continue
+        yield AnswerRow(
+            time=datetime.fromtimestamp(event.t, tz=timezone.utc),
+            user=pseudonymize(event.user_id, salt),
+            step=event.from_state,
+            field=answer[0],
+            value=answer[1],
+            dependency=event.cohort[0],
+            timezone=event.cohort[1],
+        )
+
+
+class _CsvPart:
+    def __init__(self, path: str, append: bool = False):
+        self._file = open(path, 'a' if append else 'w', encoding='utf-8', newline='')
+        self._writer = csv.writer(self._file)
+        if not append:
+            self._writer.writerow(COLUMNS)
+    
+    def write(self, rows: List[AnswerRow]) -> None:
+        self._writer.writerows(
+            (row.time.isoformat(timespec='milliseconds'), row.user, row.step or '', row.field, row.value,
+             row.dependency or '', row.timezone or '') for row in rows
+        )
+    
+    def close(self) -> None:
+        self._file.close()
+
+
+class _ParquetPart:
+    def __init__(self, path: str):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        
+        self._pa = pa
+        # Строковые колонки с малым числом значений Parquet сам кодирует словарем
+        self._schema = pa.schema([
+            ('time', pa.timestamp('ms', tz='UTC')),
+            ('user', pa.int64()),
+            ('step', pa.string()),
+            ('field', pa.string()),
+            ('value', pa.string()),
+            ('dependency', pa.string()),
+            ('timezone', pa.string()),
+        ])
+        self._writer = pq.ParquetWriter(path, self._schema, compression='zstd')
+    
+    def write(self, rows: List[AnswerRow]) -> None:
+        self._writer.write_table(self._pa.Table.from_pydict(
+            {name: [getattr(row, name) for row in rows] for name in COLUMNS}, schema=self._schema
+        ))
+    
+    def close(self) -> None:
+        self._writer.close()
+
+
+def parquet_available() -> bool:
+    try:
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+@dataclass
+class ExportStats:
+    """Result of an export run."""
+    
+    rows: int = 0
+    files: List[str] = field(default_factory=list)
+    partitions: Dict[str, int] = field(default_factory=dict)  # дата -> строк
+
+
+class PartitionedWriter:
+    """
+    Writes rows into output/date=YYYY-MM-DD/part-NNNN.<format>.
+    
+    У каждой партиции свой буфер до batch_rows строк. Открыто не больше
+    max_open_partitions файлов: давно не использованная партиция закрывается.
+    Следующие строки закрытой партиции CSV дописываются в ее последний part-файл;
+    Parquet дописать нельзя, поэтому они идут в новый part-файл (с предупреждением
+    в журнале - при вперемешку идущих датах стоит увеличить max_open_partitions).
+    Память ограничена batch_rows * max_open_partitions строк независимо от размера журнала.
+    """
+    
+    def __init__(self, directory: str, file_format: str = 'csv', batch_rows: int = DEFAULT_BATCH_ROWS,
+                 max_open_partitions: int = DEFAULT_MAX_OPEN_PARTITIONS):
+        if file_format not in FORMATS:
+            raise ValueError(f"Unknown export format: {file_format}. Expected one of {', '.join(FORMATS)}")
+        if file_format == 'parquet' and not parquet_available():
+            raise ValueError("Parquet export requires pyarrow (pip install pyarrow)")
+        self.directory = directory
+        self.file_format = file_format
+        self.batch_rows = batch_rows
+        self.max_open_partitions = max_open_partitions
+        self.stats = ExportStats()
+        
+        # дата -> (part-файл, буфер строк); порядок - от давно использованных к недавним
+        self._open: 'OrderedDict[str, Tuple[object, List[AnswerRow]]]' = OrderedDict()
+        # дата -> номер следующего part-файла
+        self._next_part: Dict[str, int] = {}
+        # дата -> последний part-файл этой выгрузки (для дописывания после закрытия)
+        self._last_part: Dict[str, str] = {}
+        self._split_warned = False
+    
+    def _open_part(self, date: str):
+        last = self._last_part.get(date)
+        if last is not None:
+            if self.file_format == 'csv':
+                return _CsvPart(last, append=True)
+            if not self._split_warned:
+                logger.warning(f"Partition date={date} was closed and continues in a new Parquet part file; "
+                               f"increase max_open_partitions (now {self.max_open_partitions}) to keep one file per day")
+                self._split_warned = True
+        
+        partition = os.path.join(self.directory, f"date={date}")
+        os.makedirs(partition, exist_ok=True)
+        index = self._next_part.get(date, 0)
+        while True:
+            path = os.path.join(partition, f"part-{index:04d}.{self.file_format}")
+            if not os.path.exists(path):
+                break
+            index += 1
+        self._next_part[date] = index + 1
+        self._last_part[date] = path
+        self.stats.files.append(path)
+        return _CsvPart(path) if self.file_format == 'csv' else _ParquetPart(path)
+    
+    def _close_partition(self, date: str) -> None:
+        part, buffer = self._open.pop(date)
+        if buffer:
+            part.write(buffer)
+        part.close()
+    
+    def write(self, row: AnswerRow) -> None:
+        date = row.time.strftime('%Y-%m-%d')
+        entry = self._open.get(date)
+        if entry is None:
+            if len(self._open) >= self.max_open_partitions:
+                self._close_partition(next(iter(self._open)))
+            entry = self._open[date] = (self._open_part(date), [])
+        else:
+            self._open.move_to_end(date)
+        
+        part, buffer = entry
+        buffer.append(row)
+        if len(buffer) >= self.batch_rows:
+            part.write(buffer)
+            buffer.clear()
+        self.stats.rows += 1
+        self.stats.partitions[date] = self.stats.partitions.get(date, 0) + 1
+    
+    def close(self) -> ExportStats:
+        for date in list(self._open):
+            self._close_partition(date)
+        return self.stats
+
+
+def events_between(events: Iterable[TransitionEvent], since: Optional[float] = None,
+                   until: Optional[float] = None) -> Iterator[TransitionEvent]:
+    """Events with since <= t < until (unix seconds, None - no bound)."""
+    since = since if since is not None else float('-inf')
+    until = until if until is not None else float('inf')
+    return (event for event in events if since <= event.t < until)
+
+
+def export_answers(events: Iterable[TransitionEvent], directory: str, file_format: str = 'csv',
+                   salt: Optional[str] = None, batch_rows: int = DEFAULT_BATCH_ROWS,
+                   max_open_partitions: int = DEFAULT_MAX_OPEN_PARTITIONS) -> ExportStats:
+    """
+    Stream answers from events into a partitioned export.
+    
+    Args:
+        events: Transition events, e.g. analytics.read_events([ANALYTICS_DIR])
+        directory: Output directory
+        file_format: 'csv' or 'parquet' (needs pyarrow)
+        salt: Pseudonymization key; random per export if not set, so ids
+            of different exports cannot be joined
+        batch_rows: Rows buffered per partition before writing
+        max_open_partitions: Partition files kept open at once
+    """
+    if not salt:
+        logger.warning("Export salt is not set: user pseudonyms are random for this export")
+    key = salt.encode('utf-8') if salt else secrets.token_bytes(16)
+    writer = PartitionedWriter(directory, file_format, batch_rows, max_open_partitions)
+    try:
+        for row in answer_rows(events, key):
+            writer.write(row)
+    finally:
+        stats = writer.close()
+    return stats
@@ -0,0 +1,238 @@
+"""
+FAQ retrieval for the dependency counseling bot.
+Russian tokenizer with a Snowball stemmer and an incremental BM25 inverted index over FAQ answers.
+"""
+
+import heapq
+import logging
+import math
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, Iterable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Параметры BM25
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Слова вопроса FAQ весят больше слов ответа
+QUESTION_WEIGHT = 2
+
+_WORD = re.compile(r'[а-яa-z0-9]+')
+
+STOPWORDS = frozenset("""
+а без более бы был была были было быть в вам вас во вот все всего всех вы где да даже для до его ее ей ему
+если есть еще же за и из или им их к как когда кто ли либо мне меня мы на над нас не него нее ней нет ни
+них но ну о об он она они оно от по под при про с себе себя со так такой там тем то того тоже только
+тот тут у уже чем что чтобы эта эти это этого этой этом этот я
+""".split())
+
+
+@dataclass(frozen=True)
+class FaqEntry:
+    """Question with its answer."""
+    
+    question: str
+    answer: str
+
+
+# ==================== STEMMER ====================
+# Алгоритм Snowball для русского языка (https://snowballstem.org/algorithms/russian/stemmer.html)
+
+_VOWELS = frozenset('аеиоуыэюя')
+
+_PERFECTIVE_GERUND_1 = ('вшись', 'вши', 'в')  # после а/я
+_PERFECTIVE_GERUND_2 = ('ившись', 'ывшись', 'ивши', 'ывши', 'ив', 'ыв')
+_REFLEXIVE = ('ся', 'сь')
+_ADJECTIVE = (
+    'ими', 'ыми', 'его', 'ого', 'ему', 'ому', 'ее', 'ие', 'ые', 'ое', 'ей', 'ий', 'ый', 'ой', 'ем', 'им',
+    'ым', 'ом', 'их', 'ых', 'ую', 'юю', 'ая', 'яя', 'ою', 'ею',
+)
+_PARTICIPLE_1 = ('ем', 'нн', 'вш', 'ющ', 'щ')  # после а/я
+_PARTICIPLE_2 = ('ивш', 'ывш', 'ующ')
+# после а/я
+_VERB_1 = ('ете', 'йте', 'ешь', 'нно', 'ла', 'на', 'ли', 'ем', 'ло', 'но', 'ет', 'ют', 'ны', 'ть', 'й', 'л', 'н')
+_VERB_2 = (
+    'ейте', 'уйте', 'ила', 'ыла', 'ена', 'ите', 'или', 'ыли', 'ило', 'ыло', 'ено', 'ует', 'уют', 'ены', 'ить',
+    'ыть', 'ишь', 'ей', 'уй', 'ил', 'ыл', 'им', 'ым', 'ен', 'ят', 'ит', 'ыт', 'ую', 'ю',
+)
+_NOUN = (
+    'иями', 'ями', 'ами', 'ией', 'иям', 'ием', 'иях', 'ев', 'ов', 'ие', 'ье', 'еи', 'ии', 'ей', 'ой', 'ий',
+    'ям', 'ем', 'ам', 'ом', 'ах', 'ях', 'ию', 'ью', 'ия', 'ья', 'а', 'е', 'и', 'й', 'о', 'у', 'ы', 'ь', 'ю', 'я',
+)
+_DERIVATIONAL = ('ость', 'ост')
+_SUPERLATIVE = ('ейше', 'ейш')
+
+
+def _longest(suffixes: Tuple[str, ...]) -> Tuple[str, ...]:
+    return tuple(sorted(suffixes, key=len, reverse=True))
+
+
+_PERFECTIVE_GERUND_1, _PERFECTIVE_GERUND_2, _ADJECTIVE, _PARTICIPLE_1, _PARTICIPLE_2, _VERB_1, _VERB_2, _NOUN = map(
+    _longest, (_PERFECTIVE_GERUND_1, _PERFECTIVE_GERUND_2, _ADJECTIVE, _PARTICIPLE_1, _PARTICIPLE_2,
+               _VERB_1, _VERB_2, _NOUN)
+)
+
+
+def _strip(word: str, after_a: Tuple[str, ...] = (), plain: Tuple[str, ...] = ()) -> Tuple[str, bool]:
+    """Remove the longest matching suffix; `after_a` suffixes must follow а or я, which is kept."""
+    best = ''
+    for suffix in after_a:
+        if len(suffix) > len(best) and word.endswith(suffix) and word[-len(suffix) - 1:-len(suffix)] in ('а', 'я'):
+            best = suffix
+            break
+    for suffix in plain:
+        if len(suffix) <= len(best):
+            break
+        if word.endswith(suffix):
+            best = suffix
+            break
+    if not best:
+        return word, False
+    return word[:-len(best)], True
+
+
+def _regions(word: str) -> Tuple[int, int]:
+    """Start of RV and R2."""
+    rv = len(word)
+    for index, char in enumerate(word):
+        if char in _VOWELS:
+            rv = index + 1
+            break
+    
+    def after_syllable(start: int) -> int:
+        for index in range(start + 1, len(word)):
+            if word[index] not in _VOWELS and word[index - 1] in _VOWELS:
+                return index + 1
+        return len(word)
+    
+    return rv, after_syllable(after_syllable(0))
+
+
+@lru_cache(maxsize=65536)
+def stem(word: str) -> str:
+    """Snowball stem of a lowercase Russian word (other words are returned as is)."""
+    rv_start, r2_start = _regions(word)
+    if rv_start >= len(word):
+        return word
+    prefix, rv = word[:rv_start], word[rv_start:]
+    
+    # Шаг 1
+    rv, found = _strip(rv, _PERFECTIVE_GERUND_1, _PERFECTIVE_GERUND_2)
+    if not found:
+        rv, _ = _strip(rv, plain=_REFLEXIVE)
+        rv, found = _strip(rv, plain=_ADJECTIVE)
+        if found:
+            rv, _ = _strip(rv, _PARTICIPLE_1, _PARTICIPLE_2)
+        else:
+            rv, found = _strip(rv, _VERB_1, _VERB_2)
+            if not found:
+                rv, _ = _strip(rv, plain=_NOUN)
+    
+    # Шаг 2
+    if rv.endswith('и'):
+        rv = rv[:-1]
+    
+    # Шаг 3: словообразовательный суффикс в R2
+    r2 = max(r2_start - rv_start, 0)
+    for suffix in _DERIVATIONAL:
+        if rv.endswith(suffix) and len(rv) - len(suffix) >= r2:
+            rv = rv[:-len(suffix)]
+            break
+    
+    # Шаг 4
+    if rv.endswith('нн'):
+        rv = rv[:-1]
+    else:
+        rv, found = _strip(rv, plain=_SUPERLATIVE)
+        if found and rv.endswith('нн'):
+            rv = rv[:-1]
+        elif not found and rv.endswith('ь'):
+            rv = rv[:-1]
+    
+    return prefix + rv
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase, drop stop words and stem."""
+    return [stem(word) for word in _WORD.findall(text.lower().replace('ё', 'е')) if word not in STOPWORDS]
+
+
+# ==================== INDEX ====================
+
+class FaqIndex:
+    """
+    Inverted index of FAQ entries ranked by BM25.
+    
+    Записи добавляются по одной: списки вхождений дописываются, средняя длина
+    документа пересчитывается лениво при следующем поиске.
+    """
+    
+    def __init__(self, entries: Iterable[FaqEntry] = (), k1: float = BM25_K1, b: float = BM25_B):
+        self.k1 = k1
+        self.b = b
+        self.entries: List[FaqEntry] = []
+        self._postings: Dict[str, List[Tuple[int, int]]] = {}
+        self._lengths: List[int] = []
+        self._total_length = 0
+        self._norms: List[float] = []
+        self.add_many(entries)
+    
+    def __len__(self) -> int:
+        return len(self.entries)
+    
+    def add(self, entry: FaqEntry) -> int:
+        """Index an entry, return its id."""
+        doc_id = len(self.entries)
+        terms: Dict[str, int] = {}
+        for term in tokenize(entry.question):
+            terms[term] = terms.get(term, 0) + QUESTION_WEIGHT
+        for term in tokenize(entry.answer):
+            terms[term] = terms.get(term, 0) + 1
+        
+        for term, frequency in terms.items():
+            self._postings.setdefault(term, []).append((doc_id, frequency))
+        length = sum(terms.values())
+        self.entries.append(entry)
+        self._lengths.append(length)
+        self._total_length += length
+        self._norms = []
+        return doc_id
+    
+    def add_many(self, entries: Iterable[FaqEntry]) -> None:
+        for entry in entries:
+            self.add(entry)
+    
+    def _length_norms(self) -> List[float]:
+        # k1 * (1 - b + b * dl / avgdl) для каждого документа
+        if len(self._norms) != len(self._lengths):
+            average = self._total_length / len(self._lengths) or 1.0
+            self._norms = [self.k1 * (1 - self.b + self.b * length / average) for length in self._lengths]
+        return self._norms
+    
+    def search(self, text: str, limit: int = 3, min_score: float = 1.5) -> List[Tuple[FaqEntry, float]]:
+        """Best matching entries for a question, highest score first."""
+        if not self.entries:
+            return []
+        norms = self._length_norms()
+        count = len(self.entries)
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(text)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, frequency in postings:
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + norms[doc_id])
+        
+        best = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+        return [(self.entries[doc_id], score) for doc_id, score in best if score >= min_score]
+
+
+def render_faq(entries: Iterable[FaqEntry], markdown: bool = False) -> str:
+    """FAQ entries as message text."""
+    if markdown:
+        return '\n\n'.join(f"**Q: {entry.question}**\nA: {entry.answer}" for entry in entries)
+    return '\n\n'.join(f"Q: {entry.question}\nA: {entry.answer}" for entry in entries)
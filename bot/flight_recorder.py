@@ -0,0 +1,90 @@
+"""
+Per-user flight recorder for the MAX bot.
+Keeps the last updates, transitions and send results of each user as compact records, dumped on demand by /flight.
+"""
+
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Iterator, List, NamedTuple, Optional
+
+# Виды записей
+UPDATE = 'update'
+TRANSITION = 'transition'
+SEND = 'send'
+EDIT = 'edit'
+ERROR = 'error'
+
+# Длина описания записи: полезная нагрузка update не копируется целиком
+DETAIL_MAX_CHARS = 120
+
+# Пользователь update, который сейчас обрабатывается (bind)
+_current_user: ContextVar[Optional[int]] = ContextVar('flight_recorder_user', default=None)
+
+
+class FlightRecord(NamedTuple):
+    t: float
+    kind: str
+    detail: str
+
+
+class FlightRecorder:
+    """
+    Ring buffer of the last `records_per_user` records for each of `max_users` users.
+    
+    Память ограничена records_per_user * max_users записями по DETAIL_MAX_CHARS
+    символов: при переполнении вытесняется пользователь, у которого дольше всех
+    не было событий. Записи не пишутся в лог, поэтому отладка одного пользователя
+    не требует LOG_LEVEL=DEBUG для всех.
+    """
+    
+    def __init__(self, records_per_user: int = 32, max_users: int = 5000):
+        self.records_per_user = records_per_user
+        self.max_users = max_users
+        # user_id -> записи; порядок - от давно активных к недавним
+        self._users: 'OrderedDict[int, deque]' = OrderedDict()
+        self.users_evicted = 0
+    
+    @contextmanager
+    def bind(self, user_id: Optional[int]) -> Iterator[None]:
+        """Attribute records without an explicit user to user_id (the user of the current update)."""
+        token = _current_user.set(user_id)
+        try:
+            yield
+        finally:
+            _current_user.reset(token)
+    
+    def record(self, kind: str, detail: str = '', user_id: Optional[int] = None) -> None:
+        """Add a record for user_id or, if not given, for the bound user; ignored if there is none."""
+        if user_id is None:
+            user_id = _current_user.get()
+            if user_id is None:
+                return
+        
+        records = self._users.get(user_id)
+        if records is None:
+            if len(self._users) >= self.max_users:
+                self._users.popitem(last=False)
+                self.users_evicted += 1
+            records = self._users[user_id] = deque(maxlen=self.records_per_user)
+        else:
+            self._users.move_to_end(user_id)
+        records.append(FlightRecord(time.time(), kind, detail[:DETAIL_MAX_CHARS]))
+    
+    def dump(self, user_id: int) -> List[FlightRecord]:
+        """Records of a user, oldest first."""
+        return list(self._users.get(user_id, ()))
+    
+    @property
+    def users(self) -> int:
+        return len(self._users)
+
+
+def format_flight(records: List[FlightRecord]) -> str:
+    """Records as one line each: time, kind, details."""
+    return "\n".join(
+        f"{datetime.fromtimestamp(record.t).strftime('%H:%M:%S.%f')[:-3]} {record.kind:<10} {record.detail}".rstrip()
+        for record in records
+    )
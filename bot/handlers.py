@@ -5,6 +5,8 @@ NEW VERSION - Complete restructure based on new flow
 """
 
 import logging
+import re
+import time
 from typing import Dict, Any, Optional
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
@@ -16,17 +18,277 @@ from telegram.ext import (
 )
 
 from .states import BotStates
+from .state_machine import STATE_MACHINE, TEXT, END, record_state
+from .analytics import FunnelAnalytics, TransitionEvent, format_funnel
+from .crisis import CrisisDetector
+from .tracing import Tracer, format_traces
+from .flight_recorder import TRANSITION, FlightRecorder, format_flight
+from .faq import FaqIndex, render_faq
+from .questions import QuestionDigest
+from .navigation import (
+    Screen, ScreenCache, find_back_target, find_latest, push_screen, truncate_history
+)
 from .conversation_flow import ConversationFlow
 from .utils import format_user_info, sanitize_input
 from .dependency_links import get_dependency_link
 
 logger = logging.getLogger(__name__)
 
+
+class _CommandQuery:
+    """Callback query stand-in: lets button handlers answer a command with a new message."""
+    
+    def __init__(self, update: Update, data: str):
+        self.data = data
+        self.message = update.message
+        self.from_user = update.effective_user
+    
+    async def answer(self, *args, **kwargs):
+        pass
+    
+    async def edit_message_text(self, text: str, reply_markup=None, parse_mode=None):
+        return await self.message.reply_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+
+
+class _CommandUpdate:
+    """Update of a command message presented as a button press."""
+    
+    def __init__(self, update: Update, data: str):
+        self.message = update.message
+        self.effective_user = update.effective_user
+        self.effective_chat = update.effective_chat
+        self.callback_query = _CommandQuery(update, data)
+
+
+class _ScreenRecorder:
+    """Holds the last screen a handler sent."""
+    
+    def __init__(self):
+        self.screen: Optional[Screen] = None
+
+
+class _RecordingTarget:
+    """Callback query or message proxy that remembers the screen sent through it."""
+    
+    def __init__(self, target, recorder: _ScreenRecorder):
+        self._target = target
+        self._recorder = recorder
+    
+    def __getattr__(self, name):
+        return getattr(self._target, name)
+    
+    async def edit_message_text(self, text: str, reply_markup=None, parse_mode=None, **kwargs):
+        self._recorder.screen = Screen(text, reply_markup, parse_mode)
+        return await self._target.edit_message_text(text, reply_markup=reply_markup, parse_mode=parse_mode, **kwargs)
+    
+    async def reply_text(self, text: str, reply_markup=None, parse_mode=None, **kwargs):
+        self._recorder.screen = Screen(text, reply_markup, parse_mode)
+        return await self._target.reply_text(text, reply_markup=reply_markup, parse_mode=parse_mode, **kwargs)
+
+
+class _RecordingUpdate:
+    """Update proxy whose callback query and message record the sent screen."""
+    
+    def __init__(self, update, recorder: _ScreenRecorder):
+        self._update = update
+        self.callback_query = _RecordingTarget(update.callback_query, recorder) if update.callback_query else None
+        self.message = _RecordingTarget(update.message, recorder) if update.message else None
+    
+    def __getattr__(self, name):
+        return getattr(self._update, name)
+
+
 class BotHandlers:
     """Handles all bot interactions and conversation flow."""
     
-    def __init__(self, conversation_flow: ConversationFlow):
+    def __init__(self, conversation_flow: ConversationFlow, crisis_detector: Optional[CrisisDetector] = None):
         self.conversation_flow = conversation_flow
+        
+        # Поиск признаков кризиса в каждом текстовом сообщении
+        self.crisis_detector = crisis_detector or CrisisDetector()
+        self.crisis_detections = 0
+        
+        # Очередь анонимных вопросов для администраторов (подключается при запуске, см. bot/questions.py)
+        self.questions: Optional[QuestionDigest] = None
+        
+        # Воронка переходов (bot/analytics.py) и администраторы, которым доступна /stats
+        self.analytics: Optional[FunnelAnalytics] = None
+        self.admin_ids: frozenset = frozenset()
+        
+        # Трассировка обработчиков (bot/tracing.py); /traces показывает последние трассировки
+        self.tracer = Tracer()
+        # Последние события каждого пользователя (bot/flight_recorder.py) для /flight
+        self.flight_recorder: Optional[FlightRecorder] = None
+        
+        # Переходы между состояниями описаны в bot/state_machine.py
+        self.state_machine = STATE_MACHINE
+        self._transition_handlers = STATE_MACHINE.bind(self)
+        
+        # Поиск по ответам на популярные вопросы; faq.add() дополняет индекс на лету
+        self.faq = FaqIndex(conversation_flow.faq_entries)
+        
+        # Показанные экраны: "Назад" возвращает сохраненный экран без вызова обработчика
+        self.screens = ScreenCache()
+        self._back_targets = [
+            frozenset(STATE_MACHINE.state_index[target.value] for target in transition.targets)
+            if transition.back else None
+            for transition in STATE_MACHINE.transitions
+        ]
+    
+    async def _run_transition(self, transition_id: int, update, context) -> Any:
+        back_targets = self._back_targets[transition_id]
+        if back_targets is not None:
+            new_state = await self._navigate_back(back_targets, update, context)
+            if new_state is not None:
+                return new_state
+        return await self._run_recorded(self._transition_handlers[transition_id], update, context,
+                                        back=back_targets is not None)
+    
+    async def _run_recorded(self, handler, update, context, back: bool = False) -> Any:
+        """Run a handler, record the state it returns and the screen it sent."""
+        recorder = _ScreenRecorder()
+        from_state, cohort_before = context.user_data.get('current_state'), self._cohort(context.user_data)
+        with self.tracer.span(f"handler {getattr(handler, '__name__', 'handler')}") as span:
+            new_state = await handler(_RecordingUpdate(update, recorder), context)
+            span.set_attribute('state.from', from_state or '')
+            span.set_attribute('state.to', new_state if isinstance(new_state, str) else '')
+        record_state(context.user_data, new_state)
+        self._remember_screen(context.user_data, new_state, recorder.screen, back)
+        self._record_transition(update, context.user_data, from_state, cohort_before, new_state)
+        return new_state
+    
+    @staticmethod
+    def _cohort(user_data: dict):
+        preferences = user_data.get('preferences') or {}
+        return preferences.get('dependency'), preferences.get('timezone')
+    
+    def _record_transition(self, update, user_data: dict, from_state: Optional[str], cohort_before, new_state: Any) -> None:
+        if self.analytics is None and self.flight_recorder is None:
+            return
+        user = update.effective_user
+        user_id = user.get('id') if isinstance(user, dict) else getattr(user, 'id', None)
+        if user_id is None:
+            return
+        query = update.callback_query
+        
+        if self.flight_recorder is not None:
+            choice = f" [{query.data}]" if query is not None and query.data else ''
+            self.flight_recorder.record(TRANSITION, f"{from_state} -> {new_state}{choice}", user_id)
+        if self.analytics is None:
+            return
+        
+        now = time.time()
+        dwell = self.analytics.enter_step(user_id, now, isinstance(new_state, str))
+        
+        self.analytics.record(TransitionEvent(
+            t=now,
+            user_id=user_id,
+            from_state=from_state,
+            to_state=new_state if isinstance(new_state, str) else None,
+            cohort_before=cohort_before,
+            cohort=self._cohort(user_data),
+            dwell=dwell,
+            choice=query.data if query is not None and query.data else '',
+        ))
+    
+    def _remember_screen(self, user_data: dict, new_state: Any, screen: Optional[Screen], back: bool) -> None:
+        if new_state == END:
+            truncate_history(user_data, 0)
+            return
+        state_index = self.state_machine.state_index.get(new_state)
+        if screen is None or state_index is None:
+            return
+        if back:
+            # Экран не нашелся в истории и построен заново: срезаем ушедшие вперед шаги
+            position = find_latest(user_data, state_index)
+            truncate_history(user_data, position if position is not None else 0)
+        push_screen(user_data, state_index, self.screens.put(screen))
+    
+    async def _navigate_back(self, targets, update, context) -> Optional[str]:
+        """Show the previous screen from the history; None if it is not available."""
+        found = find_back_target(context.user_data, targets)
+        if found is None:
+            return None
+        position, state_index, key = found
+        screen = self.screens.get(key)
+        if screen is None:
+            return None
+        
+        query = update.callback_query
+        with self.tracer.span("handler back (cached screen)"):
+            await query.answer()
+            await query.edit_message_text(screen.text, reply_markup=screen.reply_markup, parse_mode=screen.parse_mode)
+        
+        truncate_history(context.user_data, position + 1)
+        new_state = self.state_machine.states[state_index].value
+        from_state, cohort = context.user_data.get('current_state'), self._cohort(context.user_data)
+        record_state(context.user_data, new_state)
+        self._record_transition(update, context.user_data, from_state, cohort, new_state)
+        return new_state
+    
+    async def check_crisis(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+        """
+        Answer a text with crisis signals with emergency contacts right away.
+        
+        Сообщение после этого обрабатывается как обычно: ответ на текущем шаге
+        диалога (например, анонимный вопрос) не должен теряться.
+        Returns True if crisis signals were found.
+        """
+        message = update.message
+        if not message or not message.text or message.text.startswith('/'):
+            return False
+        if self.crisis_detector.find(message.text) is None:
+            return False
+        
+        self.crisis_detections += 1
+        # Текст сообщения в лог не пишем
+        logger.warning(f"Crisis signal from user {format_user_info(update.effective_user)}, "
+                       f"state {context.user_data.get('current_state')}")
+        
+        await message.reply_text(
+            "🆘 Похоже, вам сейчас очень тяжело. Вы не одни, и помощь рядом.\n\n"
+            "Если есть угроза жизни - звоните 112 (бесплатно, круглосуточно).\n"
+            "📞 Телефон доверия: 8-800-2000-122 (бесплатно, круглосуточно, анонимно).\n\n"
+            "Позвоните прямо сейчас или попросите близкого человека побыть рядом.\n"
+            "Когда будете готовы, можно продолжить разговор здесь или начать заново командой /start"
+        )
+        return True
+    
+    async def crisis_guard(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Telegram handler run before the conversation: sends emergency contacts for a crisis message."""
+        await self.check_crisis(update, context)
+    
+    async def start_conversation(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+        """Run /start as the conversation entry point, recording its state and screen."""
+        return await self._run_recorded(self.start, update, context)
+    
+    async def dispatch_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> Optional[str]:
+        """
+        Run the handler of a button press in the user's current state.
+        
+        Returns the new state, or None if the button is not valid in the current state.
+        """
+        state = context.user_data.get('current_state')
+        transition_id = self.state_machine.resolve_callback(state, update.callback_query.data)
+        if transition_id < 0:
+            logger.info(f"No transition from {state} for callback {update.callback_query.data}")
+            return None
+        return await self._run_transition(transition_id, update, context)
+    
+    async def dispatch_text(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> Optional[str]:
+        """Run the text input handler of the user's current state (None if it expects buttons)."""
+        transition_id = self.state_machine.resolve_text(context.user_data.get('current_state'))
+        if transition_id < 0:
+            return None
+        return await self._run_transition(transition_id, update, context)
+    
+    def _transition_callback(self, transition_id: int):
+        """ConversationHandler callback running one transition of the state machine."""
+        async def callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            return await self._run_transition(transition_id, update, context)
+        
+        callback.__name__ = self.state_machine.transitions[transition_id].handler
+        return callback
     
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
         """Handle the /start command."""
@@ -36,7 +298,6 @@ class BotHandlers:
         # Initialize user context
         context.user_data.clear()
         context.user_data['preferences'] = {}
-        context.user_data['current_state'] = BotStates.DEPENDENCY_SELECTION.value
         
         welcome_message = """
 🤝 **Добро пожаловать!**
@@ -90,7 +351,6 @@ class BotHandlers:
             parse_mode='Markdown'
         )
         
-        context.user_data['current_state'] = BotStates.TIME_ZONE_SELECTION.value
         return BotStates.TIME_ZONE_SELECTION.value
     
     # ==================== 2. TIME ZONE AND CITY SELECTION ====================
@@ -119,7 +379,6 @@ class BotHandlers:
             parse_mode='Markdown'
         )
         
-        context.user_data['current_state'] = BotStates.CITY_SELECTION.value
         return BotStates.CITY_SELECTION.value
     
     async def handle_city_selection(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
@@ -146,7 +405,6 @@ class BotHandlers:
             parse_mode='Markdown'
         )
         
-        context.user_data['current_state'] = BotStates.HELP_TYPE.value
         return BotStates.HELP_TYPE.value
     
     async def back_to_timezones(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
@@ -231,10 +489,9 @@ class BotHandlers:
                 reply_markup=keyboard
             )
             
-            context.user_data['current_state'] = BotStates.HELP_CHOICE.value
             return BotStates.HELP_CHOICE.value
-
-            
+        
+        
         elif help_type == 'groups_selection':
             # Подбор онлайн/офлайн-групп
             dependency_type = context.user_data['preferences'].get('dependency', '')
@@ -270,9 +527,8 @@ class BotHandlers:
                 reply_markup=keyboard
             )
             
-            context.user_data['current_state'] = BotStates.HELP_TYPE.value
             return BotStates.HELP_TYPE.value
-            
+        
         elif help_type == 'specialist':
             # Консультация специалиста - начинаем с выбора пола
             message = """
@@ -288,26 +544,11 @@ class BotHandlers:
             )
             
             context.user_data['preferences']['consultation_type'] = 'specialist'
-            context.user_data['current_state'] = BotStates.GENDER_PREFERENCE.value
             return BotStates.GENDER_PREFERENCE.value
-            
+        
         elif help_type == 'faq':
             # Ответы на популярные вопросы
-            message = """
-❓ Ответы на популярные вопросы
-
-Q: Вредно ли опохмеляться?
-A: Да, опохмеление лишь усугубляет пагубное воздействие на организм
-
-Q: Алкоголь является фактором риска развития онкологических заболеваний?
-A: Да, этанол, содержащийся в любом спиртном напитке, повышает вероятность возникновения онкологических заболеваний.
-
-Q: Могу ли я сам, своей силой воли, избавиться от зависимости?
-A: Если стадия лёгкая, попробовать можно, но при более тяжёлой степени зависимости без посторонние помощи и поддержки вы не справитесь
-
-Q: Без чего (кого) не справиться с зависимостью?
-A: Полноценно справиться с зависимостью поможет правильный подход, основанный на программе 12 шагов, поддержка со стороны и если требуется, обращение за медикаментозным лечением в клинике
-            """
+            message = f"❓ Ответы на популярные вопросы\n\n{render_faq(self.faq.entries)}"
             
             keyboard = InlineKeyboardMarkup([
                 [InlineKeyboardButton("⬅️ Назад к выбору помощи", callback_data="back_to_help")]
@@ -318,9 +559,8 @@ A: Полноценно справиться с зависимостью пом
                 reply_markup=keyboard
             )
             
-            context.user_data['current_state'] = BotStates.HELP_TYPE.value
             return BotStates.HELP_TYPE.value
-            
+        
         elif help_type == 'webinars':
             # Расписание вебинаров спикеров
             message = """
@@ -342,9 +582,8 @@ A: Полноценно справиться с зависимостью пом
                 reply_markup=keyboard
             )
             
-            context.user_data['current_state'] = BotStates.HELP_TYPE.value
             return BotStates.HELP_TYPE.value
-
+    
     async def ask_how_found_us(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
         """Ask how the user found us."""
         query = update.callback_query
@@ -361,7 +600,6 @@ A: Полноценно справиться с зависимостью пом
             parse_mode='Markdown'
         )
         
-        context.user_data['current_state'] = BotStates.HOW_FOUND_US.value
         return BotStates.HOW_FOUND_US.value
     
     def get_dependency_info(self, dependency_type: str) -> str:
@@ -432,7 +670,6 @@ A: Полноценно справиться с зависимостью пом
             reply_markup=keyboard
         )
         
-        context.user_data['current_state'] = BotStates.SUPPORT_OR_SPECIALIST.value
         return BotStates.SUPPORT_OR_SPECIALIST.value
     
     async def handle_choose_literature(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
@@ -452,7 +689,6 @@ A: Полноценно справиться с зависимостью пом
             reply_markup=self.conversation_flow.get_literature_keyboard()
         )
         
-        context.user_data['current_state'] = BotStates.LITERATURE_CHOICE.value
         return BotStates.LITERATURE_CHOICE.value
     
     async def handle_skip_both(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
@@ -485,7 +721,6 @@ A: Полноценно справиться с зависимостью пом
             reply_markup=keyboard
         )
         
-        context.user_data['current_state'] = BotStates.HELP_CHOICE.value
         return BotStates.HELP_CHOICE.value
     
     async def handle_support_choice_after_info(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
@@ -514,7 +749,6 @@ A: Полноценно справиться с зависимостью пом
             reply_markup=keyboard
         )
         
-        context.user_data['current_state'] = BotStates.LITERATURE_CHOICE.value
         return BotStates.LITERATURE_CHOICE.value
     
     # ==================== 5. LITERATURE CHOICE ====================
@@ -552,9 +786,8 @@ A: Полноценно справиться с зависимостью пом
                 reply_markup=keyboard
             )
             
-            context.user_data['current_state'] = BotStates.SUPPORT_OR_SPECIALIST.value
             return BotStates.SUPPORT_OR_SPECIALIST.value
-            
+        
         elif wants_literature:
             # User wants literature but not support - show literature options
             message = """
@@ -567,7 +800,7 @@ A: Полноценно справиться с зависимостью пом
             )
             
             return BotStates.LITERATURE_CHOICE.value
-            
+        
         else:
             # User doesn't want either - proceed to discovery question
             return await self.show_discovery_question(query, context)
@@ -734,9 +967,8 @@ https://ozon.ru/t/LtWbt2m
                 parse_mode='Markdown'
             )
             
-            context.user_data['current_state'] = BotStates.ONLINE_OFFLINE_GROUPS.value
             return BotStates.ONLINE_OFFLINE_GROUPS.value
-            
+        
         elif choice == 'specialist':
             # Ask for user's gender
             message = """
@@ -752,7 +984,6 @@ https://ozon.ru/t/LtWbt2m
             )
             
             context.user_data['preferences']['consultation_type'] = 'specialist'
-            context.user_data['current_state'] = BotStates.GENDER_PREFERENCE.value
             return BotStates.GENDER_PREFERENCE.value
     
     # ==================== 7. SPECIALIST FLOW ====================
@@ -782,7 +1013,6 @@ https://ozon.ru/t/LtWbt2m
             parse_mode='Markdown'
         )
         
-        context.user_data['current_state'] = BotStates.AGE_USER.value
         return BotStates.AGE_USER.value
     
     async def handle_age_user(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
@@ -827,7 +1057,6 @@ https://ozon.ru/t/LtWbt2m
                 parse_mode='Markdown'
             )
             
-            context.user_data['current_state'] = BotStates.AGE_USER.value
             return BotStates.AGE_USER.value
         else:
             # For specialist consultation, ask for age preference
@@ -841,7 +1070,6 @@ https://ozon.ru/t/LtWbt2m
                 parse_mode='Markdown'
             )
             
-            context.user_data['current_state'] = BotStates.AGE_SPECIALIST_PREFERENCE.value
             return BotStates.AGE_SPECIALIST_PREFERENCE.value
     
     async def handle_age_specialist(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
@@ -880,7 +1108,6 @@ https://ozon.ru/t/LtWbt2m
         )
         
         logger.info(f"Showing specialist selection complete message with continue button, state: AGE_SPECIALIST_PREFERENCE")
-        context.user_data['current_state'] = BotStates.AGE_SPECIALIST_PREFERENCE.value
         return BotStates.AGE_SPECIALIST_PREFERENCE.value
     
     # ==================== 8. DISCOVERY QUESTION ====================
@@ -901,7 +1128,6 @@ https://ozon.ru/t/LtWbt2m
             parse_mode='Markdown'
         )
         
-        context.user_data['current_state'] = BotStates.HOW_FOUND_US.value
         return BotStates.HOW_FOUND_US.value
     
     async def handle_continue_to_discovery(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
@@ -937,9 +1163,8 @@ https://ozon.ru/t/LtWbt2m
                 parse_mode='Markdown'
             )
             
-            context.user_data['current_state'] = BotStates.GROUP_NAME_INPUT.value
             return BotStates.GROUP_NAME_INPUT.value
-            
+        
         elif source == 'psychologist':
             # Ask for psychologist name
             message = """
@@ -953,7 +1178,6 @@ https://ozon.ru/t/LtWbt2m
                 parse_mode='Markdown'
             )
             
-            context.user_data['current_state'] = BotStates.PSYCHOLOGIST_NAME_INPUT.value
             return BotStates.PSYCHOLOGIST_NAME_INPUT.value
         else:
             # Skip to anonymous question
@@ -1011,7 +1235,6 @@ https://ozon.ru/t/LtWbt2m
             parse_mode='Markdown'
         )
         
-        context.user_data['current_state'] = BotStates.ANONYMOUS_QUESTION_CHOICE.value
         return BotStates.ANONYMOUS_QUESTION_CHOICE.value
     
     async def show_anonymous_question_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
@@ -1028,7 +1251,6 @@ https://ozon.ru/t/LtWbt2m
             parse_mode='Markdown'
         )
         
-        context.user_data['current_state'] = BotStates.ANONYMOUS_QUESTION_CHOICE.value
         return BotStates.ANONYMOUS_QUESTION_CHOICE.value
     
     async def handle_anonymous_question_choice(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
@@ -1050,7 +1272,6 @@ https://ozon.ru/t/LtWbt2m
                 parse_mode='Markdown'
             )
             
-            context.user_data['current_state'] = BotStates.ANONYMOUS_QUESTION_INPUT.value
             return BotStates.ANONYMOUS_QUESTION_INPUT.value
         else:
             # Skip to final message
@@ -1061,6 +1282,8 @@ https://ozon.ru/t/LtWbt2m
         """Handle anonymous question text input."""
         question = sanitize_input(update.message.text)
         context.user_data['anonymous_question'] = question
+        if self.questions is not None:
+            self.questions.submit(question)
         
         logger.info(f"User {format_user_info(update.effective_user)} asked: {question[:50]}...")
         
@@ -1070,6 +1293,11 @@ https://ozon.ru/t/LtWbt2m
 Ваш вопрос принят. Скоро ответ на ваш вопрос появится в разделе "Ответы на популярные вопросы".
         """
         
+        # Похожие вопросы, на которые ответ уже есть
+        matches = [entry for entry, _ in self.faq.search(question)]
+        if matches:
+            message = f"{message.rstrip()}\n\nВозможно, ответ уже есть:\n\n{render_faq(matches, markdown=True)}"
+        
         await update.message.reply_text(message, parse_mode='Markdown')
         
         # Show final message
@@ -1119,21 +1347,7 @@ https://ozon.ru/t/LtWbt2m
         query = update.callback_query
         await query.answer()
         
-        message = """
-❓ **Ответы на популярные вопросы**
-
-**Q: Вредно ли опохмеляться?**
-A: Да, опохмеление лишь усугубляет пагубное воздействие на организм
-
-**Q: Алкоголь является фактором риска развития онкологических заболеваний?**
-A: Да, этанол, содержащийся в любом спиртном напитке, повышает вероятность возникновения онкологических заболеваний.
-
-**Q: Могу ли я сам, своей силой воли, избавиться от зависимости?**
-A: Если стадия лёгкая, попробовать можно, но при более тяжёлой степени зависимости без посторонние помощи и поддержки вы не справитесь
-
-**Q: Без чего (кого) не справиться с зависимостью?**
-A: Полноценно справиться с зависимостью поможет правильный подход, основанный на программе 12 шагов, поддержка со стороны и если требуется, обращение за медикаментозным лечением в клинике
-        """
+        message = f"❓ **Ответы на популярные вопросы**\n\n{render_faq(self.faq.entries, markdown=True)}"
         
         keyboard = InlineKeyboardMarkup([
             [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_final")]
@@ -1200,7 +1414,6 @@ A: Полноценно справиться с зависимостью пом
             reply_markup=self.conversation_flow.get_dependency_keyboard()
         )
         
-        context.user_data['current_state'] = BotStates.DEPENDENCY_SELECTION.value
         logger.info(f"User {format_user_info(query.from_user)} restarted conversation")
         
         return BotStates.DEPENDENCY_SELECTION.value
@@ -1229,7 +1442,6 @@ A: Полноценно справиться с зависимостью пом
             reply_markup=self.conversation_flow.get_dependency_keyboard()
         )
         
-        context.user_data['current_state'] = BotStates.DEPENDENCY_SELECTION.value
         logger.info(f"User {format_user_info(query.from_user)} cancelled help request")
         
         return BotStates.DEPENDENCY_SELECTION.value
@@ -1448,6 +1660,71 @@ A: Полноценно справиться с зависимостью пом
         
         await update.message.reply_text(help_text, parse_mode='Markdown')
     
+    async def stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Handle /stats [dependency] [timezone]: funnel report for admins."""
+        user = update.effective_user
+        user_id = user.get('id') if isinstance(user, dict) else getattr(user, 'id', None)
+        if user_id not in self.admin_ids:
+            await update.message.reply_text("Команда доступна только администраторам.")
+            return
+        if self.analytics is None:
+            await update.message.reply_text("Аналитика не включена (ANALYTICS_DIR).")
+            return
+        
+        args = update.message.text.split()[1:]
+        dependency = args[0] if len(args) > 0 and args[0] != '*' else None
+        timezone = args[1] if len(args) > 1 and args[1] != '*' else None
+        
+        title = f"📊 Воронка: зависимость {dependency or 'все'}, часовой пояс {timezone or 'все'}"
+        steps = self.analytics.aggregator.steps(dependency, timezone)
+        await update.message.reply_text(format_funnel(steps, title))
+    
+    async def traces_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Handle /traces [user_id]: latest update traces for admins."""
+        user = update.effective_user
+        user_id = user.get('id') if isinstance(user, dict) else getattr(user, 'id', None)
+        if user_id not in self.admin_ids:
+            await update.message.reply_text("Команда доступна только администраторам.")
+            return
+        if self.tracer.buffer is None:
+            await update.message.reply_text("Буфер трассировок не включен (TRACE_BUFFER_SPANS).")
+            return
+        
+        args = update.message.text.split()[1:]
+        target = int(args[0]) if args and args[0].lstrip('-').isdigit() else None
+        traces = self.tracer.buffer.recent_traces(limit=5, user_id=target)
+        if not traces:
+            await update.message.reply_text("Трассировок пока нет.")
+            return
+        
+        title = f"🔎 Последние трассировки{f' пользователя {target}' if target is not None else ''}:\n\n"
+        await update.message.reply_text((title + format_traces(traces))[:3500])
+    
+    async def flight_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Handle /flight <user_id>: last recorded events of a user for admins."""
+        user = update.effective_user
+        user_id = user.get('id') if isinstance(user, dict) else getattr(user, 'id', None)
+        if user_id not in self.admin_ids:
+            await update.message.reply_text("Команда доступна только администраторам.")
+            return
+        if self.flight_recorder is None:
+            await update.message.reply_text("Журнал событий не включен (FLIGHT_RECORDER_RECORDS).")
+            return
+        
+        args = update.message.text.split()[1:]
+        if not args or not args[0].lstrip('-').isdigit():
+            await update.message.reply_text("Использование: /flight <id пользователя>")
+            return
+        target = int(args[0])
+        records = self.flight_recorder.dump(target)
+        if not records:
+            await update.message.reply_text(f"Событий пользователя {target} нет.")
+            return
+        
+        # Сообщение ограничено по длине - при обрезке остаются последние записи
+        body = format_flight(records)[-3500:]
+        await update.message.reply_text(f"🛩 События пользователя {target} ({len(records)}):\n\n{body}")
+    
     async def cancel(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Handle conversation cancellation."""
         user = update.effective_user
@@ -1463,7 +1740,7 @@ A: Полноценно справиться с зависимостью пом
         return -1
     
     async def back_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
-        """Handle /back command."""
+        """Handle /back command: run the "back" button of the current state."""
         if 'current_state' not in context.user_data:
             await update.message.reply_text(
                 "Нет предыдущего шага. Начните диалог с команды /start"
@@ -1471,111 +1748,38 @@ A: Полноценно справиться с зависимостью пом
             return -1
         
         current_state = context.user_data.get('current_state')
+        transition_id = self.state_machine.resolve_back(current_state)
         
-        # Map states to back handlers
-        back_map = {
-            BotStates.TIME_ZONE_SELECTION.value: self.back_to_dependency,
-            BotStates.CITY_SELECTION.value: self.back_to_timezones,
-            BotStates.HELP_TYPE.value: self.back_to_city,
-            BotStates.SUPPORT_OR_SPECIALIST.value: self.back_to_help,
-            BotStates.GENDER_PREFERENCE.value: self.back_to_sos,
-            BotStates.AGE_USER.value: self.back_to_gender,
-            BotStates.AGE_SPECIALIST_PREFERENCE.value: self.back_to_age_user,
-        }
-        
-        handler = back_map.get(current_state)
-        if handler:
-            # Create a fake query object for back handlers
-            await update.message.reply_text("Возвращаюсь назад...")
-            return current_state
-        else:
+        if transition_id < 0:
             await update.message.reply_text(
                 "Используйте кнопки для навигации."
             )
             return current_state
+        
+        # Обработчики кнопок "Назад" редактируют сообщение - на команду отвечаем новым
+        transition = self.state_machine.transitions[transition_id]
+        return await self._run_transition(transition_id, _CommandUpdate(update, transition.pattern), context)
     
     # ==================== STATE MAPPING ====================
     
     def get_conversation_states(self) -> Dict[str, list]:
-        """Get conversation states mapping for ConversationHandler."""
-        return {
-            BotStates.DEPENDENCY_SELECTION.value: [
-                CallbackQueryHandler(self.handle_dependency_selection, pattern='^dep_')
-            ],
-            BotStates.TIME_ZONE_SELECTION.value: [
-                CallbackQueryHandler(self.back_to_dependency, pattern='^back_to_dependency'),
-                CallbackQueryHandler(self.handle_timezone_selection, pattern='^timezone_')
-            ],
-            BotStates.CITY_SELECTION.value: [
-                CallbackQueryHandler(self.back_to_timezones, pattern='^back_to_timezones'),
-                CallbackQueryHandler(self.handle_city_selection, pattern='^city_')
-            ],
-            BotStates.HELP_TYPE.value: [
-                CallbackQueryHandler(self.back_to_city, pattern='^back_to_city'),
-                CallbackQueryHandler(self.back_to_help, pattern='^back_to_help'),
-                CallbackQueryHandler(self.handle_help_type, pattern='^help_')
-            ],
-            BotStates.HELP_CHOICE.value: [
-                CallbackQueryHandler(self.handle_choose_support, pattern='^choose_support'),
-                CallbackQueryHandler(self.handle_choose_literature, pattern='^choose_literature'),
-                CallbackQueryHandler(self.handle_skip_both, pattern='^skip_both'),
-                CallbackQueryHandler(self.handle_support_choice_after_info, pattern='^yes_support'),
-                CallbackQueryHandler(self.handle_support_choice_after_info, pattern='^no_support'),
-                CallbackQueryHandler(self.back_to_help, pattern='^back_to_help'),
-                CallbackQueryHandler(self.back_to_help, pattern='^back_from_support')
-            ],
-            BotStates.LITERATURE_CHOICE.value: [
-                CallbackQueryHandler(self.handle_continue_after_literature, pattern='^continue_after_literature'),
-                CallbackQueryHandler(self.handle_literature_selection, pattern='^lit_'),
-                CallbackQueryHandler(self.handle_literature_choice_after_info, pattern='^yes_literature_after_info'),
-                CallbackQueryHandler(self.handle_literature_choice_after_info, pattern='^no_literature_after_info'),
-                CallbackQueryHandler(self.handle_literature_choice, pattern='^yes_literature'),
-                CallbackQueryHandler(self.handle_literature_choice, pattern='^no_literature'),
-                CallbackQueryHandler(self.back_to_help, pattern='^back_to_help'),
-                CallbackQueryHandler(self.back_to_help, pattern='^back_from_literature')
-            ],
-            BotStates.SUPPORT_OR_SPECIALIST.value: [
-                CallbackQueryHandler(self.back_to_help, pattern='^back_to_help'),
-                CallbackQueryHandler(self.handle_support_or_specialist, pattern='^sos_')
-            ],
-            BotStates.GENDER_PREFERENCE.value: [
-                CallbackQueryHandler(self.back_from_gender, pattern='^back_from_gender'),
-                CallbackQueryHandler(self.handle_gender_selection, pattern='^gender_')
-            ],
-            BotStates.AGE_USER.value: [
-                CallbackQueryHandler(self.back_to_gender, pattern='^back_to_gender'),
-                CallbackQueryHandler(self.handle_age_user, pattern='^ageu_')
-            ],
-            BotStates.AGE_SPECIALIST_PREFERENCE.value: [
-                CallbackQueryHandler(self.back_to_age_user, pattern='^back_to_age_user'),
-                CallbackQueryHandler(self.handle_age_specialist, pattern='^ages_'),
-                CallbackQueryHandler(self.handle_continue_to_discovery, pattern='^continue_to_discovery'),
-                CallbackQueryHandler(self.handle_cancel_help, pattern='^cancel_help')
-            ],
-            BotStates.ONLINE_OFFLINE_GROUPS.value: [
-                CallbackQueryHandler(self.handle_continue_to_discovery, pattern='^continue_to_discovery')
-            ],
-            BotStates.HOW_FOUND_US.value: [
-                CallbackQueryHandler(self.handle_discovery_answer, pattern='^found_')
-            ],
-            BotStates.GROUP_NAME_INPUT.value: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_group_name_input)
-            ],
-            BotStates.PSYCHOLOGIST_NAME_INPUT.value: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_psychologist_name_input)
-            ],
-            BotStates.ANONYMOUS_QUESTION_CHOICE.value: [
-                CallbackQueryHandler(self.handle_anonymous_question_choice, pattern='^yes_anon_question'),
-                CallbackQueryHandler(self.handle_anonymous_question_choice, pattern='^no_anon_question')
-            ],
-            BotStates.ANONYMOUS_QUESTION_INPUT.value: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_anonymous_question_input)
-            ],
-            BotStates.CONVERSATION_END.value: [
-                CallbackQueryHandler(self.handle_final_faq, pattern='^final_faq'),
-                CallbackQueryHandler(self.handle_final_webinars, pattern='^final_webinars'),
-                CallbackQueryHandler(self.handle_back_to_final, pattern='^back_to_final'),
-                CallbackQueryHandler(self.handle_restart_conversation, pattern='^restart_conversation'),
-                CallbackQueryHandler(self.handle_cancel_help, pattern='^cancel_help')
-            ]
-        }
+        """Get conversation states mapping for ConversationHandler, built from the state machine."""
+        states = {}
+        for state in BotStates:
+            transitions = self.state_machine.state_transitions(state)
+            if not transitions:
+                continue
+            
+            handlers = []
+            # ConversationHandler берет первый подходящий - длинные шаблоны проверяются раньше
+            for transition in sorted(transitions, key=lambda item: -len(item.pattern or '')):
+                callback = self._transition_callback(self.state_machine.transition_id(transition))
+                if transition.pattern is TEXT:
+                    handlers.append(MessageHandler(filters.TEXT & ~filters.COMMAND, callback))
+                else:
+                    boundary = '' if transition.pattern.endswith('_') else '(?:_|$)'
+                    handlers.append(CallbackQueryHandler(
+                        callback, pattern=f'^{re.escape(transition.pattern)}{boundary}'
+                    ))
+            states[state.value] = handlers
+        return states
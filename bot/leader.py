@@ -0,0 +1,564 @@
+"""
+Leader election for multi-replica deployments.
+Only the leader replica polls MAX; updates reach replicas through a partitioned work queue.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import signal
+import socket
+import time
+import uuid
+from dataclasses import asdict
+from typing import Dict, Any, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from .max_adapter import MaxUpdate
+from .sharding import shard_for, update_user_id
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PARTITIONS = 16
+
+
+def _lock_file(f) -> None:
+    """Take a non-blocking exclusive lock, raise OSError if it is held by someone else."""
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+
+
+def _unlock_file(f) -> None:
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class FileLease:
+    """
+    Exclusive lease backed by an OS file lock.
+    
+    Работает для реплик на одном хосте (или на общем томе с поддержкой
+    блокировок). ОС снимает блокировку при завершении процесса, поэтому
+    переключение на резервную реплику происходит сразу.
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+    
+    @property
+    def held(self) -> bool:
+        return self._file is not None
+    
+    async def acquire(self) -> bool:
+        """Try to take the lease without waiting."""
+        if self._file is not None:
+            return True
+        f = open(self.path, 'a+b')
+        try:
+            _lock_file(f)
+        except OSError:
+            f.close()
+            return False
+        self._file = f
+        return True
+    
+    async def renew(self) -> bool:
+        """Check that the lease is still held."""
+        return self._file is not None
+    
+    async def release(self) -> None:
+        """Give the lease up."""
+        if self._file is not None:
+            try:
+                _unlock_file(self._file)
+            finally:
+                self._file.close()
+                self._file = None
+
+
+class RedisError(Exception):
+    """Error reply from Redis."""
+    pass
+
+
+class RedisClient:
+    """Minimal Redis client (RESP2) for the few commands coordination needs."""
+    
+    def __init__(self, url: str):
+        parts = urlsplit(url)
+        self.host = parts.hostname or 'localhost'
+        self.port = parts.port or 6379
+        self.password = parts.password
+        self.db = int(parts.path.lstrip('/') or 0)
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._lock = asyncio.Lock()
+    
+    async def execute(self, *args) -> Any:
+        """Run a command and return its decoded reply."""
+        async with self._lock:
+            try:
+                if self._writer is None:
+                    self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+                    if self.password:
+                        await self._command('AUTH', self.password)
+                    if self.db:
+                        await self._command('SELECT', self.db)
+                return await self._command(*args)
+            except RedisError:
+                raise
+            except BaseException:
+                # После обрыва посреди ответа поток рассинхронизирован - переподключаемся
+                self._disconnect()
+                raise
+    
+    async def _command(self, *args) -> Any:
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(data), data))
+        self._writer.write(b''.join(parts))
+        await self._writer.drain()
+        return await self._read_reply()
+    
+    async def _read_reply(self) -> Any:
+        line = await self._reader.readuntil(b'\r\n')
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest.decode('utf-8')
+        if kind == b'-':
+            raise RedisError(rest.decode('utf-8'))
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            length = int(rest)
+            if length < 0:
+                return None
+            return (await self._reader.readexactly(length + 2))[:-2]
+        if kind == b'*':
+            length = int(rest)
+            if length < 0:
+                return None
+            return [await self._read_reply() for _ in range(length)]
+        raise RedisError(f"Unexpected reply: {line!r}")
+    
+    def _disconnect(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+    
+    async def close(self) -> None:
+        """Close the connection."""
+        async with self._lock:
+            self._disconnect()
+
+
+# Продление и освобождение только своей аренды (значение ключа - идентификатор владельца)
+_RENEW_SCRIPT = ("if redis.call('get', KEYS[1]) == ARGV[1] then "
+                 "return redis.call('pexpire', KEYS[1], ARGV[2]) else return 0 end")
+_RELEASE_SCRIPT = ("if redis.call('get', KEYS[1]) == ARGV[1] then "
+                   "return redis.call('del', KEYS[1]) else return 0 end")
+
+
+class RedisLease:
+    """
+    Exclusive lease stored as a Redis key with a TTL.
+    
+    Владелец продлевает ключ чаще, чем истекает TTL. Если реплика умерла
+    или потеряла связь с Redis, ключ истекает и аренду забирает другая
+    реплика - время переключения не больше ttl_ms.
+    """
+    
+    def __init__(self, client: RedisClient, key: str, owner: str, ttl_ms: int = 5000):
+        self.client = client
+        self.key = key
+        self.owner = owner
+        self.ttl_ms = ttl_ms
+        self.held = False
+    
+    async def acquire(self) -> bool:
+        """Try to take the lease without waiting."""
+        if self.held:
+            return await self.renew()
+        try:
+            self.held = await self.client.execute('SET', self.key, self.owner, 'NX', 'PX', self.ttl_ms) == 'OK'
+        except (OSError, RedisError, asyncio.IncompleteReadError) as e:
+            logger.warning(f"Failed to acquire lease {self.key}: {e}")
+            self.held = False
+        return self.held
+    
+    async def renew(self) -> bool:
+        """Extend the lease. Returns False if it was lost."""
+        if not self.held:
+            return False
+        try:
+            self.held = await self.client.execute('EVAL', _RENEW_SCRIPT, 1, self.key, self.owner, self.ttl_ms) == 1
+        except (OSError, RedisError, asyncio.IncompleteReadError) as e:
+            logger.warning(f"Failed to renew lease {self.key}: {e}")
+            self.held = False
+        return self.held
+    
+    async def release(self) -> None:
+        """Give the lease up so a standby can take it immediately."""
+        if not self.held:
+            return
+        self.held = False
+        try:
+            await self.client.execute('EVAL', _RELEASE_SCRIPT, 1, self.key, self.owner)
+        except (OSError, RedisError, asyncio.IncompleteReadError) as e:
+            logger.warning(f"Failed to release lease {self.key}: {e}")
+
+
+class FileCoordinationBackend:
+    """Leases and work queue in a local directory (replicas on one host)."""
+    
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+    
+    def lease(self, name: str) -> FileLease:
+        return FileLease(os.path.join(self.directory, f'{name}.lock'))
+    
+    def _partition_dir(self, partition: int) -> str:
+        path = os.path.join(self.directory, f'queue-{partition:03d}')
+        os.makedirs(path, exist_ok=True)
+        return path
+    
+    def _write_atomic(self, path: str, data: str) -> None:
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    
+    async def push(self, partition: int, updates: List[Dict[str, Any]]) -> None:
+        """Append a batch of updates to a partition queue."""
+        path = os.path.join(self._partition_dir(partition), f'{time.time_ns():020d}.json')
+        await asyncio.to_thread(self._write_atomic, path, json.dumps(updates, ensure_ascii=False))
+    
+    def _peek(self, partition: int) -> Optional[Tuple[str, List[Dict[str, Any]]]]:
+        directory = self._partition_dir(partition)
+        names = sorted(name for name in os.listdir(directory) if name.endswith('.json'))
+        if not names:
+            return None
+        path = os.path.join(directory, names[0])
+        with open(path, encoding='utf-8') as f:
+            return path, json.load(f)
+    
+    async def peek(self, partition: int) -> Optional[Tuple[str, List[Dict[str, Any]]]]:
+        """Return the oldest batch of a partition without removing it."""
+        return await asyncio.to_thread(self._peek, partition)
+    
+    async def ack(self, partition: int, token: str) -> None:
+        """Remove a processed batch."""
+        try:
+            os.remove(token)
+        except FileNotFoundError:
+            pass
+    
+    async def get_position(self) -> Tuple[Optional[Any], int]:
+        """Return (marker, last_update_id) saved by the last leader."""
+        try:
+            with open(os.path.join(self.directory, 'position.json'), encoding='utf-8') as f:
+                position = json.load(f)
+            return position.get('marker'), position.get('last_update_id') or 0
+        except (OSError, ValueError):
+            return None, 0
+    
+    async def set_position(self, marker: Optional[Any], last_update_id: int) -> None:
+        """Save polling position for the next leader."""
+        await asyncio.to_thread(self._write_atomic, os.path.join(self.directory, 'position.json'),
+                                json.dumps({'marker': marker, 'last_update_id': last_update_id}))
+    
+    async def close(self) -> None:
+        pass
+
+
+class RedisCoordinationBackend:
+    """Leases and work queue in Redis (replicas on different hosts)."""
+    
+    def __init__(self, url: str, prefix: str = 'maxbot', lease_ttl_ms: int = 5000):
+        self.client = RedisClient(url)
+        self.prefix = prefix
+        self.lease_ttl_ms = lease_ttl_ms
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    
+    def lease(self, name: str) -> RedisLease:
+        return RedisLease(self.client, f'{self.prefix}:lease:{name}', self.owner, self.lease_ttl_ms)
+    
+    def _queue_key(self, partition: int) -> str:
+        return f'{self.prefix}:queue:{partition}'
+    
+    async def push(self, partition: int, updates: List[Dict[str, Any]]) -> None:
+        """Append a batch of updates to a partition queue."""
+        await self.client.execute('RPUSH', self._queue_key(partition), json.dumps(updates, ensure_ascii=False))
+    
+    async def peek(self, partition: int) -> Optional[Tuple[None, List[Dict[str, Any]]]]:
+        """Return the oldest batch of a partition without removing it."""
+        data = await self.client.execute('LINDEX', self._queue_key(partition), 0)
+        if data is None:
+            return None
+        return None, json.loads(data)
+    
+    async def ack(self, partition: int, token: None) -> None:
+        """Remove a processed batch (the partition has a single consumer - its lease holder)."""
+        await self.client.execute('LPOP', self._queue_key(partition))
+    
+    async def get_position(self) -> Tuple[Optional[Any], int]:
+        """Return (marker, last_update_id) saved by the last leader."""
+        data = await self.client.execute('GET', f'{self.prefix}:position')
+        if data is None:
+            return None, 0
+        position = json.loads(data)
+        return position.get('marker'), position.get('last_update_id') or 0
+    
+    async def set_position(self, marker: Optional[Any], last_update_id: int) -> None:
+        """Save polling position for the next leader."""
+        await self.client.execute('SET', f'{self.prefix}:position',
+                                  json.dumps({'marker': marker, 'last_update_id': last_update_id}))
+    
+    async def close(self) -> None:
+        await self.client.close()
+
+
+def create_coordination_backend(url: str, lease_ttl_ms: int = 5000):
+    """Create backend from URL: file:///path/to/dir or redis://[:password@]host:port/db."""
+    if url.startswith('file://'):
+        return FileCoordinationBackend(url[len('file://'):])
+    if url.startswith('redis://'):
+        return RedisCoordinationBackend(url, lease_ttl_ms=lease_ttl_ms)
+    raise ValueError(f"Unsupported coordination URL: {url}")
+
+
+class ReplicaCoordinator:
+    """
+    Runs a MaxBotApplication as one of several replicas.
+    
+    Реплики соревнуются за аренду лидера: только лидер опрашивает /updates
+    и раскладывает их в очередь по партициям (хеш user_id). Партиции тоже
+    арендуются - каждую обрабатывает одна реплика, поэтому updates одного
+    пользователя обрабатываются по порядку и без дублей. Реплика без
+    аренд - горячий резерв: при падении владельца она забирает его аренды.
+    
+    Сессии пользователей переходят вместе с партицией только через общее
+    хранилище сессий (DATABASE_URL).
+    """
+    
+    def __init__(self, app, backend, partitions: int = DEFAULT_PARTITIONS,
+                 max_partitions: int = 0,
+                 renew_interval: float = 1.0,
+                 queue_poll_interval: float = 0.2):
+        """
+        Args:
+            app: MaxBotApplication processing updates
+            backend: FileCoordinationBackend or RedisCoordinationBackend
+            partitions: Number of work queue partitions (same on all replicas)
+            max_partitions: Maximum partitions one replica owns (0 - no limit)
+            renew_interval: How often leases are renewed and free ones acquired (seconds)
+            queue_poll_interval: Delay between checks of empty queues (seconds)
+        """
+        self.app = app
+        self.backend = backend
+        self.partitions = partitions
+        self.max_partitions = max_partitions or partitions
+        self.renew_interval = renew_interval
+        self.queue_poll_interval = queue_poll_interval
+        
+        self.leader_lease = backend.lease('leader')
+        self.partition_leases = [backend.lease(f'partition-{index}') for index in range(partitions)]
+        self.owned_partitions: set = set()
+        
+        self._stopping = asyncio.Event()
+        self._poll_task: Optional[asyncio.Task] = None
+    
+    @property
+    def is_leader(self) -> bool:
+        return self.leader_lease.held
+    
+    async def _become_leader(self):
+        """Continue polling from the position saved by the previous leader."""
+        marker, last_update_id = await self.backend.get_position()
+        self.app.bot.last_marker = marker
+        self.app.bot.last_update_id = last_update_id
+        logger.info(f"This replica is now the leader (marker={marker})")
+    
+    async def _restore_partitions(self, partitions: List[int]):
+        """Load sessions of newly acquired partitions from the shared store in one pass."""
+        if self.app.session_writer is None or not partitions:
+            return
+        wanted = set(partitions)
+        # Чтение хранилища идет в потоке: опрос и обработка updates не останавливаются
+        sessions = await asyncio.to_thread(
+            self.app.session_writer.load, lambda user_id: shard_for(user_id, self.partitions) in wanted)
+        self.app.restore_sessions(sessions)
+    
+    async def _maintain_leases(self):
+        """Renew held leases and pick up free ones."""
+        while not self._stopping.is_set():
+            try:
+                if self.leader_lease.held:
+                    if not await self.leader_lease.renew():
+                        logger.error("Leadership lost, stopping polling")
+                        if self._poll_task is not None:
+                            self._poll_task.cancel()
+                elif await self.leader_lease.acquire():
+                    await self._become_leader()
+                
+                acquired = []
+                for index, lease in enumerate(self.partition_leases):
+                    if lease.held:
+                        if not await lease.renew():
+                            logger.error(f"Lost partition {index}")
+                            self.owned_partitions.discard(index)
+                    elif len(self.owned_partitions) + len(acquired) < self.max_partitions and await lease.acquire():
+                        acquired.append(index)
+                
+                # Сессии всех захваченных партиций загружаются одним чтением, затем партиции обслуживаются
+                try:
+                    await self._restore_partitions(acquired)
+                except Exception:
+                    # Без сессий партицию не обслуживаем - пусть ее возьмет другая реплика или следующий проход
+                    for index in acquired:
+                        await self.partition_leases[index].release()
+                    raise
+                for index in acquired:
+                    self.owned_partitions.add(index)
+                    logger.info(f"Acquired partition {index}")
+            
+            except Exception as e:
+                logger.error(f"Error maintaining leases: {e}", exc_info=True)
+            
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=self.renew_interval)
+            except asyncio.TimeoutError:
+                pass
+    
+    async def _poll(self):
+        """Poll MAX while leader and enqueue updates by partition."""
+        while not self._stopping.is_set():
+            if not self.is_leader:
+                await asyncio.sleep(self.renew_interval)
+                continue
+            
+            self._poll_task = asyncio.ensure_future(self.app.bot.get_updates(timeout=30))
+            try:
+                updates = await self._poll_task
+            except asyncio.CancelledError:
+                if self._stopping.is_set() or not self.is_leader:
+                    continue
+                raise
+            except Exception as e:
+                logger.error(f"Error in polling loop: {e}", exc_info=True)
+                await asyncio.sleep(5)
+                continue
+            finally:
+                self._poll_task = None
+            
+            try:
+                if updates:
+                    logger.info(f"Received {len(updates)} updates")
+                    batches: Dict[int, List[Dict[str, Any]]] = {}
+                    for max_update in updates:
+                        partition = shard_for(update_user_id(max_update), self.partitions)
+                        batches.setdefault(partition, []).append(asdict(max_update))
+                    for partition, batch in batches.items():
+                        await self.backend.push(partition, batch)
+                
+                # Позиция сохраняется после постановки в очередь: новый лидер не потеряет updates
+                await self.backend.set_position(self.app.bot.last_marker, self.app.bot.last_update_id)
+            
+            except Exception as e:
+                logger.error(f"Error enqueueing updates: {e}", exc_info=True)
+                await asyncio.sleep(5)
+    
+    async def _consume(self):
+        """Process queued updates of owned partitions."""
+        while not self._stopping.is_set():
+            idle = True
+            try:
+                for partition in sorted(self.owned_partitions):
+                    item = await self.backend.peek(partition)
+                    if item is None:
+                        continue
+                    idle = False
+                    token, batch = item
+                    for max_update in self.app.coalesce_updates([MaxUpdate(**data) for data in batch]):
+                        await self.app.process_update(max_update)
+                    # Удаляем пакет, только если партиция все еще наша
+                    if await self.partition_leases[partition].renew():
+                        await self.backend.ack(partition, token)
+            
+            except Exception as e:
+                logger.error(f"Error consuming updates: {e}", exc_info=True)
+            
+            if idle:
+                await asyncio.sleep(self.queue_poll_interval)
+    
+    def request_stop(self):
+        """Stop polling and consuming, then release leases."""
+        if self._stopping.is_set():
+            return
+        logger.info("Shutdown requested, releasing leadership")
+        self._stopping.set()
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+    
+    async def run(self):
+        """Run the replica until stopped."""
+        logger.info("Starting MAX bot replica...")
+        
+        bot_info = await self.app.bot.get_me()
+        if bot_info:
+            logger.info(f"Bot started: @{bot_info.get('username', 'unknown')}")
+        else:
+            logger.error("Failed to get bot info")
+            await self.app.shutdown()
+            return
+        
+        await self.app.start_services()
+        
+        loop = asyncio.get_running_loop()
+        installed_signals = []
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, self.request_stop)
+                installed_signals.append(sig)
+            except (NotImplementedError, RuntimeError):
+                pass
+        
+        lease_task = asyncio.create_task(self._maintain_leases())
+        poll_task = asyncio.create_task(self._poll())
+        consume_task = asyncio.create_task(self._consume())
+        
+        try:
+            await self._stopping.wait()
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            self.request_stop()
+        finally:
+            for sig in installed_signals:
+                loop.remove_signal_handler(sig)
+            
+            # Текущему пакету даем время завершиться
+            await asyncio.wait({consume_task}, timeout=self.app.shutdown_timeout)
+            for task in (lease_task, poll_task, consume_task):
+                task.cancel()
+            await asyncio.gather(lease_task, poll_task, consume_task, return_exceptions=True)
+            
+            for lease in [self.leader_lease] + self.partition_leases:
+                await lease.release()
+            
+            await self.app.shutdown()
+            await self.backend.close()
@@ -5,12 +5,62 @@ MAX Messenger API Adapter
 
 import logging
 import asyncio
+import hashlib
+import json
+import time
 import aiohttp
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from typing import Dict, Any, Optional, List
 from dataclasses import dataclass
 
+from .flight_recorder import EDIT, SEND, FlightRecorder
+from .tracing import SPAN_KIND_CLIENT, Tracer
+
 logger = logging.getLogger(__name__)
 
+# Максимальная длина текста одного сообщения MAX
+MAX_MESSAGE_LENGTH = 4000
+
+# Окно (в секундах), в котором повторная отправка идентичного сообщения пропускается
+DUPLICATE_SEND_WINDOW = 3.0
+
+# Версия клавиатуры в payload кнопки: "<версия base36>~<callback_data>"
+CALLBACK_VERSION_SEPARATOR = '~'
+CALLBACK_VERSION_MODULUS = 36 ** 2  # не более двух символов версии
+MAX_CALLBACK_PAYLOAD_LENGTH = 1024
+
+_BASE36_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+# Буфер ответов текущего обрабатываемого update (см. MaxBot.reply_buffer)
+_current_reply_buffer: ContextVar[Optional['ReplyBuffer']] = ContextVar('max_reply_buffer', default=None)
+
+
+def encode_callback_payload(data: str, version: int) -> str:
+    """
+    Add a keyboard version prefix to callback data.
+    
+    Если payload с префиксом не помещается в лимит MAX, данные
+    возвращаются без версии.
+    """
+    high, low = divmod(version % CALLBACK_VERSION_MODULUS, 36)
+    prefix = (_BASE36_DIGITS[high] if high else '') + _BASE36_DIGITS[low]
+    payload = f"{prefix}{CALLBACK_VERSION_SEPARATOR}{data}"
+    return payload if len(payload) <= MAX_CALLBACK_PAYLOAD_LENGTH else data
+
+
+def decode_callback_payload(payload: str):
+    """
+    Split callback payload into (callback_data, version).
+    
+    Для payload без версии (старые клавиатуры) version равен None.
+    """
+    prefix, separator, data = payload.partition(CALLBACK_VERSION_SEPARATOR)
+    if not separator or not 0 < len(prefix) <= 2 or not all(c in _BASE36_DIGITS for c in prefix):
+        return payload, None
+    return data, int(prefix, 36)
+
 
 @dataclass
 class MaxUpdate:
@@ -77,7 +127,8 @@ class MaxUpdate:
 class MaxBot:
     """MAX Bot API client."""
     
-    def __init__(self, token: str, base_url: str = "https://platform-api.max.ru", verify_ssl: bool = True):
+    def __init__(self, token: str, base_url: str = "https://platform-api.max.ru", verify_ssl: bool = True,
+                 duplicate_window: float = DUPLICATE_SEND_WINDOW):
         """
         Initialize MAX Bot.
         
@@ -85,6 +136,8 @@ class MaxBot:
             token: Bot API token
             base_url: Base URL for MAX Bot API (default: https://platform-api.max.ru)
             verify_ssl: Whether to verify SSL certificates
+            duplicate_window: Seconds during which an identical message to the same
+                chat is not sent again (0 disables the check)
         """
         self.token = token
         self.base_url = base_url.rstrip('/')
@@ -94,6 +147,23 @@ class MaxBot:
         self.last_marker = None  # MAX использует marker вместо offset
         self.verify_ssl = verify_ssl
         
+        # Последнее отправленное содержимое по чатам: chat_id -> (digest, time)
+        self.duplicate_window = duplicate_window
+        self._last_sent: 'OrderedDict[int, tuple]' = OrderedDict()
+        self.suppressed_duplicates = 0
+        
+        # Версия последней отправленной клавиатуры по чатам: chat_id -> version
+        self.keyboard_versions: Dict[int, int] = {}
+        
+        # Запись получаемых updates для воспроизведения (bot.capture.CaptureWriter)
+        self.capture = None
+        
+        # Трассировка запросов к API (bot.tracing); по умолчанию выключена
+        self.tracer = Tracer()
+        
+        # Результаты отправки для /flight (bot.flight_recorder.FlightRecorder)
+        self.flight_recorder: Optional[FlightRecorder] = None
+        
         # Заголовки для авторизации
         self.headers = {
             'Authorization': token,
@@ -124,7 +194,112 @@ class MaxBot:
             max_buttons.append(max_row)
         
         return max_buttons
+    
+    def _build_message_body(self, text: str,
+                            reply_markup: Optional[Dict[str, Any]] = None,
+                            parse_mode: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Формирует тело сообщения (NewMessageBody) согласно MAX API.
+        
+        Используется и для отправки, и для редактирования сообщений.
+        """
+        message_body = {
+            'text': text
+        }
+        
+        # MAX использует 'format' вместо 'parse_mode'
+        if parse_mode:
+            message_body['format'] = parse_mode.lower()
+        
+        # Добавляем inline keyboard как attachment
+        if reply_markup and reply_markup.get('inline_keyboard'):
+            # Конвертируем Telegram формат кнопок в MAX формат
+            max_buttons = self._convert_telegram_buttons_to_max(reply_markup['inline_keyboard'])
+            
+            message_body['attachments'] = [{
+                'type': 'inline_keyboard',
+                'payload': {
+                    'buttons': max_buttons
+                }
+            }]
+        
+        return message_body
+    
+    def _stamp_keyboard(self, chat_id: int, message_body: Dict[str, Any]) -> Optional[int]:
+        """
+        Add the next keyboard version of the chat to all callback payloads.
+        
+        Returns:
+            New version (записывается через _commit_keyboard_version после
+            успешной отправки) или None, если клавиатуры нет
+        """
+        keyboards = [a for a in message_body.get('attachments', []) if a.get('type') == 'inline_keyboard']
+        if not keyboards:
+            return None
+        
+        version = (self.keyboard_versions.get(chat_id, 0) + 1) % CALLBACK_VERSION_MODULUS
+        for keyboard in keyboards:
+            for row in keyboard['payload']['buttons']:
+                for button in row:
+                    if button.get('type') == 'callback':
+                        button['payload'] = encode_callback_payload(button['payload'], version)
+        return version
+    
+    def _commit_keyboard_version(self, chat_id: int, version: Optional[int]) -> None:
+        """Make version the only valid keyboard version for the chat."""
+        if version is not None:
+            self.keyboard_versions[chat_id] = version
+    
+    def is_stale_callback(self, chat_id: int, version: Optional[int]) -> bool:
+        """
+        Check whether a button press came from an outdated keyboard.
+        
+        Нажатия без версии и нажатия в чатах, для которых версия неизвестна
+        (например, после перезапуска), не считаются устаревшими.
+        """
+        if version is None:
+            return False
+        current = self.keyboard_versions.get(chat_id)
+        return current is not None and current != version
+    
+    def _content_digest(self, message_id: Optional[str], message_body: Dict[str, Any]) -> bytes:
+        """Short hash of outgoing content (target message + body)."""
+        raw = json.dumps([message_id, message_body], sort_keys=True, ensure_ascii=False)
+        return hashlib.blake2b(raw.encode('utf-8'), digest_size=8).digest()
+    
+    def _is_recent_duplicate(self, chat_id: int, digest: bytes) -> bool:
+        """Check whether the same content was sent to the chat within the window."""
+        if self.duplicate_window <= 0:
+            return False
         
+        last = self._last_sent.get(chat_id)
+        return last is not None and last[0] == digest and time.monotonic() - last[1] < self.duplicate_window
+    
+    def _record_flight(self, kind: str, detail: str) -> None:
+        # Запись попадает к пользователю обрабатываемого update (FlightRecorder.bind)
+        if self.flight_recorder is not None:
+            self.flight_recorder.record(kind, detail)
+    
+    @staticmethod
+    def _elapsed_ms(started: float) -> int:
+        return round((time.perf_counter() - started) * 1000)
+    
+    def _remember_sent(self, chat_id: int, digest: bytes) -> None:
+        """Remember the last content sent to the chat, dropping expired entries."""
+        if self.duplicate_window <= 0:
+            return
+        
+        now = time.monotonic()
+        self._last_sent[chat_id] = (digest, now)
+        self._last_sent.move_to_end(chat_id)
+        
+        # Записи упорядочены по времени - удаляем устаревшие с начала
+        while self._last_sent:
+            oldest_chat_id, (_, sent_at) = next(iter(self._last_sent.items()))
+            if now - sent_at < self.duplicate_window:
+                break
+            del self._last_sent[oldest_chat_id]
+    
     async def __aenter__(self):
         """Async context manager entry."""
         connector = aiohttp.TCPConnector(ssl=self.verify_ssl)
@@ -136,15 +311,17 @@ class MaxBot:
         if self.session:
             await self.session.close()
     
-    async def _make_request(self, method: str, data: Optional[Dict[str, Any]] = None, http_method: str = 'GET') -> Dict[str, Any]:
+    async def _make_request(self, method: str, data: Optional[Dict[str, Any]] = None, http_method: str = 'GET',
+                            params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         """
         Make an API request to MAX.
         
         Args:
             method: API method path (e.g., '/me', '/messages')
-            data: Request data
-            http_method: HTTP method (GET, POST, etc.)
-            
+            data: Request data (query параметры для GET, JSON тело для остальных методов)
+            http_method: HTTP method (GET, POST, PUT, etc.)
+            params: Query parameters for non-GET requests
+        
         Returns:
             API response
         """
@@ -153,27 +330,41 @@ class MaxBot:
             self.session = aiohttp.ClientSession(connector=connector)
         
         url = f"{self.base_url}{method}"
+        http_method = http_method.upper()
         
-        try:
-            if http_method.upper() == 'GET':
-                async with self.session.get(url, headers=self.headers, params=data) as response:
-                    if response.status == 200:
-                        return await response.json()
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"API error {response.status}: {error_text}")
-                        return {}
-            else:
-                async with self.session.post(url, headers=self.headers, json=data) as response:
+        if http_method == 'GET':
+            request_kwargs = {'params': data}
+        else:
+            request_kwargs = {'params': params, 'json': data}
+        
+        with self.tracer.span(f"max {http_method} {method}", kind=SPAN_KIND_CLIENT) as span:
+            try:
+                async with self.session.request(http_method, url, headers=self.headers, **request_kwargs) as response:
+                    span.set_attribute('http.status_code', response.status)
                     if response.status == 200:
                         return await response.json()
                     else:
                         error_text = await response.text()
+                        span.set_error(f"HTTP {response.status}")
                         logger.error(f"API error {response.status}: {error_text}")
                         return {}
-        except Exception as e:
-            logger.error(f"Request error: {e}")
-            return {}
+            except Exception as e:
+                span.set_error(str(e))
+                logger.error(f"Request error: {e}")
+                return {}
+    
+    @staticmethod
+    def parse_update(update_data: Dict[str, Any]) -> MaxUpdate:
+        """Build MaxUpdate from a raw /updates item (also used by replay and load tools)."""
+        timestamp = update_data.get('timestamp')
+        return MaxUpdate(
+            update_id=timestamp,  # Используем timestamp как уникальный ID
+            message=update_data.get('message'),
+            callback_query=update_data.get('message_callback'),
+            update_type=update_data.get('update_type'),
+            timestamp=timestamp,
+            raw_data=update_data  # Сохраняем полный raw update для callback
+        )
     
     async def get_updates(self, offset: Optional[int] = None, timeout: int = 30, limit: int = 100) -> List[MaxUpdate]:
         """
@@ -183,7 +374,7 @@ class MaxBot:
             offset: Not used (for compatibility) - MAX uses marker
             timeout: Long polling timeout in seconds
             limit: Maximum number of updates to retrieve
-            
+        
         Returns:
             List of MaxUpdate objects
         """
@@ -208,32 +399,32 @@ class MaxBot:
         updates_data = result.get('updates', [])
         
         updates = []
+        captured = []
         for update_data in updates_data:
             # Логируем структуру update для отладки
             logger.debug(f"Update data: {update_data}")
             
             # MAX возвращает другую структуру данных
             timestamp = update_data.get('timestamp')
-            update_type = update_data.get('update_type')
             
             # Пропускаем уже обработанные обновления
             if timestamp and timestamp <= self.last_update_id:
                 logger.debug(f"Skipping already processed update: {timestamp}")
                 continue
             
-            update = MaxUpdate(
-                update_id=timestamp,  # Используем timestamp как уникальный ID
-                message=update_data.get('message'),
-                callback_query=update_data.get('message_callback'),
-                update_type=update_type,
-                timestamp=timestamp,
-                raw_data=update_data  # Сохраняем полный raw update для callback
-            )
-            updates.append(update)
+            updates.append(self.parse_update(update_data))
+            captured.append(update_data)
             
             if timestamp and timestamp > self.last_update_id:
                 self.last_update_id = timestamp
         
+        if self.capture is not None and captured:
+            try:
+                self.capture.record(captured)
+            except Exception as e:
+                # Сбой записи не должен останавливать обработку
+                logger.error(f"Error capturing updates: {e}")
+        
         return updates
     
     async def send_message(self, chat_id: int, text: str, 
@@ -242,35 +433,39 @@ class MaxBot:
         """
         Send a message to a chat.
         
+        Внутри reply_buffer() сообщение не отправляется сразу, а попадает
+        в буфер и уходит при его сбросе (возвращается пустой dict).
+        
         Args:
             chat_id: Chat ID (передается как query параметр!)
             text: Message text
             reply_markup: Inline keyboard markup
             parse_mode: Parse mode (markdown, html)
-            
+        
         Returns:
             Sent message data
         """
-        # Формируем тело сообщения согласно MAX API
-        message_body = {
-            'text': text
-        }
+        buffer = _current_reply_buffer.get()
+        if buffer is not None:
+            buffer.add(chat_id, None, text, reply_markup, parse_mode)
+            return {}
         
-        # MAX использует 'format' вместо 'parse_mode'
-        if parse_mode:
-            message_body['format'] = parse_mode.lower()
+        return await self._send_message_now(chat_id, text, reply_markup, parse_mode)
+    
+    async def _send_message_now(self, chat_id: int, text: str,
+                                reply_markup: Optional[Dict[str, Any]] = None,
+                                parse_mode: Optional[str] = None) -> Dict[str, Any]:
+        """Send a message to a chat immediately, bypassing the reply buffer."""
+        message_body = self._build_message_body(text, reply_markup, parse_mode)
+        
+        digest = self._content_digest(None, message_body)
+        if self._is_recent_duplicate(chat_id, digest):
+            self.suppressed_duplicates += 1
+            logger.info(f"Skipping duplicate message to chat_id={chat_id}")
+            self._record_flight(SEND, f"chat={chat_id} duplicate skipped")
+            return {}
         
-        # Добавляем inline keyboard как attachment
-        if reply_markup and reply_markup.get('inline_keyboard'):
-            # Конвертируем Telegram формат кнопок в MAX формат
-            max_buttons = self._convert_telegram_buttons_to_max(reply_markup['inline_keyboard'])
-            
-            message_body['attachments'] = [{
-                'type': 'inline_keyboard',
-                'payload': {
-                    'buttons': max_buttons
-                }
-            }]
+        keyboard_version = self._stamp_keyboard(chat_id, message_body)
         
         # MAX требует chat_id в query параметрах!
         url = f"{self.base_url}/messages"
@@ -278,47 +473,157 @@ class MaxBot:
         
         logger.info(f"Sending message to chat_id={chat_id}, text length={len(text)}, has_buttons={bool(reply_markup)}")
         
-        try:
-            if not self.session:
-                connector = aiohttp.TCPConnector(ssl=self.verify_ssl)
-                self.session = aiohttp.ClientSession(connector=connector)
-            
-            async with self.session.post(url, headers=self.headers, params=params, 
-                                        json=message_body) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    logger.info(f"Message sent successfully, response: {result.get('message_id', 'no_id')}")
-                    return result
-                else:
+        started = time.perf_counter()
+        with self.tracer.span("max POST /messages", kind=SPAN_KIND_CLIENT) as span:
+            try:
+                if not self.session:
+                    connector = aiohttp.TCPConnector(ssl=self.verify_ssl)
+                    self.session = aiohttp.ClientSession(connector=connector)
+                
+                async with self.session.post(url, headers=self.headers, params=params, 
+                                            json=message_body) as response:
+                    span.set_attribute('http.status_code', response.status)
+                    if response.status == 200:
+                        result = await response.json()
+                        logger.info(f"Message sent successfully, response: {result.get('message_id', 'no_id')}")
+                        self._remember_sent(chat_id, digest)
+                        self._commit_keyboard_version(chat_id, keyboard_version)
+                        self._record_flight(SEND, f"chat={chat_id} ok {self._elapsed_ms(started)}ms "
+                                                  f"len={len(text)} buttons={bool(reply_markup)}")
+                        return result
+                    else:
+                        error_text = await response.text()
+                        span.set_error(f"HTTP {response.status}")
+                        logger.error(f"Send message error {response.status}: {error_text}")
+                        self._record_flight(SEND, f"chat={chat_id} HTTP {response.status} "
+                                                  f"{self._elapsed_ms(started)}ms {error_text}")
+                        return {}
+            except Exception as e:
+                span.set_error(str(e))
+                logger.error(f"Send message error: {e}")
+                self._record_flight(SEND, f"chat={chat_id} {type(e).__name__} {self._elapsed_ms(started)}ms {e}")
+                return {}
+    
+    async def send_message_to_user(self, user_id: int, text: str,
+                                   parse_mode: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Send a message to a user's dialog by user ID.
+        
+        MAX принимает POST /messages?user_id=<id>: так пишут пользователю,
+        chat_id диалога с которым неизвестен (например, администраторам из
+        ADMIN_IDS). Буфер ответов и версии клавиатур не используются.
+        
+        Args:
+            user_id: User ID (передается как query параметр)
+            text: Message text
+            parse_mode: Parse mode (markdown, html)
+        
+        Returns:
+            Sent message data, empty dict on failure
+        """
+        message_body = self._build_message_body(text, None, parse_mode)
+        url = f"{self.base_url}/messages"
+        params = {'user_id': user_id}
+        
+        logger.info(f"Sending message to user_id={user_id}, text length={len(text)}")
+        
+        started = time.perf_counter()
+        with self.tracer.span("max POST /messages", kind=SPAN_KIND_CLIENT) as span:
+            try:
+                if not self.session:
+                    connector = aiohttp.TCPConnector(ssl=self.verify_ssl)
+                    self.session = aiohttp.ClientSession(connector=connector)
+                
+                async with self.session.post(url, headers=self.headers, params=params,
+                                            json=message_body) as response:
+                    span.set_attribute('http.status_code', response.status)
+                    if response.status == 200:
+                        result = await response.json()
+                        self._record_flight(SEND, f"user={user_id} ok {self._elapsed_ms(started)}ms len={len(text)}")
+                        return result
                     error_text = await response.text()
-                    logger.error(f"Send message error {response.status}: {error_text}")
+                    span.set_error(f"HTTP {response.status}")
+                    logger.error(f"Send message to user error {response.status}: {error_text}")
+                    self._record_flight(SEND, f"user={user_id} HTTP {response.status} "
+                                              f"{self._elapsed_ms(started)}ms {error_text}")
                     return {}
-        except Exception as e:
-            logger.error(f"Send message error: {e}")
-            return {}
+            except Exception as e:
+                span.set_error(str(e))
+                logger.error(f"Send message to user error: {e}")
+                self._record_flight(SEND, f"user={user_id} {type(e).__name__} {self._elapsed_ms(started)}ms {e}")
+                return {}
     
-    async def edit_message_text(self, chat_id: int, message_id: int, text: str,
+    async def edit_message_text(self, chat_id: int, message_id: Optional[str], text: str,
                                reply_markup: Optional[Dict[str, Any]] = None,
                                parse_mode: Optional[str] = None) -> Dict[str, Any]:
         """
-        Edit an existing message.
+        Edit an existing message in place.
         
-        Note: MAX API не поддерживает редактирование сообщений.
-        Вместо этого отправляем новое сообщение.
+        MAX редактирует сообщение через PUT /messages?message_id=<mid>.
+        Если message_id неизвестен (например, для bot_started) или
+        редактирование не удалось, отправляется новое сообщение.
         
         Args:
-            chat_id: Chat ID
-            message_id: Message ID (игнорируется, так как нельзя редактировать)
+            chat_id: Chat ID (нужен для fallback на send_message)
+            message_id: Message ID (mid) редактируемого сообщения
             text: New message text
             reply_markup: New inline keyboard markup
             parse_mode: Parse mode (markdown, html)
-            
+        
         Returns:
-            New message data
+            API response (edit result or new message data)
         """
-        # MAX API не поддерживает редактирование, просто отправляем новое сообщение
-        logger.info(f"MAX doesn't support message editing, sending new message instead")
-        return await self.send_message(
+        buffer = _current_reply_buffer.get()
+        if buffer is not None:
+            buffer.add(chat_id, message_id, text, reply_markup, parse_mode)
+            return {}
+        
+        return await self._edit_message_text_now(chat_id, message_id, text, reply_markup, parse_mode)
+    
+    async def _edit_message_text_now(self, chat_id: int, message_id: Optional[str], text: str,
+                                     reply_markup: Optional[Dict[str, Any]] = None,
+                                     parse_mode: Optional[str] = None) -> Dict[str, Any]:
+        """Edit a message immediately, bypassing the reply buffer."""
+        if not message_id:
+            logger.info(f"No message_id to edit in chat_id={chat_id}, sending new message instead")
+            return await self._send_message_now(
+                chat_id=chat_id,
+                text=text,
+                reply_markup=reply_markup,
+                parse_mode=parse_mode
+            )
+        
+        message_body = self._build_message_body(text, reply_markup, parse_mode)
+        
+        # Без attachments MAX оставит старую клавиатуру - явно убираем её
+        message_body.setdefault('attachments', [])
+        
+        digest = self._content_digest(message_id, message_body)
+        if self._is_recent_duplicate(chat_id, digest):
+            self.suppressed_duplicates += 1
+            logger.info(f"Skipping duplicate edit of message {message_id} in chat_id={chat_id}")
+            self._record_flight(EDIT, f"chat={chat_id} duplicate skipped")
+            return {'success': True}
+        
+        keyboard_version = self._stamp_keyboard(chat_id, message_body)
+        
+        logger.info(f"Editing message {message_id} in chat_id={chat_id}, text length={len(text)}, has_buttons={bool(reply_markup)}")
+        
+        started = time.perf_counter()
+        result = await self._make_request('/messages', message_body, 'PUT', params={'message_id': message_id})
+        
+        if result.get('success'):
+            logger.info(f"Message {message_id} edited successfully")
+            self._remember_sent(chat_id, digest)
+            self._commit_keyboard_version(chat_id, keyboard_version)
+            self._record_flight(EDIT, f"chat={chat_id} ok {self._elapsed_ms(started)}ms "
+                                      f"len={len(text)} buttons={bool(reply_markup)}")
+            return result
+        
+        logger.warning(f"Failed to edit message {message_id}: {result.get('message', 'no response')}, sending new message instead")
+        self._record_flight(EDIT, f"chat={chat_id} failed {self._elapsed_ms(started)}ms "
+                                  f"{result.get('message', 'no response')}, sending new message")
+        return await self._send_message_now(
             chat_id=chat_id,
             text=text,
             reply_markup=reply_markup,
@@ -327,23 +632,68 @@ class MaxBot:
     
     async def answer_callback_query(self, callback_query_id: str, 
                                    text: Optional[str] = None,
-                                   show_alert: bool = False) -> bool:
+                                   show_alert: bool = False,
+                                   message: Optional[Dict[str, Any]] = None) -> bool:
         """
-        Answer a callback query.
+        Answer a callback query via POST /answers.
+        
+        Ответ без текста просто подтверждает нажатие, чтобы клиент MAX
+        убрал индикатор загрузки на кнопке.
         
         Args:
             callback_query_id: Callback query ID
-            text: Notification text
+            text: Notification text (одноразовое уведомление пользователю)
             show_alert: Show as alert (not used in MAX, for compatibility)
-            
+            message: Updated message body ({'text', 'reply_markup', 'parse_mode'})
+                     для замены сообщения с кнопкой в том же запросе
+        
         Returns:
             Success status
         """
-        # В MAX для ответа на callback используется другой подход
-        # Обычно достаточно просто обработать callback и отправить сообщение
-        # Этот метод оставлен для совместимости
+        if not callback_query_id:
+            return False
+        
+        answer_body: Dict[str, Any] = {}
+        
+        if text:
+            answer_body['notification'] = text
+        
+        if message:
+            answer_body['message'] = self._build_message_body(
+                message.get('text', ''),
+                message.get('reply_markup'),
+                message.get('parse_mode')
+            )
+        
+        result = await self._make_request('/answers', answer_body, 'POST', params={'callback_id': callback_query_id})
+        
+        if not result.get('success'):
+            logger.warning(f"Failed to answer callback {callback_query_id}: {result.get('message', 'no response')}")
+            return False
+        
         return True
     
+    @asynccontextmanager
+    async def reply_buffer(self):
+        """
+        Collect outgoing messages of one update and send them on exit.
+        
+        Сообщения, отправленные обработчиком внутри блока, объединяются
+        (см. ReplyBuffer) и уходят при выходе из блока - в том числе при
+        исключении. Вложенные вызовы используют внешний буфер.
+        """
+        if _current_reply_buffer.get() is not None:
+            yield _current_reply_buffer.get()
+            return
+        
+        buffer = ReplyBuffer(self)
+        token = _current_reply_buffer.set(buffer)
+        try:
+            yield buffer
+        finally:
+            _current_reply_buffer.reset(token)
+            await buffer.flush()
+    
     async def get_me(self) -> Dict[str, Any]:
         """
         Get bot information.
@@ -359,7 +709,7 @@ class MaxBot:
         
         Args:
             buttons: List of button rows, each containing button dicts with 'text' and 'callback_data'
-            
+        
         Returns:
             Inline keyboard markup dict
         """
@@ -368,6 +718,104 @@ class MaxBot:
         }
 
 
+class ReplyBuffer:
+    """
+    Buffer of outgoing messages produced while handling one update.
+    
+    При сбросе соседние совместимые сообщения объединяются в один запрос:
+    - новые сообщения в тот же чат, если у предыдущего нет клавиатуры,
+      форматы совпадают и суммарный текст не превышает лимит MAX;
+    - повторное редактирование того же сообщения заменяет предыдущее.
+    Порядок сообщений и клавиатуры сохраняются.
+    """
+    
+    # Символы, которые меняют смысл обычного текста при включенном markdown
+    MARKDOWN_SPECIAL_CHARS = frozenset('*_`[]~')
+    
+    def __init__(self, bot: 'MaxBot'):
+        self.bot = bot
+        self.pending: List[Dict[str, Any]] = []
+        self.merged_count = 0
+    
+    def add(self, chat_id: int, message_id: Optional[str], text: str,
+            reply_markup: Optional[Dict[str, Any]] = None,
+            parse_mode: Optional[str] = None) -> None:
+        """Add an outgoing message (message_id=None means a new message)."""
+        entry = {
+            'chat_id': chat_id,
+            'message_id': message_id,
+            'text': text,
+            'reply_markup': reply_markup if reply_markup and reply_markup.get('inline_keyboard') else None,
+            'parse_mode': parse_mode.lower() if parse_mode else None
+        }
+        
+        if self.pending and self._merge(self.pending[-1], entry):
+            self.merged_count += 1
+            return
+        
+        self.pending.append(entry)
+    
+    def _merge(self, previous: Dict[str, Any], entry: Dict[str, Any]) -> bool:
+        """Merge entry into previous if compatible. Returns True on success."""
+        if previous['chat_id'] != entry['chat_id']:
+            return False
+        
+        # Два редактирования одного сообщения - достаточно последнего
+        if entry['message_id'] and entry['message_id'] == previous['message_id']:
+            previous.update(entry)
+            return True
+        
+        if previous['message_id'] or entry['message_id'] or previous['reply_markup']:
+            return False
+        
+        parse_mode = self._merged_parse_mode(previous, entry)
+        if parse_mode is False:
+            return False
+        
+        text = f"{previous['text'].strip()}\n\n{entry['text'].strip()}"
+        if len(text) > MAX_MESSAGE_LENGTH:
+            return False
+        
+        previous.update(text=text, reply_markup=entry['reply_markup'], parse_mode=parse_mode)
+        return True
+    
+    def _merged_parse_mode(self, previous: Dict[str, Any], entry: Dict[str, Any]):
+        """Return parse mode for merged text or False if formats are incompatible."""
+        if previous['parse_mode'] == entry['parse_mode']:
+            return entry['parse_mode']
+        
+        # Обычный текст можно присоединить к форматированному, если в нём нет разметки
+        if previous['parse_mode'] is None and not self.MARKDOWN_SPECIAL_CHARS & set(previous['text']):
+            return entry['parse_mode']
+        if entry['parse_mode'] is None and not self.MARKDOWN_SPECIAL_CHARS & set(entry['text']):
+            return previous['parse_mode']
+        
+        return False
+    
+    async def flush(self) -> None:
+        """Send all buffered messages in order."""
+        pending, self.pending = self.pending, []
+        
+        if self.merged_count:
+            logger.info(f"Reply buffer merged {self.merged_count} messages, sending {len(pending)} requests")
+            self.merged_count = 0
+        
+        for entry in pending:
+            try:
+                if entry['message_id']:
+                    await self.bot._edit_message_text_now(
+                        entry['chat_id'], entry['message_id'], entry['text'],
+                        entry['reply_markup'], entry['parse_mode']
+                    )
+                else:
+                    await self.bot._send_message_now(
+                        entry['chat_id'], entry['text'],
+                        entry['reply_markup'], entry['parse_mode']
+                    )
+            except Exception as e:
+                logger.error(f"Error flushing buffered message to chat_id={entry['chat_id']}: {e}")
+
+
 class MaxMessageProxy:
     """Proxy class to make MAX messages compatible with Telegram bot handlers."""
     
@@ -443,9 +891,10 @@ class MaxCallbackQueryProxy:
         
         # Callback ID для ответа
         self.id = callback.get('callback_id', '')
+        self._ack_task: Optional[asyncio.Future] = None
         
-        # Данные callback (payload)
-        self.data = callback.get('payload', '')
+        # Данные callback (payload) и версия клавиатуры, с которой нажата кнопка
+        self.data, self.payload_version = decode_callback_payload(callback.get('payload', ''))
         
         # Информация о пользователе
         user = callback.get('user', {})
@@ -468,12 +917,35 @@ class MaxCallbackQueryProxy:
             'text': body.get('text', '')
         }
     
-    async def answer(self, text: Optional[str] = None, show_alert: bool = False):
+    def acknowledge(self) -> None:
+        """
+        Start acknowledging the callback in the background.
+        
+        Вызывается диспетчером сразу при получении callback, до запуска
+        обработчика, чтобы клиент не ждал полного ответа.
+        """
+        if self._ack_task is None and self.id:
+            self._ack_task = asyncio.ensure_future(self.bot.answer_callback_query(callback_query_id=self.id))
+    
+    async def answer(self, text: Optional[str] = None, show_alert: bool = False,
+                     message: Optional[Dict[str, Any]] = None):
         """Answer the callback query."""
+        if not text and not message:
+            # Повторные пустые ответы переиспользуют уже отправленное подтверждение
+            self.acknowledge()
+            return await self._ack_task if self._ack_task else False
+        
+        if self._ack_task is not None:
+            await self._ack_task
+        
+        if message and hasattr(message.get('reply_markup'), 'to_dict'):
+            message = dict(message, reply_markup=message['reply_markup'].to_dict())
+        
         return await self.bot.answer_callback_query(
             callback_query_id=self.id,
             text=text,
-            show_alert=show_alert
+            show_alert=show_alert,
+            message=message
         )
     
     async def edit_message_text(self, text: str, reply_markup=None, parse_mode=None):
@@ -497,7 +969,7 @@ def convert_telegram_keyboard_to_max(telegram_markup) -> Dict[str, Any]:
     
     Args:
         telegram_markup: Telegram InlineKeyboardMarkup object
-        
+    
     Returns:
         MAX-compatible keyboard dict
     """
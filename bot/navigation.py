@@ -0,0 +1,121 @@
+"""
+Navigation history for back actions.
+Rendered screens are cached by content; each user keeps a short packed stack of (state, screen id).
+"""
+
+import hashlib
+import logging
+import struct
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Container, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Сколько экранов помнить на пользователя: 8 записей по 9 байт
+HISTORY_LIMIT = 8
+
+# Сколько разных экранов держать в общем кэше
+SCREEN_CACHE_SIZE = 4096
+
+HISTORY_KEY = 'history'
+
+# индекс состояния в StateMachine.states, id экрана
+_ENTRY = struct.Struct('<B8s')
+
+
+@dataclass(frozen=True)
+class Screen:
+    """Rendered message: text and keyboard, exactly as a handler sent it."""
+    
+    text: str
+    reply_markup: Any = None
+    parse_mode: Optional[str] = None
+
+
+def screen_id(screen: Screen) -> bytes:
+    """Content address of a screen (8 bytes)."""
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(screen.text.encode('utf-8'))
+    if screen.reply_markup is not None:
+        to_json = getattr(screen.reply_markup, 'to_json', None)
+        digest.update(b'\0' + (to_json() if to_json else repr(screen.reply_markup)).encode('utf-8'))
+    digest.update(b'\0' + (screen.parse_mode or '').encode('utf-8'))
+    return digest.digest()
+
+
+class ScreenCache:
+    """LRU cache of rendered screens shared by all users."""
+    
+    def __init__(self, max_entries: int = SCREEN_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._screens: 'OrderedDict[bytes, Screen]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def put(self, screen: Screen) -> bytes:
+        """Store a screen and return its id."""
+        key = screen_id(screen)
+        if key in self._screens:
+            self._screens.move_to_end(key)
+        else:
+            self._screens[key] = screen
+            if len(self._screens) > self.max_entries:
+                self._screens.popitem(last=False)
+        return key
+    
+    def get(self, key: bytes) -> Optional[Screen]:
+        screen = self._screens.get(key)
+        if screen is None:
+            self.misses += 1
+            return None
+        self._screens.move_to_end(key)
+        self.hits += 1
+        return screen
+    
+    def __len__(self) -> int:
+        return len(self._screens)
+
+
+def history_entries(user_data: dict) -> List[Tuple[int, bytes]]:
+    """Decode the user's history, oldest first."""
+    return list(_ENTRY.iter_unpack(user_data.get(HISTORY_KEY, b'')))
+
+
+def push_screen(user_data: dict, state_index: int, key: bytes) -> None:
+    """Append a screen to the history, dropping the oldest beyond HISTORY_LIMIT."""
+    history = user_data.get(HISTORY_KEY, b'')
+    entry = _ENTRY.pack(state_index, key)
+    if history.endswith(entry):
+        # Тот же экран показан повторно
+        return
+    history += entry
+    user_data[HISTORY_KEY] = history[-HISTORY_LIMIT * _ENTRY.size:]
+
+
+def truncate_history(user_data: dict, length: int) -> None:
+    """Keep the first `length` entries."""
+    user_data[HISTORY_KEY] = user_data.get(HISTORY_KEY, b'')[:length * _ENTRY.size]
+
+
+def find_back_target(user_data: dict, states: Container[int]) -> Optional[Tuple[int, int, bytes]]:
+    """
+    Latest screen below the current one whose state is among `states`.
+    
+    Returns (position, state index, screen id) or None.
+    """
+    entries = history_entries(user_data)
+    for position in range(len(entries) - 2, -1, -1):
+        state_index, key = entries[position]
+        if state_index in states:
+            return position, state_index, key
+    return None
+
+
+def find_latest(user_data: dict, state_index: int) -> Optional[int]:
+    """Position of the latest entry with a state, or None."""
+    entries = history_entries(user_data)
+    for position in range(len(entries) - 1, -1, -1):
+        if entries[position][0] == state_index:
+            return position
+    return None
@@ -0,0 +1,263 @@
+"""
+Session persistence for the MAX bot.
+Write-behind storage: handlers only mark sessions dirty, changed keys are flushed in batches.
+"""
+
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Dict, Any, Optional, Callable, Container, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Значения bytes (например, история навигации) хранятся в JSON как {"__bytes__": "<base64>"}
+_BYTES_TAG = '__bytes__'
+
+
+def _encode_special(value: Any) -> Any:
+    if isinstance(value, (bytes, bytearray)):
+        return {_BYTES_TAG: base64.b64encode(value).decode('ascii')}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _decode_special(obj: Dict[str, Any]) -> Any:
+    if len(obj) == 1 and _BYTES_TAG in obj:
+        return base64.b64decode(obj[_BYTES_TAG])
+    return obj
+
+
+def encode_session_value(value: Any) -> str:
+    """Encode a session value as JSON; bytes are stored base64 with a type tag."""
+    return json.dumps(value, ensure_ascii=False, sort_keys=True, default=_encode_special)
+
+
+def decode_session_value(encoded: str) -> Any:
+    """Decode a value written by encode_session_value()."""
+    return json.loads(encoded, object_hook=_decode_special)
+
+
+def sqlite_path_from_url(database_url: Optional[str]) -> Optional[str]:
+    """
+    Extract SQLite file path from DATABASE_URL (sqlite:///path/to/file.db).
+    
+    Returns None for empty or non-SQLite URLs.
+    """
+    if not database_url:
+        return None
+    prefix = 'sqlite:///'
+    if not database_url.startswith(prefix):
+        logger.warning(f"Unsupported DATABASE_URL scheme, session persistence disabled: {database_url.split(':', 1)[0]}")
+        return None
+    return database_url[len(prefix):]
+
+
+class SessionStore:
+    """SQLite storage of session data: one row per (user_id, key) with a JSON value."""
+    
+    def __init__(self, path: str):
+        self.path = path
+        # Загрузка и запись идут в разных потоках (asyncio.to_thread) через одно соединение
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS session_data ('
+            'user_id INTEGER NOT NULL, '
+            'key TEXT NOT NULL, '
+            'value TEXT NOT NULL, '
+            'updated_at REAL NOT NULL, '
+            'PRIMARY KEY (user_id, key))'
+        )
+        self.connection.commit()
+    
+    def load_all(self, user_filter: Optional[Callable[[int], bool]] = None) -> Dict[int, Dict[str, str]]:
+        """
+        Load stored sessions as {user_id: {key: json_value}}.
+        
+        user_filter отбирает пользователей (например, своего шарда): строки
+        остальных пропускаются при чтении и не занимают память.
+        """
+        sessions: Dict[int, Dict[str, str]] = {}
+        last_user, keep = None, True
+        with self._lock:
+            for user_id, key, value in self.connection.execute(
+                    'SELECT user_id, key, value FROM session_data ORDER BY user_id'):
+                if user_filter is not None:
+                    # Строки идут по user_id - фильтр вызывается один раз на пользователя
+                    if user_id != last_user:
+                        last_user, keep = user_id, user_filter(user_id)
+                    if not keep:
+                        continue
+                sessions.setdefault(user_id, {})[key] = value
+        return sessions
+    
+    def write_batch(self, upserts: List[Tuple[int, str, str]], deletes: List[Tuple[int, str]]) -> None:
+        """Apply changed and removed keys in a single transaction."""
+        now = time.time()
+        with self._lock, self.connection:
+            if upserts:
+                self.connection.executemany(
+                    'INSERT INTO session_data (user_id, key, value, updated_at) VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT (user_id, key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at',
+                    [(user_id, key, value, now) for user_id, key, value in upserts]
+                )
+            if deletes:
+                self.connection.executemany(
+                    'DELETE FROM session_data WHERE user_id = ? AND key = ?',
+                    deletes
+                )
+    
+    def close(self) -> None:
+        """Close the database connection."""
+        with self._lock:
+            self.connection.close()
+
+
+class WriteBehindSessionWriter:
+    """
+    Batches session writes off the request path.
+    
+    Диспетчер вызывает mark_dirty() после обработки update. Фоновая задача
+    раз в flush_interval секунд (или после max_pending_updates отметок)
+    сравнивает текущие ключи сессий с последними сохраненными и пишет
+    в хранилище только изменившиеся - одной транзакцией в отдельном потоке.
+    
+    flush_interval задает окно долговечности: при падении процесса теряются
+    изменения не более чем за этот интервал.
+    """
+    
+    def __init__(self, store: SessionStore,
+                 snapshot: Callable[[int], Dict[str, Any]],
+                 flush_interval: float = 0.5,
+                 max_pending_updates: int = 100,
+                 skip_keys: Container[str] = ()):
+        """
+        Args:
+            store: Session storage
+            snapshot: Returns current session data of a user as {key: value}
+            flush_interval: Maximum delay before dirty sessions are written (seconds)
+            max_pending_updates: Flush early after this many mark_dirty() calls
+            skip_keys: Keys that are never written (state that does not outlive the process)
+        """
+        self.store = store
+        self.snapshot = snapshot
+        self.flush_interval = flush_interval
+        self.max_pending_updates = max_pending_updates
+        self.skip_keys = skip_keys
+        
+        self._dirty: set = set()
+        self._pending_updates = 0
+        # Хеши последних сохраненных значений: user_id -> {key: digest}
+        self._persisted: Dict[int, Dict[str, bytes]] = {}
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+    
+    @staticmethod
+    def _digest(value: str) -> bytes:
+        return hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest()
+    
+    def load(self, user_filter: Optional[Callable[[int], bool]] = None) -> Dict[int, Dict[str, Any]]:
+        """Load stored sessions (only users accepted by user_filter) and remember them as already persisted."""
+        sessions = {}
+        for user_id, values in self.store.load_all(user_filter).items():
+            self._persisted[user_id] = {key: self._digest(value) for key, value in values.items()}
+            sessions[user_id] = {key: decode_session_value(value) for key, value in values.items()}
+        logger.info(f"Loaded {len(sessions)} sessions from storage")
+        return sessions
+    
+    def mark_dirty(self, user_id: int) -> None:
+        """Mark user's session as changed."""
+        self._dirty.add(user_id)
+        self._pending_updates += 1
+        if self._pending_updates >= self.max_pending_updates:
+            self._wakeup.set()
+    
+    def start(self) -> None:
+        """Start the background flush task."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self) -> None:
+        """Stop the background task and flush everything that is still dirty."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+    
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing sessions: {e}", exc_info=True)
+    
+    def _collect_changes(self, user_ids) -> Tuple[List[Tuple[int, str, str]], List[Tuple[int, str]], Dict[int, Dict[str, bytes]]]:
+        """Compare current session keys with persisted ones."""
+        upserts = []
+        deletes = []
+        new_digests = {}
+        
+        for user_id in user_ids:
+            persisted = self._persisted.get(user_id, {})
+            current = {}
+            for key, value in self.snapshot(user_id).items():
+                if key in self.skip_keys:
+                    continue
+                try:
+                    encoded = encode_session_value(value)
+                except (TypeError, ValueError) as e:
+                    # Ключ не сохраняется, но и не мешает записи остальных данных
+                    logger.error(f"Cannot persist session key {key!r} of user {user_id}: {e}")
+                    if key in persisted:
+                        current[key] = persisted[key]
+                    continue
+                digest = self._digest(encoded)
+                current[key] = digest
+                if persisted.get(key) != digest:
+                    upserts.append((user_id, key, encoded))
+            deletes.extend((user_id, key) for key in persisted if key not in current)
+            new_digests[user_id] = current
+        
+        return upserts, deletes, new_digests
+    
+    async def flush(self) -> None:
+        """Write changed keys of all dirty sessions."""
+        async with self._flush_lock:
+            self._wakeup.clear()
+            self._pending_updates = 0
+            if not self._dirty:
+                return
+            
+            dirty, self._dirty = self._dirty, set()
+            try:
+                upserts, deletes, new_digests = self._collect_changes(dirty)
+                if upserts or deletes:
+                    await asyncio.to_thread(self.store.write_batch, upserts, deletes)
+            except Exception:
+                # Вернем сессии в очередь, чтобы записать их при следующем сбросе
+                self._dirty |= dirty
+                raise
+            
+            if upserts or deletes:
+                logger.debug(f"Flushed sessions: {len(dirty)} users, {len(upserts)} keys written, {len(deletes)} removed")
+            
+            for user_id, digests in new_digests.items():
+                if digests:
+                    self._persisted[user_id] = digests
+                else:
+                    self._persisted.pop(user_id, None)
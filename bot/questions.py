@@ -0,0 +1,350 @@
+"""
+Anonymous question queue for the dependency counseling bot.
+Questions are appended to a JSONL log, grouped by SimHash similarity and sent to admins as batched digests.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+
+from .faq import tokenize
+
+logger = logging.getLogger(__name__)
+
+FINGERPRINT_BITS = 64
+# Вопросы, отпечатки которых отличаются не больше чем на столько бит, считаются похожими
+# (у коротких вопросов одно лишнее слово меняет около 10 бит)
+SIMILARITY_THRESHOLD = 12
+# Отпечаток делится на 13 полос по 5 бит: при расстоянии <= 12 хотя бы одна полоса совпадает,
+# поэтому сравнивать нужно только группы с общей полосой
+_BAND_BITS = 5
+_BANDS = -(-FINGERPRINT_BITS // _BAND_BITS)
+_BAND_MASK = (1 << _BAND_BITS) - 1
+
+# Ограничения одного дайджеста (остальное уходит в следующий)
+DIGEST_MAX_GROUPS = 15
+DIGEST_MAX_CHARS = 3500
+QUESTION_PREVIEW_CHARS = 300
+
+
+def _feature_hash(feature: str) -> int:
+    return int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def simhash(text: str) -> int:
+    """64-bit SimHash over word stems and stem pairs."""
+    terms = tokenize(text)
+    features = terms + [f"{first} {second}" for first, second in zip(terms, terms[1:])]
+    if not features:
+        return 0
+    
+    weights = [0] * FINGERPRINT_BITS
+    for feature in features:
+        value = _feature_hash(feature)
+        for bit in range(FINGERPRINT_BITS):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    return sum(1 << bit for bit, weight in enumerate(weights) if weight > 0)
+
+
+def hamming_distance(first: int, second: int) -> int:
+    return bin(first ^ second).count('1')
+
+
+@dataclass
+class Question:
+    """One anonymous question."""
+    
+    id: int
+    t: float  # время получения (unix)
+    text: str
+    fingerprint: int
+    cluster: int  # id первого вопроса группы похожих
+
+
+class QuestionQueue:
+    """
+    Durable queue of anonymous questions.
+    
+    Журнал - JSONL, в который дописываются строки: {"q": id, ...} для
+    вопроса и {"sent": [id, ...]} для вопросов, ушедших в дайджест. При запуске
+    журнал читается целиком, неотправленные вопросы снова попадают в очередь.
+    После доставки дайджеста журнал сжимается (compact): в нем остаются
+    неотправленные вопросы и группы {"c": id, "fp": ..., "n": отправлено},
+    чтобы пометка "уже задавали раньше" переживала перезапуск.
+    Без path очередь живет только в памяти.
+    """
+    
+    def __init__(self, path: Optional[str] = None, threshold: int = SIMILARITY_THRESHOLD):
+        self.path = path
+        self.threshold = threshold
+        self.pending: Dict[int, Question] = {}
+        self.total = 0
+        self._next_id = 1
+        # Отпечатки первых вопросов групп и индекс по полосам отпечатка
+        self._clusters: Dict[int, int] = {}
+        self._bands: List[Dict[int, List[int]]] = [{} for _ in range(_BANDS)]
+        self.cluster_sizes: Dict[int, int] = {}
+        self._file = None
+        
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._load()
+            self._file = open(path, 'a', encoding='utf-8')
+    
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding='utf-8') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning(f"Skipping damaged record in {self.path}")
+                    continue
+                if 'q' in record:
+                    self._index(Question(record['q'], record['t'], record['text'],
+                                         int(record['fp'], 16), 0))
+                elif 'c' in record:
+                    self._add_cluster(record['c'], int(record['fp'], 16))
+                    self.cluster_sizes[record['c']] = self.cluster_sizes.get(record['c'], 0) + record['n']
+                    self._next_id = max(self._next_id, record['c'] + 1)
+                elif 'sent' in record:
+                    for question_id in record['sent']:
+                        self.pending.pop(question_id, None)
+        logger.info(f"Loaded question queue: {self.total} questions, {len(self.pending)} pending")
+    
+    def _append(self, record: Dict) -> None:
+        if self._file is None:
+            return
+        self._file.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+        self._file.flush()
+    
+    def _find_cluster(self, fingerprint: int) -> Optional[int]:
+        best, best_distance = None, self.threshold + 1
+        for band in range(_BANDS):
+            key = fingerprint >> (band * _BAND_BITS) & _BAND_MASK
+            for cluster in self._bands[band].get(key, ()):
+                distance = hamming_distance(fingerprint, self._clusters[cluster])
+                if distance < best_distance:
+                    best, best_distance = cluster, distance
+        return best
+    
+    def _add_cluster(self, cluster: int, fingerprint: int) -> None:
+        self._clusters[cluster] = fingerprint
+        for band in range(_BANDS):
+            key = fingerprint >> (band * _BAND_BITS) & _BAND_MASK
+            self._bands[band].setdefault(key, []).append(cluster)
+    
+    def _index(self, question: Question) -> None:
+        cluster = self._find_cluster(question.fingerprint)
+        if cluster is None:
+            cluster = question.id
+            self._add_cluster(cluster, question.fingerprint)
+        question.cluster = cluster
+        self.cluster_sizes[cluster] = self.cluster_sizes.get(cluster, 0) + 1
+        self.pending[question.id] = question
+        self.total += 1
+        self._next_id = max(self._next_id, question.id + 1)
+    
+    @staticmethod
+    def _question_record(question: Question) -> Dict:
+        return {'q': question.id, 't': round(question.t, 3), 'text': question.text,
+                'fp': f"{question.fingerprint:016x}"}
+    
+    def add(self, text: str) -> Question:
+        """Store a question and assign it to a group of similar ones."""
+        question = Question(self._next_id, time.time(), text, simhash(text), 0)
+        self._index(question)
+        self._append(self._question_record(question))
+        return question
+    
+    def pending_groups(self) -> List[List[Question]]:
+        """Unsent questions grouped by similarity, largest groups first."""
+        groups: Dict[int, List[Question]] = {}
+        for question in self.pending.values():
+            groups.setdefault(question.cluster, []).append(question)
+        return sorted(groups.values(), key=lambda group: (-len(group), group[0].id))
+    
+    def mark_sent(self, question_ids: Iterable[int]) -> None:
+        """Remove questions from the queue after they were delivered."""
+        sent = [question_id for question_id in question_ids if self.pending.pop(question_id, None)]
+        if sent:
+            self._append({'sent': sent, 't': round(time.time(), 3)})
+    
+    def compact(self) -> None:
+        """
+        Rewrite the log with pending questions and group fingerprints only.
+        
+        Новый журнал пишется во временный файл и атомарно подменяет старый:
+        при сбое остается прежний журнал, в котором уже записана отметка
+        об отправке.
+        """
+        if self._file is None:
+            return
+        pending_sizes: Dict[int, int] = {}
+        for question in self.pending.values():
+            pending_sizes[question.cluster] = pending_sizes.get(question.cluster, 0) + 1
+        records = [{'c': cluster, 'fp': f"{fingerprint:016x}",
+                    'n': self.cluster_sizes.get(cluster, 0) - pending_sizes.get(cluster, 0)}
+                   for cluster, fingerprint in self._clusters.items()]
+        records.extend(self._question_record(question) for question in self.pending.values())
+        
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            for record in records:
+                file.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+        self._file.close()
+        try:
+            os.replace(temp_path, self.path)
+        finally:
+            self._file = open(self.path, 'a', encoding='utf-8')
+    
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def build_digest(groups: List[List[Question]], cluster_sizes: Dict[int, int],
+                 max_groups: int = DIGEST_MAX_GROUPS, max_chars: int = DIGEST_MAX_CHARS):
+    """
+    Digest text and ids of the questions it covers.
+    
+    Группа показывается одним вопросом с числом похожих; группы, не поместившиеся
+    по числу или длине, остаются в очереди до следующего дайджеста.
+    """
+    pending_count = sum(len(group) for group in groups)
+    header = f"📝 Новые анонимные вопросы: {pending_count}\n"
+    lines = []
+    covered: List[int] = []
+    length = len(header)
+    for group in groups[:max_groups]:
+        text = group[-1].text
+        if len(text) > QUESTION_PREVIEW_CHARS:
+            text = text[:QUESTION_PREVIEW_CHARS] + '…'
+        line = f"\n{len(lines) + 1}. {text}"
+        if len(group) > 1:
+            line += f" (похожих: {len(group)})"
+        if cluster_sizes.get(group[0].cluster, 0) > len(group):
+            line += " [уже задавали раньше]"
+        if lines and length + len(line) > max_chars:
+            break
+        lines.append(line)
+        length += len(line)
+        covered.extend(question.id for question in group)
+    
+    rest = pending_count - len(covered)
+    footer = f"\n\nОстальные ({rest}) придут в следующем дайджесте." if rest else ""
+    return header + ''.join(lines) + footer, covered
+
+
+class QuestionDigest:
+    """
+    Sends admins batched digests of queued questions.
+    
+    Дайджест уходит раз в interval секунд, если есть новые вопросы, или раньше,
+    когда их накопилось batch_size - но не чаще чем раз в min_interval секунд.
+    """
+    
+    def __init__(self, queue: QuestionQueue, send: Callable[[int, str], Awaitable[bool]],
+                 admin_ids: List[int], interval: float = 900.0, min_interval: float = 300.0,
+                 batch_size: int = 20):
+        """
+        Args:
+            queue: Question queue
+            send: Coroutine sending text to an admin by user ID, returns True on success
+            admin_ids: User IDs of admins that receive digests
+            interval: Longest delay of a question before it is sent (seconds)
+            min_interval: Shortest time between two digests (seconds)
+            batch_size: Pending questions that trigger an early digest
+        """
+        self.queue = queue
+        self.send = send
+        self.admin_ids = list(admin_ids)
+        self.interval = interval
+        self.min_interval = min_interval
+        self.batch_size = batch_size
+        
+        self.digests_sent = 0
+        self._last_digest = 0.0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+    
+    def submit(self, text: str) -> Question:
+        """Queue a question from a user."""
+        question = self.queue.add(text)
+        if len(self.queue.pending) >= self.batch_size:
+            self._wakeup.set()
+        return question
+    
+    def start(self) -> None:
+        """Start the background digest task."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self) -> None:
+        """Stop the background task; undelivered questions stay in the queue."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.queue.close()
+    
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            
+            # Ограничение частоты: ранний дайджест ждет окончания min_interval
+            delay = self._last_digest + self.min_interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                await self.send_digest()
+            except Exception as e:
+                logger.error(f"Error sending question digest: {e}", exc_info=True)
+    
+    async def send_digest(self) -> bool:
+        """Send one digest to all admins; questions are dequeued if anyone received it."""
+        groups = self.queue.pending_groups()
+        if not groups or not self.admin_ids:
+            return False
+        
+        text, covered = build_digest(groups, self.queue.cluster_sizes)
+        delivered = 0
+        for admin_id in self.admin_ids:
+            try:
+                if await self.send(admin_id, text):
+                    delivered += 1
+            except Exception as e:
+                logger.error(f"Error sending question digest to {admin_id}: {e}")
+        
+        self._last_digest = time.monotonic()
+        if not delivered:
+            logger.warning("Question digest was not delivered to any admin, will retry")
+            return False
+        
+        self.queue.mark_sent(covered)
+        try:
+            self.queue.compact()
+        except OSError as e:
+            logger.error(f"Error compacting question log: {e}")
+        self.digests_sent += 1
+        logger.info(f"Question digest sent to {delivered}/{len(self.admin_ids)} admins: "
+                    f"{len(covered)} questions, {len(self.queue.pending)} left")
+        return True
@@ -0,0 +1,83 @@
+"""
+Event loop selection for the MAX bot.
+Runs the application on uvloop when it is installed and enables eager tasks on Python 3.12+.
+"""
+
+import asyncio
+import logging
+import sys
+from typing import Any, Callable, Coroutine, Optional
+
+logger = logging.getLogger(__name__)
+
+EVENT_LOOPS = ('auto', 'uvloop', 'asyncio')
+
+# asyncio.eager_task_factory появился в Python 3.12
+EAGER_TASKS_SUPPORTED = hasattr(asyncio, 'eager_task_factory')
+
+
+def get_loop_factory(event_loop: str = 'auto') -> Optional[Callable[[], asyncio.AbstractEventLoop]]:
+    """
+    Return event loop factory for the requested implementation.
+    
+    Args:
+        event_loop: 'auto' (uvloop if installed), 'uvloop' or 'asyncio'
+    
+    Returns:
+        Loop factory, or None for the standard asyncio loop
+    """
+    if event_loop not in EVENT_LOOPS:
+        raise ValueError(f"Unknown event loop: {event_loop}. Expected one of {', '.join(EVENT_LOOPS)}")
+    
+    if event_loop == 'asyncio':
+        return None
+    
+    try:
+        import uvloop
+    except ImportError:
+        # uvloop не поддерживает Windows и не входит в обязательные зависимости
+        if event_loop == 'uvloop':
+            logger.warning("uvloop is not installed, falling back to asyncio event loop")
+        return None
+    
+    return uvloop.new_event_loop
+
+
+async def _with_eager_tasks(main: Coroutine[Any, Any, Any]) -> Any:
+    # Задачи начинают выполняться сразу при создании, без лишнего прохода цикла
+    asyncio.get_running_loop().set_task_factory(asyncio.eager_task_factory)
+    return await main
+
+
+def describe_runtime(event_loop: str = 'auto', eager_tasks: bool = True) -> str:
+    """Human-readable description of the runtime that run() would use."""
+    loop_factory = get_loop_factory(event_loop)
+    name = 'uvloop' if loop_factory is not None else 'asyncio'
+    eager = eager_tasks and EAGER_TASKS_SUPPORTED
+    return f"{name}{' + eager tasks' if eager else ''} (Python {sys.version_info.major}.{sys.version_info.minor})"
+
+
+def run(main: Coroutine[Any, Any, Any], event_loop: str = 'auto', eager_tasks: bool = True) -> Any:
+    """
+    Run a coroutine to completion on the selected event loop.
+    
+    Замена asyncio.run(): выбирает реализацию цикла событий и фабрику задач.
+    
+    Args:
+        main: Coroutine to run
+        event_loop: 'auto' (uvloop if installed), 'uvloop' or 'asyncio'
+        eager_tasks: Use asyncio.eager_task_factory when available (Python 3.12+)
+    """
+    loop_factory = get_loop_factory(event_loop)
+    if eager_tasks and EAGER_TASKS_SUPPORTED:
+        main = _with_eager_tasks(main)
+    
+    # asyncio.Runner (Python 3.11+) принимает фабрику цикла напрямую
+    if hasattr(asyncio, 'Runner'):
+        with asyncio.Runner(loop_factory=loop_factory) as runner:
+            return runner.run(main)
+    
+    if loop_factory is not None:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return asyncio.run(main)
@@ -0,0 +1,249 @@
+"""
+Compact session representation.
+Stores user conversation data as small integer codes instead of dicts of strings.
+"""
+
+import struct
+import logging
+from typing import Dict, Any, Optional, Tuple
+
+from .states import BotStates
+
+logger = logging.getLogger(__name__)
+
+# Таблицы кодов. Код 0 означает "не выбрано", значение N кодируется индексом N.
+# Порядок менять нельзя (сохраненные сессии станут некорректными) - только добавлять в конец.
+
+STATE_VALUES: Tuple[str, ...] = (
+    None,
+    BotStates.MAIN_MENU.value,
+    BotStates.DEPENDENCY_SELECTION.value,
+    BotStates.TIME_ZONE_SELECTION.value,
+    BotStates.CITY_SELECTION.value,
+    BotStates.HELP_TYPE.value,
+    BotStates.HELP_CHOICE.value,
+    BotStates.LITERATURE_CHOICE.value,
+    BotStates.SUPPORT_OR_SPECIALIST.value,
+    BotStates.GENDER_PREFERENCE.value,
+    BotStates.AGE_USER.value,
+    BotStates.AGE_SPECIALIST_PREFERENCE.value,
+    BotStates.ONLINE_OFFLINE_GROUPS.value,
+    BotStates.DEPENDENCY_INFO.value,
+    BotStates.FAQ_ANSWERS.value,
+    BotStates.WEBINAR_SCHEDULE.value,
+    BotStates.HOW_FOUND_US.value,
+    BotStates.GROUP_NAME_INPUT.value,
+    BotStates.PSYCHOLOGIST_NAME_INPUT.value,
+    BotStates.ANONYMOUS_QUESTION_CHOICE.value,
+    BotStates.ANONYMOUS_QUESTION_INPUT.value,
+    BotStates.CONVERSATION_END.value,
+)
+
+DEPENDENCY_VALUES = (None, 'alcohol', 'drugs', 'gaming', 'food', 'internet', 'nicotine',
+                     'codependency', 'vad', 'love', 'workaholism', 'vr')
+
+TIMEZONE_VALUES = (None, 'msk', 'msk_plus_1', 'msk_plus_2', 'msk_plus_3', 'msk_plus_4', 'msk_plus_5',
+                   'msk_plus_6', 'msk_plus_7', 'msk_plus_8', 'msk_plus_9', 'msk_minus_1')
+
+CITY_VALUES = (None, 'moscow', 'spb', 'voronezh', 'krasnodar', 'kazan', 'samara', 'izhevsk',
+               'ekaterinburg', 'chelyabinsk', 'omsk', 'barnaul', 'novosibirsk', 'krasnoyarsk',
+               'irkutsk', 'ulan_ude', 'yakutsk', 'blagoveshchensk', 'vladivostok', 'khabarovsk',
+               'magadan', 'yuzhno_sakhalinsk', 'petropavlovsk', 'anadyr', 'kaliningrad')
+
+HELP_TYPE_VALUES = (None, 'info', 'groups_selection', 'specialist', 'faq', 'webinars')
+
+CONSULTATION_TYPE_VALUES = (None, 'specialist', 'psychologist')
+
+SOS_CHOICE_VALUES = (None, 'support_group', 'specialist')
+
+GENDER_VALUES = (None, 'male', 'female')
+
+AGE_USER_VALUES = (None, '16_18', '18_25', '25_35', '35_50', '50_plus')
+
+AGE_SPECIALIST_VALUES = (None, 'young', 'middle')
+
+LITERATURE_VALUES = (None, '12steps', 'new_glasses')
+
+DISCOVERY_SOURCE_VALUES = (None, 'friends', 'ads', 'psychologist', 'support_group', 'other')
+
+# Поля preferences, хранящиеся кодами: (ключ в preferences, таблица значений)
+PREFERENCE_FIELDS = (
+    ('dependency', DEPENDENCY_VALUES),
+    ('timezone', TIMEZONE_VALUES),
+    ('city', CITY_VALUES),
+    ('help_type', HELP_TYPE_VALUES),
+    ('consultation_type', CONSULTATION_TYPE_VALUES),
+    ('sos_choice', SOS_CHOICE_VALUES),
+    ('gender', GENDER_VALUES),
+    ('age_user', AGE_USER_VALUES),
+    ('age_specialist', AGE_SPECIALIST_VALUES),
+    ('literature', LITERATURE_VALUES),
+)
+
+# Текстовые поля user_data, которые пользователь вводит сам
+TEXT_FIELDS = ('group_name', 'psychologist_name', 'anonymous_question')
+
+# Битовые флаги: задано значение / значение True
+FLAG_WANTS_SUPPORT_SET = 0x01
+FLAG_WANTS_SUPPORT = 0x02
+FLAG_WANTS_LITERATURE_SET = 0x04
+FLAG_WANTS_LITERATURE = 0x08
+FLAG_HAS_PREFERENCES = 0x10
+
+SERIALIZATION_VERSION = 1
+
+# version, state, 10 кодов preferences, discovery_source, flags
+_HEADER = struct.Struct('<14B')
+_TEXT_LENGTH = struct.Struct('<H')
+
+_CODE_INDEX: Dict[int, Dict[str, int]] = {
+    id(table): {value: code for code, value in enumerate(table) if value is not None}
+    for table in (STATE_VALUES, DISCOVERY_SOURCE_VALUES) + tuple(table for _, table in PREFERENCE_FIELDS)
+}
+
+
+def encode_value(table: Tuple[Optional[str], ...], value: Optional[str]) -> int:
+    """Return the code of a value in a code table (0 for missing or unknown values)."""
+    if value is None:
+        return 0
+    code = _CODE_INDEX[id(table)].get(value)
+    if code is None:
+        logger.warning(f"Unknown session value {value!r}, storing as unset")
+        return 0
+    return code
+
+
+def decode_value(table: Tuple[Optional[str], ...], code: int) -> Optional[str]:
+    """Return the value for a code (None for 0 or codes outside the table)."""
+    return table[code] if 0 < code < len(table) else None
+
+
+class SessionRecord:
+    """Slotted, enum-coded representation of one user's session."""
+    
+    __slots__ = ('state', 'preferences', 'discovery_source', 'flags',
+                 'group_name', 'psychologist_name', 'anonymous_question')
+    
+    def __init__(self, state: int = 0, preferences: bytes = bytes(len(PREFERENCE_FIELDS)),
+                 discovery_source: int = 0, flags: int = 0,
+                 group_name: Optional[str] = None,
+                 psychologist_name: Optional[str] = None,
+                 anonymous_question: Optional[str] = None):
+        self.state = state
+        # Коды полей preferences в порядке PREFERENCE_FIELDS
+        self.preferences = preferences
+        self.discovery_source = discovery_source
+        self.flags = flags
+        self.group_name = group_name
+        self.psychologist_name = psychologist_name
+        self.anonymous_question = anonymous_question
+    
+    @classmethod
+    def from_user_data(cls, user_data: Dict[str, Any]) -> 'SessionRecord':
+        """Build a record from handler-style user_data dict."""
+        preferences = user_data.get('preferences')
+        flags = FLAG_HAS_PREFERENCES if preferences is not None else 0
+        preferences = preferences or {}
+        
+        for key, set_flag, value_flag in (('wants_support', FLAG_WANTS_SUPPORT_SET, FLAG_WANTS_SUPPORT),
+                                          ('wants_literature', FLAG_WANTS_LITERATURE_SET, FLAG_WANTS_LITERATURE)):
+            if key in preferences:
+                flags |= set_flag
+                if preferences[key]:
+                    flags |= value_flag
+        
+        return cls(
+            state=encode_value(STATE_VALUES, user_data.get('current_state')),
+            preferences=bytes(encode_value(table, preferences.get(key)) for key, table in PREFERENCE_FIELDS),
+            discovery_source=encode_value(DISCOVERY_SOURCE_VALUES, user_data.get('discovery_source')),
+            flags=flags,
+            group_name=user_data.get('group_name'),
+            psychologist_name=user_data.get('psychologist_name'),
+            anonymous_question=user_data.get('anonymous_question'),
+        )
+    
+    def to_user_data(self) -> Dict[str, Any]:
+        """Expand the record back into handler-style user_data dict."""
+        user_data: Dict[str, Any] = {}
+        
+        if self.flags & FLAG_HAS_PREFERENCES:
+            preferences: Dict[str, Any] = {}
+            for (key, table), code in zip(PREFERENCE_FIELDS, self.preferences):
+                value = decode_value(table, code)
+                if value is not None:
+                    preferences[key] = value
+            if self.flags & FLAG_WANTS_SUPPORT_SET:
+                preferences['wants_support'] = bool(self.flags & FLAG_WANTS_SUPPORT)
+            if self.flags & FLAG_WANTS_LITERATURE_SET:
+                preferences['wants_literature'] = bool(self.flags & FLAG_WANTS_LITERATURE)
+            user_data['preferences'] = preferences
+        
+        state = decode_value(STATE_VALUES, self.state)
+        if state is not None:
+            user_data['current_state'] = state
+        
+        discovery_source = decode_value(DISCOVERY_SOURCE_VALUES, self.discovery_source)
+        if discovery_source is not None:
+            user_data['discovery_source'] = discovery_source
+        
+        for key in TEXT_FIELDS:
+            value = getattr(self, key)
+            if value is not None:
+                user_data[key] = value
+        
+        return user_data
+    
+    @property
+    def current_state(self) -> Optional[str]:
+        """Current conversation state as BotStates value."""
+        return decode_value(STATE_VALUES, self.state)
+    
+    def to_bytes(self) -> bytes:
+        """Serialize the record into a compact binary form."""
+        parts = [_HEADER.pack(SERIALIZATION_VERSION, self.state, *self.preferences,
+                              self.discovery_source, self.flags)]
+        
+        for key in TEXT_FIELDS:
+            value = getattr(self, key)
+            # 0xFFFF - значение отсутствует
+            if value is None:
+                parts.append(_TEXT_LENGTH.pack(0xFFFF))
+            else:
+                encoded = value.encode('utf-8')[:0xFFFE]
+                parts.append(_TEXT_LENGTH.pack(len(encoded)))
+                parts.append(encoded)
+        
+        return b''.join(parts)
+    
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'SessionRecord':
+        """Deserialize a record produced by to_bytes()."""
+        header = _HEADER.unpack_from(data)
+        if header[0] != SERIALIZATION_VERSION:
+            raise ValueError(f"Unsupported session record version: {header[0]}")
+        
+        record = cls(
+            state=header[1],
+            preferences=bytes(header[2:2 + len(PREFERENCE_FIELDS)]),
+            discovery_source=header[-2],
+            flags=header[-1],
+        )
+        
+        offset = _HEADER.size
+        for key in TEXT_FIELDS:
+            (length,) = _TEXT_LENGTH.unpack_from(data, offset)
+            offset += _TEXT_LENGTH.size
+            if length == 0xFFFF:
+                continue
+            setattr(record, key, data[offset:offset + length].decode('utf-8', errors='replace'))
+            offset += length
+        
+        return record
+    
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, SessionRecord):
+            return NotImplemented
+        return all(getattr(self, slot) == getattr(other, slot) for slot in self.__slots__)
+    
+    def __repr__(self) -> str:
+        return f"SessionRecord(state={self.current_state!r}, data={self.to_user_data()!r})"
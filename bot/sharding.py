@@ -0,0 +1,338 @@
+"""
+Multi-process sharded runtime for the MAX bot.
+One poller distributes updates between worker processes by user_id.
+"""
+
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import signal
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Any, List, Optional, Callable
+
+from .max_adapter import MaxBot, MaxUpdate
+from .runtime import run as run_event_loop
+from .snapshot import RuntimeSnapshot, save_snapshot, load_snapshot
+
+logger = logging.getLogger(__name__)
+
+# Сообщения между супервизором и воркерами: (тип, данные)
+MSG_UPDATES = 'updates'
+MSG_STOP = 'stop'
+MSG_HEARTBEAT = 'heartbeat'
+
+
+def shard_for(user_id: Optional[int], shards: int) -> int:
+    """
+    Return the shard index of a user.
+    
+    Все updates одного пользователя попадают в один воркер, поэтому порядок
+    их обработки и сессия пользователя остаются в одном процессе.
+    Updates без пользователя идут в шард 0.
+    """
+    if not user_id or shards <= 1:
+        return 0
+    digest = hashlib.blake2b(int(user_id).to_bytes(8, 'little', signed=True), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') % shards
+
+
+def update_user_id(max_update: MaxUpdate) -> Optional[int]:
+    """Return user_id of an update, if any."""
+    user = max_update.effective_user
+    return user.get('id') if user else None
+
+
+def _worker_main(index: int, shards: int, connection, app_factory: Callable[..., Any],
+                 app_options: Dict[str, Any], heartbeat_interval: float,
+                 event_loop: str, eager_tasks: bool):
+    """Worker process entry point."""
+    # Ctrl+C получает вся группа процессов - остановкой воркеров управляет супервизор
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    run_event_loop(_worker_loop(index, shards, connection, app_factory, app_options, heartbeat_interval),
+                   event_loop=event_loop, eager_tasks=eager_tasks)
+
+
+async def _worker_loop(index: int, shards: int, connection, app_factory: Callable[..., Any],
+                       app_options: Dict[str, Any], heartbeat_interval: float):
+    """Process updates of one shard until the supervisor asks to stop."""
+    app = app_factory(**app_options)
+    processed = 0
+    
+    if app.session_writer is not None:
+        # Читаются только сессии своего шарда
+        app.restore_sessions(await asyncio.to_thread(
+            app.session_writer.load, lambda user_id: shard_for(user_id, shards) == index))
+    await app.start_services()
+    
+    async def heartbeat():
+        # Отправляется из цикла событий: зависший цикл перестанет слать heartbeat
+        while True:
+            connection.send((MSG_HEARTBEAT, processed))
+            await asyncio.sleep(heartbeat_interval)
+    
+    heartbeat_task = asyncio.create_task(heartbeat())
+    logger.info(f"Worker {index}/{shards} started")
+    
+    try:
+        while True:
+            kind, payload = await asyncio.to_thread(connection.recv)
+            if kind == MSG_STOP:
+                break
+            
+            for max_update in app.coalesce_updates(payload):
+                await app.process_update(max_update)
+                processed += 1
+    
+    except (EOFError, OSError):
+        logger.warning(f"Worker {index}: connection to supervisor lost")
+    
+    finally:
+        heartbeat_task.cancel()
+        await app.shutdown()
+        connection.close()
+
+
+@dataclass
+class WorkerHandle:
+    """Supervisor-side state of one worker process."""
+    
+    index: int
+    process: Any
+    connection: Any
+    last_heartbeat: float = field(default_factory=time.monotonic)
+    processed: int = 0
+    restarts: int = 0
+    reader: Optional[asyncio.Task] = None
+
+
+class ShardedSupervisor:
+    """
+    Polls MAX and routes updates to worker processes by user_id.
+    
+    Каждый воркер - отдельный процесс со своим MaxBotApplication, который
+    владеет сессиями своего шарда. Воркеры шлют heartbeat из цикла событий;
+    упавший или зависший воркер перезапускается с тем же номером шарда.
+    Сессии воркеров сохраняются через хранилище (DATABASE_URL), снимок
+    супервизора содержит только позицию опроса.
+    """
+    
+    def __init__(self, token: str, base_url: str, workers: int,
+                 app_factory: Callable[..., Any], app_options: Dict[str, Any],
+                 verify_ssl: bool = True,
+                 snapshot_path: Optional[str] = None,
+                 shutdown_timeout: float = 10.0,
+                 heartbeat_interval: float = 1.0,
+                 heartbeat_timeout: float = 15.0,
+                 event_loop: str = 'auto',
+                 eager_tasks: bool = True):
+        """
+        Args:
+            token: Bot token
+            base_url: MAX API base URL
+            workers: Number of worker processes
+            app_factory: Picklable callable creating MaxBotApplication in a worker
+            app_options: Keyword arguments for app_factory
+            verify_ssl: Verify SSL certificates
+            snapshot_path: File for the polling position snapshot
+            shutdown_timeout: Time for workers to finish their queues on shutdown (seconds)
+            heartbeat_interval: How often workers report they are alive (seconds)
+            heartbeat_timeout: Restart a worker silent for this long (seconds)
+            event_loop: Event loop of worker processes ('auto', 'uvloop' or 'asyncio')
+            eager_tasks: Use eager task factory in workers (Python 3.12+)
+        """
+        self.bot = MaxBot(token, base_url, verify_ssl=verify_ssl)
+        self.worker_count = workers
+        self.app_factory = app_factory
+        self.app_options = app_options
+        self.snapshot_path = snapshot_path
+        self.shutdown_timeout = shutdown_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.event_loop = event_loop
+        self.eager_tasks = eager_tasks
+        
+        # spawn - одинаково на всех платформах и без копии цикла событий родителя
+        self._mp_context = multiprocessing.get_context('spawn')
+        self.workers: List[WorkerHandle] = []
+        self._stopping = asyncio.Event()
+        self._poll_task: Optional[asyncio.Task] = None
+    
+    def _start_worker(self, index: int, restarts: int = 0) -> WorkerHandle:
+        """Spawn a worker process for a shard."""
+        parent_connection, child_connection = self._mp_context.Pipe()
+        process = self._mp_context.Process(
+            target=_worker_main,
+            args=(index, self.worker_count, child_connection, self.app_factory,
+                  self.app_options, self.heartbeat_interval, self.event_loop, self.eager_tasks),
+            name=f'maxbot-worker-{index}',
+            daemon=True
+        )
+        process.start()
+        child_connection.close()
+        
+        handle = WorkerHandle(index=index, process=process, connection=parent_connection, restarts=restarts)
+        handle.reader = asyncio.create_task(self._read_worker(handle))
+        logger.info(f"Started worker {index} (pid {process.pid})")
+        return handle
+    
+    async def _read_worker(self, handle: WorkerHandle):
+        """Receive heartbeats from a worker until its connection closes."""
+        while True:
+            try:
+                kind, payload = await asyncio.to_thread(handle.connection.recv)
+            except (EOFError, OSError):
+                return
+            if kind == MSG_HEARTBEAT:
+                handle.last_heartbeat = time.monotonic()
+                handle.processed = payload
+    
+    async def _restart_worker(self, handle: WorkerHandle, reason: str):
+        """Replace a dead or hung worker."""
+        logger.error(f"Worker {handle.index} {reason}, restarting (restarts so far: {handle.restarts})")
+        if handle.process.is_alive():
+            handle.process.kill()
+        await asyncio.to_thread(handle.process.join, 5)
+        handle.connection.close()
+        self.workers[handle.index] = self._start_worker(handle.index, handle.restarts + 1)
+    
+    async def _monitor(self):
+        """Check worker health and restart failed workers."""
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            now = time.monotonic()
+            for handle in list(self.workers):
+                if not handle.process.is_alive():
+                    await self._restart_worker(handle, f"exited with code {handle.process.exitcode}")
+                elif now - handle.last_heartbeat > self.heartbeat_timeout:
+                    await self._restart_worker(handle, "stopped sending heartbeats")
+    
+    async def _send(self, handle: WorkerHandle, updates: List[MaxUpdate]):
+        """Send a batch of updates to a worker."""
+        try:
+            await asyncio.to_thread(handle.connection.send, (MSG_UPDATES, updates))
+        except OSError as e:
+            # Воркер будет перезапущен монитором; эти updates потеряны
+            logger.error(f"Failed to send {len(updates)} updates to worker {handle.index}: {e}")
+    
+    async def dispatch(self, updates: List[MaxUpdate]):
+        """Split a batch by shard and hand it over to workers, preserving order within a shard."""
+        batches: List[List[MaxUpdate]] = [[] for _ in range(self.worker_count)]
+        for max_update in updates:
+            batches[shard_for(update_user_id(max_update), self.worker_count)].append(max_update)
+        
+        await asyncio.gather(*(self._send(self.workers[index], batch)
+                               for index, batch in enumerate(batches) if batch))
+    
+    def request_stop(self):
+        """Stop polling and let workers drain their queues."""
+        if self._stopping.is_set():
+            return
+        logger.info("Shutdown requested, stopping workers")
+        self._stopping.set()
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+    
+    async def _stop_workers(self):
+        """Ask workers to finish, terminate those that miss the deadline."""
+        for handle in self.workers:
+            try:
+                handle.connection.send((MSG_STOP, None))
+            except OSError:
+                pass
+        
+        deadline = time.monotonic() + self.shutdown_timeout
+        for handle in self.workers:
+            await asyncio.to_thread(handle.process.join, max(0.0, deadline - time.monotonic()))
+            if handle.process.is_alive():
+                logger.warning(f"Worker {handle.index} did not stop in time, terminating")
+                handle.process.terminate()
+                await asyncio.to_thread(handle.process.join, 5)
+        
+        for handle in self.workers:
+            if handle.reader is not None:
+                handle.reader.cancel()
+            handle.connection.close()
+        
+        logger.info(f"Workers stopped, processed: {[handle.processed for handle in self.workers]}")
+    
+    async def run(self):
+        """Run the poller and worker processes."""
+        logger.info(f"Starting MAX bot supervisor with {self.worker_count} workers...")
+        
+        bot_info = await self.bot.get_me()
+        if bot_info:
+            logger.info(f"Bot started: @{bot_info.get('username', 'unknown')}")
+        else:
+            logger.error("Failed to get bot info")
+            if self.bot.session:
+                await self.bot.session.close()
+            return
+        
+        if self.snapshot_path:
+            snapshot = load_snapshot(self.snapshot_path)
+            if snapshot is not None:
+                self.bot.last_marker = snapshot.marker
+                self.bot.last_update_id = snapshot.last_update_id
+        
+        self.workers = [self._start_worker(index) for index in range(self.worker_count)]
+        monitor_task = asyncio.create_task(self._monitor())
+        
+        loop = asyncio.get_running_loop()
+        installed_signals = []
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, self.request_stop)
+                installed_signals.append(sig)
+            except (NotImplementedError, RuntimeError):
+                pass
+        
+        try:
+            while not self._stopping.is_set():
+                self._poll_task = asyncio.ensure_future(self.bot.get_updates(timeout=30))
+                try:
+                    updates = await self._poll_task
+                except asyncio.CancelledError:
+                    if self._stopping.is_set():
+                        break
+                    raise
+                except Exception as e:
+                    logger.error(f"Error in polling loop: {e}", exc_info=True)
+                    try:
+                        await asyncio.wait_for(self._stopping.wait(), timeout=5)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                finally:
+                    self._poll_task = None
+                
+                if updates:
+                    logger.info(f"Received {len(updates)} updates")
+                    await self.dispatch(updates)
+        
+        except KeyboardInterrupt:
+            logger.info("Bot stopped by user")
+        
+        finally:
+            for sig in installed_signals:
+                loop.remove_signal_handler(sig)
+            
+            monitor_task.cancel()
+            await self._stop_workers()
+            
+            # Переданные воркерам updates считаются доставленными
+            if self.snapshot_path:
+                try:
+                    save_snapshot(self.snapshot_path, RuntimeSnapshot(
+                        marker=self.bot.last_marker,
+                        last_update_id=self.bot.last_update_id
+                    ))
+                except Exception as e:
+                    logger.error(f"Error saving snapshot: {e}", exc_info=True)
+            
+            if self.bot.capture is not None:
+                self.bot.capture.close()
+            
+            if self.bot.session:
+                await self.bot.session.close()
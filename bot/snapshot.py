@@ -0,0 +1,124 @@
+"""
+Runtime snapshot for the MAX bot.
+Saves polling position and user sessions on shutdown so a restart continues where it stopped.
+"""
+
+import json
+import logging
+import os
+import struct
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Any, Optional
+
+from .session import SessionRecord
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_MAGIC = b'MAXS'
+SNAPSHOT_VERSION = 1
+
+# magic, version, длина JSON-заголовка
+_PREFIX = struct.Struct('<4sBI')
+# количество записей
+_COUNT = struct.Struct('<I')
+# user_id, длина SessionRecord
+_SESSION_ENTRY = struct.Struct('<qH')
+# chat_id, версия клавиатуры
+_KEYBOARD_ENTRY = struct.Struct('<qH')
+
+
+@dataclass
+class RuntimeSnapshot:
+    """State of a MaxBotApplication needed to resume after restart."""
+    
+    marker: Optional[Any] = None  # marker, с которого нужно продолжить получение updates
+    last_update_id: int = 0  # последний полностью обработанный update
+    sessions: Dict[int, SessionRecord] = field(default_factory=dict)
+    keyboard_versions: Dict[int, int] = field(default_factory=dict)
+    created_at: float = 0.0
+
+
+def save_snapshot(path: str, snapshot: RuntimeSnapshot) -> None:
+    """
+    Write snapshot to disk atomically.
+    
+    Файл сначала пишется во временный, затем переименовывается - при падении
+    во время записи предыдущий снимок остается целым.
+    """
+    header = json.dumps({
+        'marker': snapshot.marker,
+        'last_update_id': snapshot.last_update_id,
+        'created_at': snapshot.created_at or time.time(),
+    }).encode('utf-8')
+    
+    parts = [_PREFIX.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(header)), header]
+    
+    parts.append(_COUNT.pack(len(snapshot.sessions)))
+    for user_id, record in snapshot.sessions.items():
+        data = record.to_bytes()
+        parts.append(_SESSION_ENTRY.pack(user_id, len(data)))
+        parts.append(data)
+    
+    parts.append(_COUNT.pack(len(snapshot.keyboard_versions)))
+    for chat_id, version in snapshot.keyboard_versions.items():
+        parts.append(_KEYBOARD_ENTRY.pack(chat_id, version))
+    
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(b''.join(parts))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    
+    logger.info(f"Snapshot saved to {path}: {len(snapshot.sessions)} sessions, marker={snapshot.marker}")
+
+
+def load_snapshot(path: str) -> Optional[RuntimeSnapshot]:
+    """Read snapshot from disk. Returns None if the file is missing or invalid."""
+    if not os.path.exists(path):
+        return None
+    
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        
+        magic, version, header_length = _PREFIX.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            logger.warning(f"Ignoring snapshot {path}: unsupported format")
+            return None
+        
+        offset = _PREFIX.size
+        header = json.loads(data[offset:offset + header_length].decode('utf-8'))
+        offset += header_length
+        
+        snapshot = RuntimeSnapshot(
+            marker=header.get('marker'),
+            last_update_id=header.get('last_update_id') or 0,
+            created_at=header.get('created_at') or 0.0
+        )
+        
+        (count,) = _COUNT.unpack_from(data, offset)
+        offset += _COUNT.size
+        for _ in range(count):
+            user_id, length = _SESSION_ENTRY.unpack_from(data, offset)
+            offset += _SESSION_ENTRY.size
+            snapshot.sessions[user_id] = SessionRecord.from_bytes(data[offset:offset + length])
+            offset += length
+        
+        (count,) = _COUNT.unpack_from(data, offset)
+        offset += _COUNT.size
+        for _ in range(count):
+            chat_id, version = _KEYBOARD_ENTRY.unpack_from(data, offset)
+            offset += _KEYBOARD_ENTRY.size
+            snapshot.keyboard_versions[chat_id] = version
+        
+        return snapshot
+    
+    except (OSError, ValueError, struct.error) as e:
+        logger.error(f"Failed to load snapshot {path}: {e}")
+        return None
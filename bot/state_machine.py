@@ -0,0 +1,350 @@
+"""
+Declarative conversation state machine.
+The transition table over BotStates is compiled at import into array-indexed dispatch tables
+shared by the Telegram (main.py) and MAX (main_max.py) front ends.
+"""
+
+import logging
+from array import array
+from collections import deque
+from dataclasses import dataclass
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+
+from .states import BotStates
+
+logger = logging.getLogger(__name__)
+
+# Шаблон перехода по текстовому сообщению (а не по кнопке)
+TEXT = None
+
+# ConversationHandler.END: обработчик завершил разговор
+END = -1
+
+# Сколько разных callback_data запоминать в кэше сопоставления с шаблонами
+PATTERN_CACHE_SIZE = 4096
+
+
+@dataclass(frozen=True)
+class Transition:
+    """
+    One edge of the conversation graph.
+    
+    pattern совпадает с callback_data целиком или с его началом по границе
+    '_' ('dep_' -> 'dep_alcohol', 'yes_support' -> 'yes_support_after_info');
+    из нескольких подходящих шаблонов выбирается самый длинный.
+    """
+    
+    pattern: Optional[str]  # callback_data или TEXT
+    handler: str  # имя метода BotHandlers
+    targets: Tuple[BotStates, ...]  # состояния, которые может вернуть обработчик
+    back: bool = False  # возврат к уже показанному экрану (см. bot/navigation.py)
+
+
+def _on(pattern: Optional[str], handler: str, *targets: BotStates) -> Transition:
+    return Transition(pattern, handler, targets)
+
+
+def _back(pattern: str, handler: str, *targets: BotStates) -> Transition:
+    return Transition(pattern, handler, targets, back=True)
+
+
+S = BotStates
+
+INITIAL_STATE = S.DEPENDENCY_SELECTION
+TERMINAL_STATES = frozenset({S.CONVERSATION_END})
+
+# Объявлены, но пока не используются диалогом - не считаются недостижимыми
+RESERVED_STATES = frozenset({S.MAIN_MENU, S.DEPENDENCY_INFO, S.FAQ_ANSWERS, S.WEBINAR_SCHEDULE})
+
+# Кнопки, которые работают в любом состоянии (если состояние не переопределяет шаблон)
+GLOBAL_TRANSITIONS: Tuple[Transition, ...] = (
+    _on('continue_to_discovery', 'handle_continue_to_discovery', S.HOW_FOUND_US),
+    _on('choose_support', 'handle_choose_support', S.SUPPORT_OR_SPECIALIST),
+    _on('choose_literature', 'handle_choose_literature', S.LITERATURE_CHOICE),
+    _on('skip_both', 'handle_skip_both', S.HOW_FOUND_US),
+    _on('continue_after_info', 'handle_continue_after_info', S.HELP_CHOICE),
+    _on('continue_after_literature', 'handle_continue_after_literature', S.HOW_FOUND_US),
+    _on('restart_conversation', 'handle_restart_conversation', S.DEPENDENCY_SELECTION),
+    _on('cancel_help', 'handle_cancel_help', S.DEPENDENCY_SELECTION),
+    _back('back_to_final', 'handle_back_to_final', S.CONVERSATION_END),
+    _back('back_to_help', 'handle_back_to_help', S.HELP_TYPE),
+    _back('back_to_city', 'back_to_city', S.CITY_SELECTION),
+    _back('back_to_timezones', 'back_to_timezones', S.TIME_ZONE_SELECTION),
+    _back('back_to_dependency', 'back_to_dependency', S.DEPENDENCY_SELECTION),
+    _on('final_faq', 'handle_final_faq', S.CONVERSATION_END),
+    _on('final_webinars', 'handle_final_webinars', S.CONVERSATION_END),
+)
+
+TRANSITIONS: Dict[BotStates, Tuple[Transition, ...]] = {
+    S.DEPENDENCY_SELECTION: (
+        _on('dep_', 'handle_dependency_selection', S.TIME_ZONE_SELECTION),
+    ),
+    S.TIME_ZONE_SELECTION: (
+        _on('timezone_', 'handle_timezone_selection', S.CITY_SELECTION),
+    ),
+    S.CITY_SELECTION: (
+        _on('city_', 'handle_city_selection', S.HELP_TYPE),
+    ),
+    S.HELP_TYPE: (
+        _on('help_', 'handle_help_type', S.HELP_CHOICE, S.HELP_TYPE, S.GENDER_PREFERENCE),
+    ),
+    S.HELP_CHOICE: (
+        _on('yes_support', 'handle_support_choice_after_info', S.LITERATURE_CHOICE),
+        _on('no_support', 'handle_support_choice_after_info', S.LITERATURE_CHOICE),
+        _back('back_from_support', 'handle_back_to_help', S.HELP_TYPE),
+    ),
+    S.LITERATURE_CHOICE: (
+        _on('lit_', 'handle_literature_selection', S.LITERATURE_CHOICE),
+        _on('yes_literature_after_info', 'handle_literature_choice_after_info',
+            S.SUPPORT_OR_SPECIALIST, S.LITERATURE_CHOICE, S.HOW_FOUND_US),
+        _on('no_literature_after_info', 'handle_literature_choice_after_info',
+            S.SUPPORT_OR_SPECIALIST, S.LITERATURE_CHOICE, S.HOW_FOUND_US),
+        _on('yes_literature', 'handle_literature_choice', S.LITERATURE_CHOICE, S.HOW_FOUND_US),
+        _on('no_literature', 'handle_literature_choice', S.LITERATURE_CHOICE, S.HOW_FOUND_US),
+        _back('back_from_literature', 'handle_back_to_help', S.HELP_TYPE),
+    ),
+    S.SUPPORT_OR_SPECIALIST: (
+        _on('sos_', 'handle_support_or_specialist', S.ONLINE_OFFLINE_GROUPS, S.GENDER_PREFERENCE),
+    ),
+    S.GENDER_PREFERENCE: (
+        _on('gender_', 'handle_gender_selection', S.AGE_USER),
+        _back('back_from_gender', 'back_from_gender', S.SUPPORT_OR_SPECIALIST, S.HELP_TYPE),
+    ),
+    S.AGE_USER: (
+        _on('ageu_', 'handle_age_user', S.AGE_USER, S.AGE_SPECIALIST_PREFERENCE),
+        _back('back_to_gender', 'back_to_gender', S.GENDER_PREFERENCE),
+    ),
+    S.AGE_SPECIALIST_PREFERENCE: (
+        _on('ages_', 'handle_age_specialist', S.AGE_SPECIALIST_PREFERENCE),
+        _back('back_to_age_user', 'back_to_age_user', S.AGE_USER),
+    ),
+    S.ONLINE_OFFLINE_GROUPS: (
+        _on('continue_to_discovery', 'handle_continue_to_discovery', S.HOW_FOUND_US),
+    ),
+    S.HOW_FOUND_US: (
+        _on('found_', 'handle_discovery_answer',
+            S.GROUP_NAME_INPUT, S.PSYCHOLOGIST_NAME_INPUT, S.ANONYMOUS_QUESTION_CHOICE),
+    ),
+    S.GROUP_NAME_INPUT: (
+        _on(TEXT, 'handle_group_name_input', S.ANONYMOUS_QUESTION_CHOICE),
+    ),
+    S.PSYCHOLOGIST_NAME_INPUT: (
+        _on(TEXT, 'handle_psychologist_name_input', S.ANONYMOUS_QUESTION_CHOICE),
+    ),
+    S.ANONYMOUS_QUESTION_CHOICE: (
+        _on('yes_anon_question', 'handle_anonymous_question_choice', S.ANONYMOUS_QUESTION_INPUT),
+        _on('no_anon_question', 'handle_anonymous_question_choice', S.CONVERSATION_END),
+    ),
+    S.ANONYMOUS_QUESTION_INPUT: (
+        _on(TEXT, 'handle_anonymous_question_input', S.CONVERSATION_END),
+    ),
+    S.CONVERSATION_END: (),
+}
+
+# Команда /back: обработчик кнопки "Назад" для каждого состояния (pattern - ее callback_data)
+BACK_TRANSITIONS: Dict[BotStates, Transition] = {
+    S.TIME_ZONE_SELECTION: _back('back_to_dependency', 'back_to_dependency', S.DEPENDENCY_SELECTION),
+    S.CITY_SELECTION: _back('back_to_timezones', 'back_to_timezones', S.TIME_ZONE_SELECTION),
+    S.HELP_TYPE: _back('back_to_city', 'back_to_city', S.CITY_SELECTION),
+    S.HELP_CHOICE: _back('back_to_help', 'back_to_help', S.HELP_TYPE),
+    S.LITERATURE_CHOICE: _back('back_to_help', 'back_to_help', S.HELP_TYPE),
+    S.SUPPORT_OR_SPECIALIST: _back('back_to_help', 'back_to_help', S.HELP_TYPE),
+    S.GENDER_PREFERENCE: _back('back_from_gender', 'back_from_gender', S.SUPPORT_OR_SPECIALIST, S.HELP_TYPE),
+    S.AGE_USER: _back('back_to_gender', 'back_to_gender', S.GENDER_PREFERENCE),
+    S.AGE_SPECIALIST_PREFERENCE: _back('back_to_age_user', 'back_to_age_user', S.AGE_USER),
+}
+
+
+def _pattern_prefixes(data: str) -> Iterable[str]:
+    """Prefixes of callback_data that a pattern may equal, longest first."""
+    yield data
+    end = data.rfind('_')
+    while end > 0:
+        yield data[:end + 1]
+        yield data[:end]
+        end = data.rfind('_', 0, end)
+
+
+class StateMachine:
+    """
+    Compiled transition table.
+    
+    Состояния и шаблоны нумеруются при компиляции; переход ищется в плоском
+    массиве по индексу state * число_шаблонов + шаблон. Сопоставление
+    callback_data с шаблоном кэшируется - payload кнопок повторяются.
+    """
+    
+    def __init__(self, transitions: Dict[BotStates, Tuple[Transition, ...]],
+                 global_transitions: Tuple[Transition, ...] = (),
+                 back_transitions: Optional[Dict[BotStates, Transition]] = None,
+                 initial_state: BotStates = INITIAL_STATE,
+                 terminal_states: Iterable[BotStates] = TERMINAL_STATES,
+                 reserved_states: Iterable[BotStates] = ()):
+        self.table = transitions
+        self.global_transitions = global_transitions
+        self.back = back_transitions or {}
+        self.initial_state = initial_state
+        self.terminal_states = frozenset(terminal_states)
+        self.reserved_states = frozenset(reserved_states)
+        
+        self.states: List[BotStates] = list(BotStates)
+        self.state_index: Dict[str, int] = {state.value: index for index, state in enumerate(self.states)}
+        
+        # Все переходы получают номера; таблицы хранят номер перехода или -1
+        self.transitions: List[Transition] = []
+        self._transition_ids: Dict[Transition, int] = {}
+        self.patterns: Dict[str, int] = {}
+        for transition in self._all_transitions():
+            if transition not in self._transition_ids:
+                self._transition_ids[transition] = len(self.transitions)
+                self.transitions.append(transition)
+            if transition.pattern is not TEXT and transition.pattern not in self.patterns:
+                self.patterns[transition.pattern] = len(self.patterns)
+        
+        state_count = len(self.states)
+        self._pattern_count = len(self.patterns)
+        self._callbacks = array('h', [-1]) * (state_count * self._pattern_count)
+        self._texts = array('h', [-1]) * state_count
+        self._backs = array('h', [-1]) * state_count
+        
+        for state in self.states:
+            base = self.state_index[state.value] * self._pattern_count
+            for transition in global_transitions:
+                self._callbacks[base + self.patterns[transition.pattern]] = self._transition_ids[transition]
+            # Переходы состояния переопределяют глобальные с тем же шаблоном
+            for transition in transitions.get(state, ()):
+                transition_id = self._transition_ids[transition]
+                if transition.pattern is TEXT:
+                    self._texts[self.state_index[state.value]] = transition_id
+                else:
+                    self._callbacks[base + self.patterns[transition.pattern]] = transition_id
+            if state in self.back:
+                self._backs[self.state_index[state.value]] = self._transition_ids[self.back[state]]
+        
+        self._pattern_cache: Dict[str, int] = {}
+    
+    def _all_transitions(self) -> Iterable[Transition]:
+        yield from self.global_transitions
+        for state_transitions in self.table.values():
+            yield from state_transitions
+        yield from self.back.values()
+    
+    def _pattern_id(self, data: str) -> int:
+        pattern_id = self._pattern_cache.get(data)
+        if pattern_id is None:
+            pattern_id = -1
+            for prefix in _pattern_prefixes(data):
+                if prefix in self.patterns:
+                    pattern_id = self.patterns[prefix]
+                    break
+            if len(self._pattern_cache) < PATTERN_CACHE_SIZE:
+                self._pattern_cache[data] = pattern_id
+        return pattern_id
+    
+    def resolve_callback(self, state: Optional[str], data: Optional[str]) -> int:
+        """Transition id for a button press in a state, -1 if the button is not valid there."""
+        state_index = self.state_index.get(state)
+        if state_index is None or not data:
+            return -1
+        pattern_id = self._pattern_id(data)
+        if pattern_id < 0:
+            return -1
+        return self._callbacks[state_index * self._pattern_count + pattern_id]
+    
+    def resolve_text(self, state: Optional[str]) -> int:
+        """Transition id for a text message in a state, -1 if the state expects buttons."""
+        state_index = self.state_index.get(state)
+        return self._texts[state_index] if state_index is not None else -1
+    
+    def resolve_back(self, state: Optional[str]) -> int:
+        """Transition id of the /back command in a state, -1 if there is no step back."""
+        state_index = self.state_index.get(state)
+        return self._backs[state_index] if state_index is not None else -1
+    
+    def transition_id(self, transition: Transition) -> int:
+        """Number of a transition in self.transitions."""
+        return self._transition_ids[transition]
+    
+    def state_transitions(self, state: BotStates) -> List[Transition]:
+        """Callback and text transitions active in a state, state-specific first."""
+        own = list(self.table.get(state, ()))
+        own_patterns = {transition.pattern for transition in own}
+        return own + [transition for transition in self.global_transitions
+                      if transition.pattern not in own_patterns]
+    
+    def bind(self, handlers: Any) -> List[Any]:
+        """Resolve handler names to bound methods, indexed by transition id."""
+        missing = sorted({transition.handler for transition in self.transitions
+                          if not callable(getattr(handlers, transition.handler, None))})
+        if missing:
+            raise ValueError(f"State machine refers to missing handlers: {', '.join(missing)}")
+        return [getattr(handlers, transition.handler) for transition in self.transitions]
+    
+    def validate(self) -> List[str]:
+        """Describe problems of the transition graph (empty list if there are none)."""
+        problems = []
+        
+        # Цель перехода - только член BotStates: строка или опечатка не дойдет до таблиц
+        for transition in self.transitions:
+            for target in transition.targets:
+                if not isinstance(target, BotStates):
+                    problems.append(f"{transition.handler}: unknown target state {target!r}")
+        
+        def successors(state: BotStates) -> Iterable[BotStates]:
+            transitions = self.state_transitions(state)
+            if state in self.back:
+                transitions.append(self.back[state])
+            for transition in transitions:
+                yield from (target for target in transition.targets if isinstance(target, BotStates))
+        
+        reachable = {self.initial_state}
+        queue = deque([self.initial_state])
+        while queue:
+            for target in successors(queue.popleft()):
+                if target not in reachable:
+                    reachable.add(target)
+                    queue.append(target)
+        
+        for state in self.states:
+            if state in self.reserved_states:
+                continue
+            if state not in reachable:
+                problems.append(f"{state.value}: unreachable from {self.initial_state.value}")
+            elif state not in self.terminal_states and not self.table.get(state):
+                problems.append(f"{state.value}: dead end (no transitions of its own)")
+        
+        # Из каждого достижимого состояния должен быть путь до завершения диалога
+        finishing = set(self.terminal_states)
+        changed = True
+        while changed:
+            changed = False
+            for state in reachable - finishing:
+                if any(target in finishing for target in successors(state)):
+                    finishing.add(state)
+                    changed = True
+        for state in sorted(reachable - finishing, key=lambda item: item.value):
+            problems.append(f"{state.value}: no path to {', '.join(s.value for s in self.terminal_states)}")
+        
+        return problems
+    
+    @classmethod
+    def compile(cls) -> 'StateMachine':
+        """Compile the module transition table and fail fast if the graph is broken."""
+        machine = cls(TRANSITIONS, GLOBAL_TRANSITIONS, BACK_TRANSITIONS,
+                      initial_state=INITIAL_STATE, terminal_states=TERMINAL_STATES,
+                      reserved_states=RESERVED_STATES)
+        problems = machine.validate()
+        if problems:
+            raise ValueError("Invalid conversation state machine:\n" + "\n".join(problems))
+        return machine
+
+
+def record_state(user_data: Dict[str, Any], new_state: Any) -> None:
+    """Store the state returned by a handler as the user's current state."""
+    if isinstance(new_state, str):
+        user_data['current_state'] = new_state
+    elif new_state == END:
+        user_data.pop('current_state', None)
+
+
+STATE_MACHINE = StateMachine.compile()
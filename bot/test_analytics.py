@@ -0,0 +1,73 @@
+"""Tests for funnel analytics: event segments and counters."""
+
+import asyncio
+
+from bot.analytics import (
+    SEGMENT_MAGIC, EventLog, FunnelAggregator, FunnelAnalytics, TransitionEvent, encode_event, read_events,
+)
+
+EVENTS = [
+    TransitionEvent(1.0, 7, None, 'dependency_selection', (None, None), (None, None), -1),
+    TransitionEvent(4.5, 7, 'dependency_selection', 'time_zone_selection', (None, None), ('alcohol', None), 3.5,
+                    'dep_alcohol'),
+    TransitionEvent(9.0, 7, 'time_zone_selection', None, ('alcohol', None), ('alcohol', 'msk'), 4.5, 'timezone_msk'),
+]
+
+
+def _write_segment(path, data: bytes) -> None:
+    with open(path, 'wb') as file:
+        file.write(SEGMENT_MAGIC + data)
+
+
+def test_event_log_round_trip(tmp_path):
+    log = EventLog(str(tmp_path))
+    for event in EVENTS:
+        log.record(event)
+    asyncio.run(log.stop())
+    assert list(read_events([str(tmp_path)])) == EVENTS
+
+
+def test_truncated_tail_is_skipped(tmp_path):
+    data = b''.join(encode_event(event) for event in EVENTS)
+    path = tmp_path / 'events.bin'
+    # Оборвана последняя запись: целиком прочитаны только первые две
+    for cut in (1, len(encode_event(EVENTS[-1])) - 1):
+        _write_segment(path, data[:-cut])
+        for chunk_size in (7, 1024):
+            assert list(read_events([str(path)], chunk_size=chunk_size)) == EVENTS[:2]
+
+
+def test_foreign_file_is_skipped(tmp_path):
+    path = tmp_path / 'other.bin'
+    path.write_bytes(b'not a segment')
+    assert list(read_events([str(path)])) == []
+
+
+def test_funnel_counters():
+    aggregator = FunnelAggregator()
+    aggregator.add_many(EVENTS)
+    steps = aggregator.steps()
+    assert (steps['dependency_selection'].entered, steps['dependency_selection'].left) == (1, 1)
+    assert steps['dependency_selection'].dwell_quantile(0.5) == 5
+    # Выход из шага учитывается в когорте до перехода
+    assert aggregator.steps(dependency='alcohol')['time_zone_selection'].left == 1
+    assert 'dependency_selection' not in aggregator.steps(dependency='alcohol')
+    
+    merged = FunnelAggregator()
+    merged.merge(aggregator)
+    merged.merge(aggregator)
+    assert merged.events == 6 and merged.steps()['time_zone_selection'].entered == 2
+
+
+def test_step_start_is_kept_outside_the_session():
+    analytics = FunnelAnalytics(max_users=2)
+    assert analytics.enter_step(1, 10.0, True) == -1
+    assert analytics.enter_step(1, 14.0, True) == 4.0
+    assert analytics.enter_step(1, 15.0, False) == 1.0
+    assert analytics.enter_step(1, 16.0, True) == -1
+    
+    # Самый давний пользователь вытесняется
+    analytics.enter_step(2, 17.0, True)
+    analytics.enter_step(3, 18.0, True)
+    assert analytics.enter_step(1, 20.0, True) == -1
+    assert analytics.enter_step(3, 20.0, True) == 2.0
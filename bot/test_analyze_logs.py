@@ -0,0 +1,55 @@
+"""Tests for the bot.log analyzer (analyze_logs.py)."""
+
+import pytest
+
+from analyze_logs import Histogram, LogAnalyzer
+
+
+def _line(second: int, millis: int, message: str, level: str = 'INFO') -> str:
+    return f"2025-01-01 12:{second // 60:02d}:{second % 60:02d},{millis:03d} - main_max - {level} - {message}\n"
+
+
+def _analyze(lines) -> LogAnalyzer:
+    analyzer = LogAnalyzer(window=60)
+    analyzer.feed(''.join(lines).encode('utf-8'))
+    analyzer.finish()
+    return analyzer
+
+
+def _update(second: int, user_id: int, reply: str):
+    return [
+        _line(second, 0, 'Processing update: 1, type: message_created'),
+        _line(second, 1, f'User ID: {user_id}'),
+        _line(second, 5, f'Sending message to chat_id={user_id}, text length=10, has_buttons=False'),
+        _line(second, 20, reply, 'ERROR' if reply.startswith('Send message error') else 'INFO'),
+    ]
+
+
+def test_replied_updates():
+    analyzer = _analyze(_update(1, 7, 'Message sent successfully, response: m1') +
+                        _update(2, 8, 'Message sent successfully, response: m2'))
+    assert analyzer.update_latency.total == 2 and analyzer.unanswered == 0
+    assert analyzer.update_latency.quantile(0.5) == pytest.approx(20, abs=0.01)
+
+
+def test_failed_reply_counts_as_unanswered():
+    # Второй update того же пользователя не должен скрывать первый, оставшийся без ответа
+    lines = []
+    for second in range(200):
+        user_id = second % 7
+        failed = second % 10 == 0
+        lines += _update(second, user_id, 'Send message error 500: boom' if failed
+                         else f'Message sent successfully, response: m{second}')
+    analyzer = _analyze(lines)
+    assert analyzer.update_latency.total == 180
+    assert analyzer.unanswered == 20
+    assert analyzer.send_latency.total == 200
+
+
+def test_quantiles_stay_within_observed_range():
+    histogram = Histogram()
+    for value in (100, 105, 110):
+        histogram.add(value)
+    assert 100 <= histogram.quantile(0.5) <= 110
+    assert histogram.quantile(0.99) <= histogram.max == 110
+    assert Histogram().quantile(0.5) is None
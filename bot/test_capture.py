@@ -0,0 +1,91 @@
+"""Tests for PII redaction of captured updates."""
+
+from bot.capture import pseudonymize, redact_update
+from bot.max_adapter import MaxBot
+
+SALT = b'test-salt'
+
+
+def _message(user_id, text, **body):
+    return {
+        'sender': {'user_id': user_id, 'first_name': 'Мария', 'last_name': 'Иванова',
+                   'username': 'maria', 'avatar_url': 'https://example.com/a.jpg', 'description': 'о себе'},
+        'recipient': {'chat_id': user_id + 1000, 'chat_type': 'dialog'},
+        'body': {'mid': 'mid.1', 'text': text, **body},
+    }
+
+
+def test_profile_fields_removed_and_ids_pseudonymized():
+    redacted = redact_update({'update_type': 'message_created', 'timestamp': 7,
+                              'message': _message(42, 'Привет')}, SALT)
+    
+    sender = redacted['message']['sender']
+    assert sender == {'user_id': pseudonymize(42, SALT), 'first_name': 'User'}
+    assert redacted['message']['recipient'] == {'chat_id': pseudonymize(1042, SALT), 'chat_type': 'dialog'}
+    # Поля платформы сохраняются для воспроизведения
+    assert redacted['timestamp'] == 7
+    assert redacted['message']['body']['mid'] == 'mid.1'
+
+
+def test_text_masked_with_length_and_whitespace():
+    redacted = redact_update(_message(1, 'Муж пьет, что делать?'), SALT)
+    assert redacted['body']['text'] == 'xxx xxxx, xxx xxxxxx?'
+
+
+def test_command_kept_without_arguments():
+    assert redact_update(_message(1, '/start'), SALT)['body']['text'] == '/start'
+    assert redact_update(_message(1, '/start ref_Мария'), SALT)['body']['text'] == '/start'
+
+
+def test_attachments_keep_only_type():
+    redacted = redact_update(_message(1, '', attachments=[
+        {'type': 'image', 'payload': {'url': 'https://example.com/photo.jpg', 'token': 'secret'}},
+        {'type': 'contact', 'payload': {'vcf_info': 'TEL:+79990000000'}},
+        'broken',
+    ]), SALT)
+    assert redacted['body']['attachments'] == [{'type': 'image'}, {'type': 'contact'}]
+
+
+def test_nested_forwarded_message_redacted():
+    forwarded = _message(77, 'Я больше не могу')
+    message = {**_message(1, 'Смотрите'), 'link': {'type': 'forward', **forwarded}}
+    callback = {'callback_id': 'cb.1', 'payload': 'dep_alcohol',
+                'user': {'user_id': 1, 'first_name': 'Мария', 'username': 'maria'}}
+    
+    redacted = redact_update({'update_type': 'message_callback', 'callback': callback, 'message': message}, SALT)
+    
+    link = redacted['message']['link']
+    assert link['type'] == 'forward'
+    assert link['sender'] == {'user_id': pseudonymize(77, SALT), 'first_name': 'User'}
+    assert link['body']['text'] == 'x xxxxxx xx xxxx'
+    assert redacted['callback'] == {'callback_id': 'cb.1', 'payload': 'dep_alcohol',
+                                    'user': {'user_id': pseudonymize(1, SALT), 'first_name': 'User'}}
+
+
+def test_pseudonyms_stable_within_salt():
+    first = redact_update(_message(42, 'a'), SALT)
+    second = redact_update(_message(42, 'b'), SALT)
+    other_user = redact_update(_message(43, 'a'), SALT)
+    other_salt = redact_update(_message(42, 'a'), b'other-salt')
+    
+    assert first['sender']['user_id'] == second['sender']['user_id']
+    assert first['sender']['user_id'] != other_user['sender']['user_id']
+    assert first['sender']['user_id'] != other_salt['sender']['user_id']
+    assert 0 < first['sender']['user_id'] < 2 ** 63
+
+
+def test_original_update_not_modified():
+    message = _message(42, 'Привет')
+    redact_update(message, SALT)
+    assert message['sender']['first_name'] == 'Мария'
+    assert message['body']['text'] == 'Привет'
+
+
+def test_parse_update_from_redacted_capture():
+    data = {'update_type': 'message_callback', 'timestamp': 5, 'message_callback': {'payload': 'x'},
+            'message': _message(1, 'текст')}
+    update = MaxBot.parse_update(redact_update(data, SALT))
+    
+    assert (update.update_id, update.timestamp, update.update_type) == (5, 5, 'message_callback')
+    assert update.callback_query == {'payload': 'x'}
+    assert update.message['sender']['first_name'] == 'User'
@@ -0,0 +1,55 @@
+"""Tests for crisis phrase detection."""
+
+import pytest
+
+from bot.crisis import CrisisDetector, load_lexicon, normalize
+
+DETECTOR = CrisisDetector()
+
+
+@pytest.mark.parametrize('text, phrase', [
+    ('Я больше не хочу жить так', 'не хочу жить'),
+    ('иногда думаю покончить с собой', 'покончить с собой'),
+    ('у сына был передоз на прошлой неделе', 'передоз'),
+    ('хочу умерееееть', 'хочу умереть'),
+    ('ПОВЕСИЛСЯ друг', 'повеситься'),
+    ('хочу пoвecитьcя', 'повеситься'),  # латинские o, e, c
+    ('жыть нехочу', 'жить нехочу'),
+    ('у него суицидальные мысли', 'суицид'),
+    ('вскрыла вены', 'вскрыл вены'),
+    ('хочу уйти из жизни', 'уйти из жизни'),
+])
+def test_crisis_phrases(text, phrase):
+    assert DETECTOR.find(text) == phrase
+
+
+@pytest.mark.parametrize('text', [
+    'Читаю повесть Чехова',
+    'Повесила шторы',
+    'режу себе хлеб',
+    'уйти из жизни наркотиков',
+    'Как помочь мужу, если он не признает, что пьет?',
+    '',
+])
+def test_ordinary_texts(text):
+    assert DETECTOR.find(text) is None
+
+
+def test_find_all():
+    assert DETECTOR.find_all('не хочу жить, хочу умереть, не хочу жить') == ['не хочу жить', 'хочу умереть']
+
+
+def test_short_words_are_not_stemmed():
+    assert normalize('себе себя') == ['себе', 'себя']
+    assert normalize('повесила повеситься') == ['павес', 'павесся']
+
+
+def test_lexicon_file(tmp_path):
+    path = tmp_path / 'lexicon.txt'
+    path.write_text('# Комментарий\nуйти из жизни\n\n- из жизни зависимого  # исключение\n', encoding='utf-8')
+    phrases, exclusions = load_lexicon(str(path))
+    assert (phrases, exclusions) == (['уйти из жизни'], ['из жизни зависимого'])
+    
+    detector = CrisisDetector(phrases, exclusions)
+    assert detector.find('хочу уйти из жизни зависимого') is None
+    assert detector.find('хочу уйти из жизни') == 'уйти из жизни'
@@ -0,0 +1,88 @@
+"""Tests for the partitioned answer export."""
+
+import csv
+import logging
+from datetime import datetime, timezone
+
+import pytest
+
+from bot.analytics import TransitionEvent
+from bot.capture import pseudonymize
+from bot.export import COLUMNS, events_between, export_answers, parse_choice
+
+DAY = 86400.0
+# 2025-01-01 00:00 UTC
+START = datetime(2025, 1, 1, tzinfo=timezone.utc).timestamp()
+
+
+def _event(t, user_id=7, choice='timezone_msk'):
+    return TransitionEvent(t, user_id, 'time_zone_selection', 'city_selection',
+                           ('alcohol', None), ('alcohol', 'msk'), 1.0, choice)
+
+
+def _interleaved(count=1000, days=3):
+    # Дни идут вперемешку: событие i попадает в день i % days
+    return [_event(START + (i % days) * DAY + i, user_id=i % 50) for i in range(count)]
+
+
+def _read(path):
+    with open(path, encoding='utf-8', newline='') as file:
+        return list(csv.reader(file))
+
+
+def test_parse_choice():
+    assert parse_choice('timezone_msk') == ('timezone', 'msk')
+    assert parse_choice('dep_alcohol') == ('dependency', 'alcohol')
+    assert parse_choice('dep_unknown') is None
+    assert parse_choice('restart_conversation') is None
+
+
+def test_csv_rows(tmp_path):
+    events = [_event(START + 1.5, choice='dep_alcohol'), _event(START + 2, choice='back_to_city'),
+              _event(START + 3, user_id=8)]
+    stats = export_answers(events, str(tmp_path), salt='s')
+    
+    assert stats.rows == 2 and stats.partitions == {'2025-01-01': 2}
+    rows = _read(tmp_path / 'date=2025-01-01' / 'part-0000.csv')
+    assert rows[0] == list(COLUMNS)
+    assert rows[1] == ['2025-01-01T00:00:01.500+00:00', str(pseudonymize(7, b's')), 'time_zone_selection',
+                       'dependency', 'alcohol', 'alcohol', 'msk']
+    assert rows[2][1:5] == [str(pseudonymize(8, b's')), 'time_zone_selection', 'timezone', 'msk']
+
+
+def test_closed_csv_partition_is_appended(tmp_path):
+    stats = export_answers(_interleaved(), str(tmp_path), salt='s', batch_rows=10, max_open_partitions=1)
+    
+    assert stats.rows == 1000
+    assert sorted(stats.partitions.values()) == [333, 333, 334]
+    assert len(stats.files) == 3
+    for path in stats.files:
+        rows = _read(path)
+        # Заголовок один, в начале файла
+        assert rows[0] == list(COLUMNS) and list(COLUMNS) not in rows[1:]
+    assert sum(len(_read(path)) - 1 for path in stats.files) == 1000
+
+
+def test_existing_parts_are_not_overwritten(tmp_path):
+    first = export_answers([_event(START)], str(tmp_path), salt='s')
+    second = export_answers([_event(START + 1)], str(tmp_path), salt='s')
+    assert [path.rsplit('/', 1)[1] for path in first.files + second.files] == ['part-0000.csv', 'part-0001.csv']
+
+
+def test_since_until(tmp_path):
+    events = events_between(_interleaved(), since=START + DAY, until=START + 2 * DAY)
+    stats = export_answers(events, str(tmp_path), salt='s')
+    assert stats.partitions == {'2025-01-02': 333}
+    assert len(stats.files) == 1
+    
+    assert [event.t for event in events_between([_event(START), _event(START + DAY)], until=START + DAY)] == [START]
+    assert len(list(events_between(_interleaved(30)))) == 30
+
+
+def test_closed_parquet_partition_warns(tmp_path, caplog):
+    pytest.importorskip('pyarrow')
+    with caplog.at_level(logging.WARNING, logger='bot.export'):
+        stats = export_answers(_interleaved(30), str(tmp_path), 'parquet', salt='s', max_open_partitions=1)
+    assert stats.rows == 30
+    assert len(stats.files) == 30
+    assert sum('increase max_open_partitions' in record.message for record in caplog.records) == 1
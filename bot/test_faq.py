@@ -0,0 +1,62 @@
+"""Tests for the Russian stemmer and the BM25 FAQ index."""
+
+import pytest
+
+from bot.faq import FaqEntry, FaqIndex, render_faq, stem, tokenize
+
+
+# Пары из словаря эталонной реализации Snowball
+@pytest.mark.parametrize('word, expected', [
+    ('абсолютно', 'абсолютн'),
+    ('вавилонской', 'вавилонск'),
+    ('важнейшие', 'важн'),
+    ('вдохновение', 'вдохновен'),
+    ('борьбы', 'борьб'),
+    ('красивая', 'красив'),
+    ('книги', 'книг'),
+])
+def test_snowball_stems(word, expected):
+    assert stem(word) == expected
+
+
+def test_word_forms_share_a_stem():
+    assert stem('зависимость') == stem('зависимостью') == stem('зависимости')
+
+
+def test_tokenize_drops_stop_words_and_normalizes_yo():
+    assert tokenize('Как Вы помогаете при зависимостях? Ёж') == ['помога', 'зависим', 'еж']
+    assert tokenize('и в на') == []
+
+
+ENTRIES = [
+    FaqEntry('Вредно ли опохмеляться?', 'Опохмеление продлевает запой.'),
+    FaqEntry('Сколько стоит консультация психолога?', 'Первая консультация бесплатная.'),
+    FaqEntry('Где проходят группы поддержки?', 'Группы встречаются онлайн и в городах.'),
+]
+
+
+def test_search_ranks_relevant_entry_first():
+    index = FaqIndex(ENTRIES)
+    results = index.search('консультации психологов платные?')
+    assert results[0][0] is ENTRIES[1]
+    assert all(first[1] >= second[1] for first, second in zip(results, results[1:]))
+
+
+def test_search_without_matches():
+    index = FaqIndex(ENTRIES)
+    assert index.search('погода завтра') == []
+    assert FaqIndex().search('консультация') == []
+    assert index.search('группы', min_score=100) == []
+
+
+def test_incremental_add():
+    index = FaqIndex(ENTRIES[:1])
+    assert index.search('группы поддержки') == []
+    doc_id = index.add(ENTRIES[2])
+    assert doc_id == 1 and len(index) == 2
+    assert index.search('группы поддержки')[0][0] is ENTRIES[2]
+
+
+def test_render():
+    assert render_faq(ENTRIES[:1]) == 'Q: Вредно ли опохмеляться?\nA: Опохмеление продлевает запой.'
+    assert render_faq(ENTRIES[:1], markdown=True).startswith('**Q: Вредно ли опохмеляться?**')
@@ -0,0 +1,59 @@
+"""Tests for keyboard versioning of callback payloads."""
+
+from bot.max_adapter import (
+    CALLBACK_VERSION_MODULUS, MAX_CALLBACK_PAYLOAD_LENGTH, MaxBot, decode_callback_payload, encode_callback_payload,
+)
+
+
+def test_payload_round_trip():
+    for version in (0, 1, 35, 36, CALLBACK_VERSION_MODULUS - 1):
+        for data in ('dep_alcohol', '', 'a~b', '~'):
+            assert decode_callback_payload(encode_callback_payload(data, version)) == (data, version)
+
+
+def test_version_wraps_modulus():
+    assert decode_callback_payload(encode_callback_payload('x', CALLBACK_VERSION_MODULUS + 5)) == ('x', 5)
+
+
+def test_unversioned_payload():
+    # Кнопки клавиатур, отправленных до введения версий
+    assert decode_callback_payload('dep_alcohol') == ('dep_alcohol', None)
+    assert decode_callback_payload('abc~data') == ('abc~data', None)
+    assert decode_callback_payload('A!~data') == ('A!~data', None)
+
+
+def test_too_long_payload_is_sent_without_version():
+    data = 'x' * MAX_CALLBACK_PAYLOAD_LENGTH
+    assert encode_callback_payload(data, 7) == data
+    assert decode_callback_payload(data) == (data, None)
+
+
+def _keyboard_body(bot: MaxBot) -> dict:
+    return bot._build_message_body('text', {'inline_keyboard': [[{'text': 'A', 'callback_data': 'dep_alcohol'}]]})
+
+
+def test_stale_after_new_keyboard():
+    bot = MaxBot('token', 'http://localhost')
+    assert not bot.is_stale_callback(1, 3)  # версия чата неизвестна
+    
+    first = _keyboard_body(bot)
+    bot._commit_keyboard_version(1, bot._stamp_keyboard(1, first))
+    payload = first['attachments'][0]['payload']['buttons'][0][0]['payload']
+    data, old_version = decode_callback_payload(payload)
+    assert data == 'dep_alcohol'
+    assert not bot.is_stale_callback(1, old_version)
+    
+    bot._commit_keyboard_version(1, bot._stamp_keyboard(1, _keyboard_body(bot)))
+    assert bot.is_stale_callback(1, old_version)
+    assert not bot.is_stale_callback(1, None)
+    assert not bot.is_stale_callback(2, old_version)
+
+
+def test_failed_send_keeps_version():
+    bot = MaxBot('token', 'http://localhost')
+    bot._commit_keyboard_version(1, bot._stamp_keyboard(1, _keyboard_body(bot)))
+    current = bot.keyboard_versions[1]
+    # Версия не фиксируется, пока отправка не удалась
+    bot._stamp_keyboard(1, _keyboard_body(bot))
+    assert not bot.is_stale_callback(1, current)
+    assert bot._stamp_keyboard(1, bot._build_message_body('no keyboard')) is None
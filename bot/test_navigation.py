@@ -0,0 +1,77 @@
+"""Tests for packed navigation history and the screen cache."""
+
+from bot.navigation import (
+    HISTORY_KEY, HISTORY_LIMIT, Screen, ScreenCache, find_back_target, find_latest, history_entries, push_screen,
+    screen_id, truncate_history,
+)
+
+
+def _key(n: int) -> bytes:
+    return bytes([n]) * 8
+
+
+def test_push_and_decode():
+    user_data = {}
+    for state in (1, 2, 3):
+        push_screen(user_data, state, _key(state))
+    assert history_entries(user_data) == [(1, _key(1)), (2, _key(2)), (3, _key(3))]
+    assert isinstance(user_data[HISTORY_KEY], bytes) and len(user_data[HISTORY_KEY]) == 3 * 9
+
+
+def test_repeated_screen_is_stored_once():
+    user_data = {}
+    push_screen(user_data, 1, _key(1))
+    push_screen(user_data, 1, _key(1))
+    push_screen(user_data, 1, _key(2))
+    assert history_entries(user_data) == [(1, _key(1)), (1, _key(2))]
+
+
+def test_history_is_capped():
+    user_data = {}
+    for state in range(HISTORY_LIMIT + 5):
+        push_screen(user_data, state, _key(state))
+    entries = history_entries(user_data)
+    assert len(entries) == HISTORY_LIMIT
+    assert entries[0] == (5, _key(5)) and entries[-1][0] == HISTORY_LIMIT + 4
+
+
+def test_back_target_skips_current_screen():
+    user_data = {}
+    for state in (1, 2, 3, 2):
+        push_screen(user_data, state, _key(state))
+    # Текущий экран (последний) не может быть целью "назад"
+    assert find_back_target(user_data, {2}) == (1, 2, _key(2))
+    assert find_back_target(user_data, {1, 3}) == (2, 3, _key(3))
+    assert find_back_target(user_data, {9}) is None
+    assert find_back_target({}, {1}) is None
+
+
+def test_truncate_and_find_latest():
+    user_data = {}
+    for state in (1, 2, 3):
+        push_screen(user_data, state, _key(state))
+    assert find_latest(user_data, 2) == 1
+    assert find_latest(user_data, 7) is None
+    truncate_history(user_data, 2)
+    assert history_entries(user_data) == [(1, _key(1)), (2, _key(2))]
+    truncate_history(user_data, 0)
+    assert history_entries(user_data) == []
+
+
+def test_screen_id_is_content_address():
+    base = Screen('Выберите город', {'inline_keyboard': [[{'text': 'СПб', 'callback_data': 'city_spb'}]]})
+    assert screen_id(base) == screen_id(Screen(base.text, {'inline_keyboard': [[{'text': 'СПб', 'callback_data': 'city_spb'}]]}))
+    assert screen_id(base) != screen_id(Screen(base.text))
+    assert screen_id(base) != screen_id(Screen(base.text, base.reply_markup, 'Markdown'))
+    assert len(screen_id(base)) == 8
+
+
+def test_screen_cache_lru():
+    cache = ScreenCache(max_entries=2)
+    first, second, third = Screen('1'), Screen('2'), Screen('3')
+    key1, key2 = cache.put(first), cache.put(second)
+    assert cache.get(key1) is first  # первый экран становится недавним
+    key3 = cache.put(third)
+    assert cache.get(key2) is None
+    assert cache.get(key1) is first and cache.get(key3) is third
+    assert len(cache) == 2 and cache.hits == 3 and cache.misses == 1
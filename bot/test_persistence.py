@@ -0,0 +1,116 @@
+"""Tests for write-behind session persistence."""
+
+import asyncio
+
+import pytest
+
+from bot.persistence import SessionStore, WriteBehindSessionWriter, decode_session_value, encode_session_value
+
+
+@pytest.mark.parametrize('value', [
+    None, 'текст', 42, 1.5, True, [1, 'a'],
+    {'preferences': {'city': 'spb'}},
+    b'\x00\x01history', bytearray(b'xy'),
+    {'nested': [b'\xff', {'deep': b''}]},
+])
+def test_value_round_trip(value):
+    decoded = decode_session_value(encode_session_value(value))
+    assert decoded == (bytes(value) if isinstance(value, bytearray) else value)
+
+
+def test_unsupported_value():
+    with pytest.raises(TypeError):
+        encode_session_value({1, 2})
+
+
+def _writer(tmp_path, sessions):
+    store = SessionStore(str(tmp_path / 'sessions.db'))
+    return store, WriteBehindSessionWriter(store, lambda user_id: dict(sessions.get(user_id, {})))
+
+
+def test_flush_writes_changed_keys_and_reloads(tmp_path):
+    sessions = {1: {'current_state': 'main_menu', 'history': b'\x02' * 9}, 2: {'current_state': 'faq_answers'}}
+    store, writer = _writer(tmp_path, sessions)
+    writer.mark_dirty(1)
+    writer.mark_dirty(2)
+    asyncio.run(writer.flush())
+    
+    sessions[1] = {'current_state': 'city_selection'}
+    writer.mark_dirty(1)
+    asyncio.run(writer.flush())
+    store.close()
+    
+    _, reloaded = _writer(tmp_path, {})
+    assert reloaded.load() == sessions
+
+
+def test_bad_key_does_not_block_other_sessions(tmp_path):
+    sessions = {1: {'current_state': 'main_menu', 'bad': {1, 2}}, 2: {'current_state': 'faq_answers'}}
+    store, writer = _writer(tmp_path, sessions)
+    writer.mark_dirty(1)
+    writer.mark_dirty(2)
+    asyncio.run(writer.flush())
+    assert store.load_all() == {1: {'current_state': '"main_menu"'}, 2: {'current_state': '"faq_answers"'}}
+
+
+def test_failed_flush_keeps_sessions_dirty(tmp_path):
+    sessions = {1: {'current_state': 'main_menu'}}
+    store, writer = _writer(tmp_path, sessions)
+    
+    def fail(upserts, deletes):
+        raise OSError('disk full')
+    
+    store.write_batch, write_batch = fail, store.write_batch
+    writer.mark_dirty(1)
+    with pytest.raises(OSError):
+        asyncio.run(writer.flush())
+    
+    store.write_batch = write_batch
+    asyncio.run(writer.flush())
+    assert store.load_all() == {1: {'current_state': '"main_menu"'}}
+
+
+def test_failed_snapshot_keeps_sessions_dirty(tmp_path):
+    store = SessionStore(str(tmp_path / 'sessions.db'))
+    calls = []
+    
+    def snapshot(user_id):
+        calls.append(user_id)
+        if len(calls) == 1:
+            raise RuntimeError('session is being rebuilt')
+        return {'current_state': 'main_menu'}
+    
+    writer = WriteBehindSessionWriter(store, snapshot)
+    writer.mark_dirty(1)
+    with pytest.raises(RuntimeError):
+        asyncio.run(writer.flush())
+    asyncio.run(writer.flush())
+    assert store.load_all() == {1: {'current_state': '"main_menu"'}}
+
+
+def test_skipped_keys_are_not_written(tmp_path):
+    store = SessionStore(str(tmp_path / 'sessions.db'))
+    store.write_batch([(1, 'history', '"stale"')], [])
+    writer = WriteBehindSessionWriter(store, lambda user_id: {'current_state': 'main_menu', 'history': b'\x01' * 9},
+                                      skip_keys=('history',))
+    writer.load()
+    writer.mark_dirty(1)
+    asyncio.run(writer.flush())
+    # Сохраненное ранее значение пропускаемого ключа удаляется
+    assert store.load_all() == {1: {'current_state': '"main_menu"'}}
+
+
+def test_load_with_user_filter(tmp_path):
+    store = SessionStore(str(tmp_path / 'sessions.db'))
+    store.write_batch([(user_id, key, '"x"') for user_id in (3, 1, 2) for key in ('a', 'b')], [])
+    calls = []
+    
+    def odd(user_id):
+        calls.append(user_id)
+        return user_id % 2 == 1
+    
+    writer = WriteBehindSessionWriter(store, lambda user_id: {})
+    assert writer.load(odd) == {1: {'a': 'x', 'b': 'x'}, 3: {'a': 'x', 'b': 'x'}}
+    # Фильтр вызывается один раз на пользователя, чужие сессии не считаются сохраненными
+    assert calls == [1, 2, 3]
+    assert set(writer._persisted) == {1, 3}
@@ -0,0 +1,76 @@
+"""Tests for the anonymous question queue and digests."""
+
+import asyncio
+
+from bot.questions import QuestionDigest, QuestionQueue, build_digest, hamming_distance, simhash
+
+SIMILAR = (
+    'Как помочь мужу, если он не признает, что пьет?',
+    'Как помочь мужу если муж не признает что пьет',
+)
+OTHER = 'Сколько длится реабилитация после лечения в клинике?'
+
+
+def test_simhash_similarity():
+    assert simhash('') == 0
+    assert simhash(SIMILAR[0]) == simhash(SIMILAR[0])
+    assert hamming_distance(simhash(SIMILAR[0]), simhash(SIMILAR[1])) <= 12
+    assert hamming_distance(simhash(SIMILAR[0]), simhash(OTHER)) > 12
+
+
+def test_similar_questions_are_grouped():
+    queue = QuestionQueue()
+    first, second, other = (queue.add(text) for text in SIMILAR + (OTHER,))
+    assert first.cluster == second.cluster != other.cluster
+    groups = queue.pending_groups()
+    assert [[question.id for question in group] for group in groups] == [[first.id, second.id], [other.id]]
+
+
+def test_digest_limits():
+    queue = QuestionQueue()
+    for text in SIMILAR + (OTHER,):
+        queue.add(text)
+    text, covered = build_digest(queue.pending_groups(), queue.cluster_sizes, max_groups=1)
+    assert '(похожих: 2)' in text and 'Остальные (1)' in text
+    assert covered == [1, 2]
+
+
+def test_log_is_compacted_after_digest(tmp_path):
+    path = str(tmp_path / 'questions.jsonl')
+    queue = QuestionQueue(path)
+    for text in SIMILAR:
+        queue.add(text)
+    sent = []
+    
+    async def send(user_id, text):
+        sent.append((user_id, text))
+        return True
+    
+    digest = QuestionDigest(queue, send, [42])
+    assert asyncio.run(digest.send_digest())
+    assert [user_id for user_id, _ in sent] == [42]
+    queue.add(OTHER)
+    queue.close()
+    
+    with open(path, encoding='utf-8') as file:
+        log = file.read()
+    # Группа отправленных вопросов и новый вопрос; тексты отправленных не хранятся
+    assert len(log.splitlines()) == 2 and SIMILAR[0] not in log
+    
+    reloaded = QuestionQueue(path)
+    assert [question.text for question in reloaded.pending.values()] == [OTHER]
+    question = reloaded.add(SIMILAR[1])
+    assert question.id == 4
+    text, _ = build_digest(reloaded.pending_groups(), reloaded.cluster_sizes)
+    assert '[уже задавали раньше]' in text
+
+
+def test_undelivered_digest_keeps_questions():
+    queue = QuestionQueue()
+    queue.add(OTHER)
+    
+    async def send(user_id, text):
+        return False
+    
+    assert not asyncio.run(QuestionDigest(queue, send, [42]).send_digest())
+    assert len(queue.pending) == 1
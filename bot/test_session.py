@@ -0,0 +1,74 @@
+"""Tests for the compact session record and its binary form."""
+
+import pytest
+
+from bot.session import PREFERENCE_FIELDS, SessionRecord, decode_value, encode_value, DEPENDENCY_VALUES
+
+USER_DATA = {
+    'preferences': {
+        'dependency': 'alcohol',
+        'timezone': 'msk_plus_7',
+        'city': 'anadyr',
+        'help_type': 'specialist',
+        'consultation_type': 'psychologist',
+        'gender': 'female',
+        'age_user': '50_plus',
+        'wants_support': False,
+        'wants_literature': True,
+    },
+    'current_state': 'anonymous_question_input',
+    'discovery_source': 'other',
+    'group_name': 'Группа «Надежда»',
+    'anonymous_question': '',
+}
+
+
+def test_user_data_round_trip():
+    record = SessionRecord.from_user_data(USER_DATA)
+    assert record.to_user_data() == USER_DATA
+    assert SessionRecord.from_bytes(record.to_bytes()) == record
+    assert record.current_state == 'anonymous_question_input'
+
+
+@pytest.mark.parametrize('user_data', [
+    {},
+    {'preferences': {}},
+    {'current_state': 'main_menu'},
+    {'preferences': {'wants_support': True}},
+])
+def test_sparse_sessions(user_data):
+    record = SessionRecord.from_bytes(SessionRecord.from_user_data(user_data).to_bytes())
+    assert record.to_user_data() == user_data
+
+
+def test_binary_form_is_small():
+    assert len(SessionRecord.from_user_data({'current_state': 'main_menu'}).to_bytes()) == 14 + 3 * 2
+
+
+def test_unknown_value_is_stored_unset():
+    record = SessionRecord.from_user_data({'preferences': {'dependency': 'unknown', 'city': 'spb'}})
+    assert record.to_user_data() == {'preferences': {'city': 'spb'}}
+
+
+def test_code_table_bounds():
+    assert encode_value(DEPENDENCY_VALUES, None) == 0
+    assert decode_value(DEPENDENCY_VALUES, encode_value(DEPENDENCY_VALUES, 'vr')) == 'vr'
+    # Код из более новой таблицы (после отката версии) читается как "не выбрано"
+    assert decode_value(DEPENDENCY_VALUES, len(DEPENDENCY_VALUES)) is None
+    assert len(SessionRecord().preferences) == len(PREFERENCE_FIELDS)
+
+
+def test_long_text_is_truncated():
+    record = SessionRecord.from_user_data({'anonymous_question': 'я' * 40000})
+    assert SessionRecord.from_bytes(record.to_bytes()).anonymous_question == 'я' * 32767
+    
+    # Обрезка по 0xFFFE байтам посередине буквы не ломает чтение
+    record = SessionRecord.from_user_data({'anonymous_question': '!' + 'я' * 40000})
+    assert SessionRecord.from_bytes(record.to_bytes()).anonymous_question == '!' + 'я' * 32766 + '\ufffd'
+
+
+def test_unsupported_version():
+    data = bytearray(SessionRecord().to_bytes())
+    data[0] = 99
+    with pytest.raises(ValueError):
+        SessionRecord.from_bytes(bytes(data))
@@ -0,0 +1,49 @@
+"""Tests for the runtime snapshot file."""
+
+import os
+
+from bot.session import SessionRecord
+from bot.snapshot import RuntimeSnapshot, load_snapshot, save_snapshot
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'state' / 'snapshot.bin')
+    snapshot = RuntimeSnapshot(
+        marker=1700000000123,
+        last_update_id=42,
+        sessions={
+            1: SessionRecord.from_user_data({'current_state': 'main_menu', 'preferences': {'city': 'spb'}}),
+            -5: SessionRecord.from_user_data({'group_name': 'Группа'}),
+        },
+        keyboard_versions={1: 7, 2 ** 40: 1295},
+        created_at=123.5,
+    )
+    save_snapshot(path, snapshot)
+    assert load_snapshot(path) == snapshot
+    assert not os.path.exists(path + '.tmp')
+
+
+def test_empty_snapshot(tmp_path):
+    path = str(tmp_path / 'snapshot.bin')
+    save_snapshot(path, RuntimeSnapshot())
+    loaded = load_snapshot(path)
+    assert loaded.marker is None and loaded.sessions == {} and loaded.keyboard_versions == {}
+    assert loaded.created_at > 0
+
+
+def test_missing_file(tmp_path):
+    assert load_snapshot(str(tmp_path / 'missing.bin')) is None
+
+
+def test_foreign_or_truncated_file(tmp_path):
+    path = str(tmp_path / 'snapshot.bin')
+    with open(path, 'wb') as f:
+        f.write(b'JUNK' + bytes(20))
+    assert load_snapshot(path) is None
+    
+    save_snapshot(path, RuntimeSnapshot(sessions={1: SessionRecord.from_user_data({'current_state': 'main_menu'})}))
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path, 'wb') as f:
+        f.write(data[:-3])
+    assert load_snapshot(path) is None
@@ -0,0 +1,92 @@
+"""Tests for the compiled conversation state machine."""
+
+import pytest
+
+from bot.state_machine import (
+    BACK_TRANSITIONS, GLOBAL_TRANSITIONS, STATE_MACHINE, TEXT, TRANSITIONS, StateMachine, Transition,
+)
+from bot.states import BotStates as S
+
+
+def _resolved(transition_id):
+    return STATE_MACHINE.transitions[transition_id] if transition_id >= 0 else None
+
+
+def test_compiled_table_is_valid():
+    assert STATE_MACHINE.validate() == []
+
+
+def test_validate_rejects_unknown_target_state():
+    broken = dict(TRANSITIONS)
+    broken[S.CITY_SELECTION] = (Transition('city_', 'handle_city_selection', ('help_typo',)),)
+    machine = StateMachine(broken, GLOBAL_TRANSITIONS, BACK_TRANSITIONS)
+    
+    assert "handle_city_selection: unknown target state 'help_typo'" in machine.validate()
+
+
+def test_validate_reports_dead_end():
+    broken = {**TRANSITIONS, S.HOW_FOUND_US: ()}
+    machine = StateMachine(broken, GLOBAL_TRANSITIONS, BACK_TRANSITIONS)
+    assert 'how_found_us: dead end (no transitions of its own)' in machine.validate()
+
+
+@pytest.mark.parametrize('state, data, handler', [
+    (S.DEPENDENCY_SELECTION, 'dep_alcohol', 'handle_dependency_selection'),
+    (S.TIME_ZONE_SELECTION, 'timezone_msk', 'handle_timezone_selection'),
+    # Самый длинный шаблон выигрывает: 'yes_literature_after_info', а не 'yes_literature'
+    (S.LITERATURE_CHOICE, 'yes_literature_after_info', 'handle_literature_choice_after_info'),
+    (S.LITERATURE_CHOICE, 'yes_literature', 'handle_literature_choice'),
+    # Шаблон совпадает с началом payload по границе '_'
+    (S.HELP_CHOICE, 'yes_support_after_info', 'handle_support_choice_after_info'),
+])
+def test_state_transitions(state, data, handler):
+    assert _resolved(STATE_MACHINE.resolve_callback(state.value, data)).handler == handler
+
+
+def test_global_transitions_work_in_any_state():
+    for state in (S.DEPENDENCY_SELECTION, S.AGE_USER, S.CONVERSATION_END):
+        assert _resolved(STATE_MACHINE.resolve_callback(state.value, 'restart_conversation')).handler == \
+            'handle_restart_conversation'
+
+
+def test_state_transition_overrides_global_pattern():
+    # У CITY_SELECTION нет своего back_to_help - срабатывает глобальный переход
+    own = _resolved(STATE_MACHINE.resolve_callback(S.CITY_SELECTION.value, 'back_to_help'))
+    assert own.handler == 'handle_back_to_help' and own in GLOBAL_TRANSITIONS
+    
+    machine = StateMachine({**TRANSITIONS, S.CITY_SELECTION: TRANSITIONS[S.CITY_SELECTION] + (
+        Transition('back_to_help', 'handle_city_selection', (S.HELP_TYPE,)),
+    )}, GLOBAL_TRANSITIONS, BACK_TRANSITIONS)
+    overridden = machine.transitions[machine.resolve_callback(S.CITY_SELECTION.value, 'back_to_help')]
+    assert overridden.handler == 'handle_city_selection'
+
+
+def test_text_transitions():
+    transition = _resolved(STATE_MACHINE.resolve_text(S.GROUP_NAME_INPUT.value))
+    assert transition.pattern is TEXT and transition.handler == 'handle_group_name_input'
+    assert STATE_MACHINE.resolve_text(S.CITY_SELECTION.value) == -1
+
+
+@pytest.mark.parametrize('state', list(BACK_TRANSITIONS))
+def test_back_transitions(state):
+    assert _resolved(STATE_MACHINE.resolve_back(state.value)) == BACK_TRANSITIONS[state]
+
+
+def test_no_back_from_first_step():
+    assert STATE_MACHINE.resolve_back(S.DEPENDENCY_SELECTION.value) == -1
+
+
+@pytest.mark.parametrize('state, data', [
+    (S.DEPENDENCY_SELECTION, 'unknown_payload'),
+    (S.DEPENDENCY_SELECTION, 'timezone_msk'),  # кнопка другого шага
+    (S.DEPENDENCY_SELECTION, 'dep'),  # без границы '_' шаблон 'dep_' не совпадает
+    (S.DEPENDENCY_SELECTION, ''),
+    (S.DEPENDENCY_SELECTION, None),
+    ('no_such_state', 'dep_alcohol'),
+    (None, 'dep_alcohol'),
+])
+def test_unknown_payload_falls_through(state, data):
+    state = state.value if isinstance(state, S) else state
+    assert STATE_MACHINE.resolve_callback(state, data) == -1
+    # Повторный запрос идет через кэш сопоставления и дает тот же результат
+    assert STATE_MACHINE.resolve_callback(state, data) == -1
@@ -0,0 +1,360 @@
+"""
+Request tracing for the MAX bot.
+Spans per update with children for routing, handlers and MAX API calls; trace ids in log records; pluggable exporters.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_CLIENT = 3
+
+STATUS_UNSET = 0
+STATUS_ERROR = 2
+
+SERVICE_NAME = 'max-dependency-bot'
+SEGMENT_SUFFIX = '.otlp.jsonl'
+# Span в одной строке файла OTLP/JSON
+SPANS_PER_LINE = 128
+
+
+class Span:
+    """One timed operation of a trace."""
+    
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'kind', 'start_ns', 'end_ns', 'attributes',
+                 'status', 'status_message')
+    
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], kind: int,
+                 attributes: Optional[Dict[str, Any]]):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.attributes = attributes or {}
+        self.status = STATUS_UNSET
+        self.status_message = ''
+    
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+    
+    def set_error(self, message: str) -> None:
+        self.status = STATUS_ERROR
+        self.status_message = message
+    
+    @property
+    def duration_ms(self) -> float:
+        return (self.end_ns - self.start_ns) / 1e6
+
+
+class _NoopSpan:
+    """Span returned when tracing is off: instrumented code does not need to check."""
+    
+    def set_attribute(self, key: str, value: Any) -> None:
+        pass
+    
+    def set_error(self, message: str) -> None:
+        pass
+
+
+# Текущий span задачи; _UNSAMPLED - трассировка не попала в выборку, дочерние span не создаются
+_UNSAMPLED = object()
+_current_span: ContextVar[Any] = ContextVar('trace_span', default=None)
+
+_NOOP = nullcontext(_NoopSpan())
+
+
+def current_span() -> Optional[Span]:
+    span = _current_span.get()
+    return span if isinstance(span, Span) else None
+
+
+class Tracer:
+    """
+    Creates spans and hands finished ones to exporters.
+    
+    Без экспортеров трассировка выключена: trace() и span() возвращают
+    пустой контекст и ничего не создают. Решение о выборке принимается для
+    корневого span (sample_rate), дочерние наследуют его.
+    """
+    
+    def __init__(self, exporters: Iterable[Any] = (), sample_rate: float = 1.0):
+        self.exporters = list(exporters)
+        self.sample_rate = sample_rate
+        self.enabled = bool(self.exporters)
+        # Кольцевой буфер, если он среди экспортеров (для /traces)
+        self.buffer: Optional[RingBufferExporter] = next(
+            (exporter for exporter in self.exporters if isinstance(exporter, RingBufferExporter)), None
+        )
+    
+    def trace(self, name: str, attributes: Optional[Dict[str, Any]] = None):
+        """Context manager for a root span that starts a new trace."""
+        if not self.enabled:
+            return _NOOP
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return self._unsampled()
+        return self._span(name, f"{random.getrandbits(128):032x}", None, SPAN_KIND_INTERNAL, attributes)
+    
+    def span(self, name: str, attributes: Optional[Dict[str, Any]] = None, kind: int = SPAN_KIND_INTERNAL):
+        """Context manager for a child of the current span; no-op outside a trace."""
+        parent = _current_span.get()
+        if not isinstance(parent, Span):
+            return _NOOP
+        return self._span(name, parent.trace_id, parent.span_id, kind, attributes)
+    
+    @contextmanager
+    def _unsampled(self) -> Iterator[_NoopSpan]:
+        token = _current_span.set(_UNSAMPLED)
+        try:
+            yield _NOOP.enter_result
+        finally:
+            _current_span.reset(token)
+    
+    @contextmanager
+    def _span(self, name: str, trace_id: str, parent_id: Optional[str], kind: int,
+              attributes: Optional[Dict[str, Any]]) -> Iterator[Span]:
+        span = Span(name, trace_id, parent_id, kind, attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.set_error(f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            span.end_ns = time.time_ns()
+            _current_span.reset(token)
+            for exporter in self.exporters:
+                try:
+                    exporter.export(span)
+                except Exception as e:
+                    logger.error(f"Error exporting span: {e}")
+    
+    def start(self) -> None:
+        for exporter in self.exporters:
+            if hasattr(exporter, 'start'):
+                exporter.start()
+    
+    async def stop(self) -> None:
+        for exporter in self.exporters:
+            if hasattr(exporter, 'stop'):
+                await exporter.stop()
+
+
+class TraceContextFilter(logging.Filter):
+    """Adds the current trace id to log records as %(trace)s (empty outside a trace)."""
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        span = _current_span.get()
+        record.trace = f" [trace={span.trace_id}]" if isinstance(span, Span) else ''
+        return True
+
+
+# ==================== EXPORTERS ====================
+
+class RingBufferExporter:
+    """Keeps the last `capacity` finished spans in memory."""
+    
+    def __init__(self, capacity: int = 5000):
+        self.spans: deque = deque(maxlen=capacity)
+    
+    def export(self, span: Span) -> None:
+        self.spans.append(span)
+    
+    def recent_traces(self, limit: int = 5, user_id: Optional[int] = None) -> List[List[Span]]:
+        """Latest complete traces, newest first; each is a list of spans with the root first."""
+        spans = list(self.spans)
+        roots = [span for span in reversed(spans) if span.parent_id is None
+                 and (user_id is None or span.attributes.get('user.id') == user_id)][:limit]
+        by_trace: Dict[str, List[Span]] = {root.trace_id: [] for root in roots}
+        for span in spans:
+            if span.trace_id in by_trace and span.parent_id is not None:
+                by_trace[span.trace_id].append(span)
+        return [[root] + sorted(by_trace[root.trace_id], key=lambda span: span.start_ns) for root in roots]
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def _otlp_attributes(attributes: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [{'key': key, 'value': _otlp_value(value)} for key, value in attributes.items()]
+
+
+def encode_otlp(spans: List[Span], resource: Dict[str, Any]) -> str:
+    """Spans as one OTLP/JSON ExportTraceServiceRequest."""
+    encoded = []
+    for span in spans:
+        item = {
+            'traceId': span.trace_id,
+            'spanId': span.span_id,
+            'name': span.name,
+            'kind': span.kind,
+            'startTimeUnixNano': str(span.start_ns),
+            'endTimeUnixNano': str(span.end_ns),
+            'attributes': _otlp_attributes(span.attributes),
+            'status': {'code': span.status, 'message': span.status_message} if span.status else {},
+        }
+        if span.parent_id:
+            item['parentSpanId'] = span.parent_id
+        encoded.append(item)
+    return json.dumps({'resourceSpans': [{
+        'resource': {'attributes': _otlp_attributes(resource)},
+        'scopeSpans': [{'scope': {'name': __name__}, 'spans': encoded}],
+    }]}, ensure_ascii=False, separators=(',', ':'))
+
+
+class OtlpFileExporter:
+    """
+    Writes spans as OTLP/JSON lines for offline import.
+    
+    Каждая строка - ExportTraceServiceRequest, как в file exporter
+    OpenTelemetry Collector: файлы можно загрузить в коллектор (otlpjsonfile
+    receiver) или Jaeger без сети на стороне бота. Span копятся в памяти,
+    фоновая задача раз в flush_interval секунд кодирует их и пишет в отдельном потоке.
+    Сегменты закрываются по размеру, имя содержит pid.
+    """
+    
+    def __init__(self, directory: str, segment_max_bytes: int = 16 * 1024 * 1024,
+                 flush_interval: float = 2.0, max_pending: int = 100_000):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.flush_interval = flush_interval
+        # При зависшем диске лишние span отбрасываются, а не копятся без предела
+        self.max_pending = max_pending
+        self.resource = {'service.name': SERVICE_NAME, 'process.pid': os.getpid()}
+        
+        started = datetime.now().strftime('%Y%m%d-%H%M%S')
+        self._prefix = f"traces-{started}-{os.getpid()}"
+        self._segment_index = 0
+        self._file = None
+        self._segment_bytes = 0
+        
+        self._pending: List[Span] = []
+        self.spans_exported = 0
+        self.spans_dropped = 0
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        
+        os.makedirs(directory, exist_ok=True)
+    
+    def export(self, span: Span) -> None:
+        if len(self._pending) >= self.max_pending:
+            self.spans_dropped += 1
+            return
+        self._pending.append(span)
+    
+    def start(self) -> None:
+        """Start the background flush task."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self) -> None:
+        """Stop the background task, write pending spans and close the segment."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+    
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error writing trace spans: {e}", exc_info=True)
+    
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            spans, self._pending = self._pending, []
+            # Кодирование - чистый Python: в потоке оно отнимало бы GIL у цикла событий
+            # на каждом вызове ввода-вывода, поэтому частями здесь, а в поток уходит только запись
+            lines = []
+            for start in range(0, len(spans), SPANS_PER_LINE):
+                lines.append((encode_otlp(spans[start:start + SPANS_PER_LINE], self.resource) + '\n').encode('utf-8'))
+                await asyncio.sleep(0)
+            await asyncio.to_thread(self._write, b''.join(lines))
+            self.spans_exported += len(spans)
+    
+    def _write(self, data: bytes) -> None:
+        if self._file is not None and self._segment_bytes >= self.segment_max_bytes:
+            self._file.close()
+            self._file = None
+        if self._file is None:
+            self._open_segment()
+        self._file.write(data)
+        self._file.flush()
+        self._segment_bytes += len(data)
+    
+    def _open_segment(self) -> None:
+        while True:
+            path = os.path.join(self.directory, f"{self._prefix}-{self._segment_index:04d}{SEGMENT_SUFFIX}")
+            self._segment_index += 1
+            if not os.path.exists(path):
+                break
+        self._file = open(path, 'wb')
+        self._segment_bytes = 0
+        logger.info(f"Writing trace spans to {path}")
+
+
+def create_tracer(buffer_spans: int = 0, otlp_dir: Optional[str] = None, otlp_segment_mb: int = 16,
+                  sample_rate: float = 1.0) -> Tracer:
+    """Tracer with the configured exporters (disabled if there are none)."""
+    exporters: List[Any] = []
+    if buffer_spans > 0:
+        exporters.append(RingBufferExporter(buffer_spans))
+    if otlp_dir:
+        exporters.append(OtlpFileExporter(otlp_dir, segment_max_bytes=otlp_segment_mb * 1024 * 1024))
+    tracer = Tracer(exporters, sample_rate)
+    if tracer.enabled:
+        logger.info(f"Tracing enabled: buffer {buffer_spans} spans, OTLP files {otlp_dir or 'off'}, "
+                    f"sample rate {sample_rate:g}")
+    return tracer
+
+
+def format_traces(traces: List[List[Span]]) -> str:
+    """Traces as an indented span tree with durations."""
+    blocks = []
+    for trace in traces:
+        root = trace[0]
+        depth = {root.span_id: 0}
+        started = datetime.fromtimestamp(root.start_ns / 1e9).strftime('%H:%M:%S')
+        header = f"{started} {root.attributes.get('update.type', root.name)}: {root.duration_ms:.0f} ms"
+        queue_ms = root.attributes.get('queue_ms')
+        if queue_ms is not None:
+            header += f" (в очереди {queue_ms:.0f} ms)"
+        lines = [header + (" ❗" if root.status == STATUS_ERROR else "")]
+        for span in trace[1:]:
+            level = depth.get(span.parent_id, 0) + 1
+            depth[span.span_id] = level
+            lines.append(f"{'  ' * level}{span.name} {span.duration_ms:.0f} ms"
+                         + (" ❗" if span.status == STATUS_ERROR else ""))
+        blocks.append('\n'.join(lines))
+    return '\n\n'.join(blocks)
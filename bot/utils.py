@@ -7,20 +7,26 @@ import logging
 import sys
 from typing import Optional
 
+from .tracing import TraceContextFilter
+
 def setup_logging(log_level: str = 'INFO') -> None:
     """Setup logging configuration for the bot."""
     
-    # Define log format
-    log_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    # Define log format (trace id добавляется в конец строки только внутри трассировки, см. bot/tracing.py)
+    log_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s%(trace)s'
+    
+    handlers = [
+        logging.StreamHandler(sys.stdout),
+        logging.FileHandler('bot.log', encoding='utf-8')
+    ]
+    for handler in handlers:
+        handler.addFilter(TraceContextFilter())
     
     # Configure logging
     logging.basicConfig(
         format=log_format,
         level=getattr(logging, log_level.upper()),
-        handlers=[
-            logging.StreamHandler(sys.stdout),
-            logging.FileHandler('bot.log', encoding='utf-8')
-        ]
+        handlers=handlers
     )
     
     # Set specific logger levels
@@ -30,6 +30,57 @@ class Config:
         self.LOG_LEVEL: str = os.getenv('LOG_LEVEL', 'INFO')
         self.DATABASE_URL: Optional[str] = os.getenv('DATABASE_URL')
         
+        # Write-behind сохранение сессий: интервал сброса (мс) и число update'ов до досрочного сброса
+        self.SESSION_FLUSH_INTERVAL_MS: int = int(os.getenv('SESSION_FLUSH_INTERVAL_MS', '500'))
+        self.SESSION_FLUSH_MAX_UPDATES: int = int(os.getenv('SESSION_FLUSH_MAX_UPDATES', '100'))
+        
+        # Корректная остановка: файл снимка состояния и время на завершение обработки (сек)
+        self.SNAPSHOT_PATH: Optional[str] = os.getenv('SNAPSHOT_PATH')
+        self.SHUTDOWN_TIMEOUT: float = float(os.getenv('SHUTDOWN_TIMEOUT', '10'))
+        
+        # Число процессов-обработчиков (MAX). Больше 1 - updates распределяются по user_id
+        self.MAX_WORKERS: int = int(os.getenv('MAX_WORKERS', '1'))
+        
+        # Несколько реплик: выбор лидера и очередь updates (file:///path или redis://host:6379/0)
+        self.REPLICA_COORDINATION_URL: Optional[str] = os.getenv('REPLICA_COORDINATION_URL')
+        self.REPLICA_PARTITIONS: int = int(os.getenv('REPLICA_PARTITIONS', '16'))
+        self.REPLICA_MAX_PARTITIONS: int = int(os.getenv('REPLICA_MAX_PARTITIONS', '0'))
+        self.REPLICA_LEASE_TTL_MS: int = int(os.getenv('REPLICA_LEASE_TTL_MS', '5000'))
+        
+        # Цикл событий: auto (uvloop, если установлен), uvloop или asyncio; eager-задачи на Python 3.12+
+        self.EVENT_LOOP: str = os.getenv('EVENT_LOOP', 'auto')
+        self.EAGER_TASKS: bool = os.getenv('EAGER_TASKS', 'true').lower() == 'true'
+        
+        # Запись получаемых updates (gzip JSONL) для воспроизведения через replay_capture.py
+        self.CAPTURE_DIR: Optional[str] = os.getenv('CAPTURE_DIR')
+        self.CAPTURE_SEGMENT_MB: int = int(os.getenv('CAPTURE_SEGMENT_MB', '16'))
+        self.CAPTURE_REDACT: bool = os.getenv('CAPTURE_REDACT', 'true').lower() == 'true'
+        self.CAPTURE_SALT: Optional[str] = os.getenv('CAPTURE_SALT')
+        
+        # Словарь кризисных фраз (по строке на фразу); без него используется встроенный (bot/crisis.py)
+        self.CRISIS_LEXICON_PATH: Optional[str] = os.getenv('CRISIS_LEXICON_PATH')
+        
+        # Анонимные вопросы: журнал очереди и дайджесты для ADMIN_IDS (интервалы в секундах)
+        self.QUESTIONS_PATH: Optional[str] = os.getenv('QUESTIONS_PATH')
+        self.QUESTION_DIGEST_INTERVAL: float = float(os.getenv('QUESTION_DIGEST_INTERVAL', '900'))
+        self.QUESTION_DIGEST_MIN_INTERVAL: float = float(os.getenv('QUESTION_DIGEST_MIN_INTERVAL', '300'))
+        self.QUESTION_DIGEST_BATCH: int = int(os.getenv('QUESTION_DIGEST_BATCH', '20'))
+        
+        # Воронка переходов по шагам диалога: каталог журнала событий (без него аналитика выключена)
+        self.ANALYTICS_DIR: Optional[str] = os.getenv('ANALYTICS_DIR')
+        self.ANALYTICS_SEGMENT_MB: int = int(os.getenv('ANALYTICS_SEGMENT_MB', '64'))
+        self.ANALYTICS_FLUSH_INTERVAL: float = float(os.getenv('ANALYTICS_FLUSH_INTERVAL', '1.0'))
+        
+        # Трассировка updates (только MAX-бот): кольцевой буфер span в памяти (/traces), файлы OTLP/JSON и доля трассируемых updates
+        self.TRACE_BUFFER_SPANS: int = int(os.getenv('TRACE_BUFFER_SPANS', '0'))
+        self.TRACE_OTLP_DIR: Optional[str] = os.getenv('TRACE_OTLP_DIR')
+        self.TRACE_OTLP_SEGMENT_MB: int = int(os.getenv('TRACE_OTLP_SEGMENT_MB', '16'))
+        self.TRACE_SAMPLE_RATE: float = float(os.getenv('TRACE_SAMPLE_RATE', '1.0'))
+        
+        # Журнал последних событий пользователей для /flight: записей на пользователя (0 - выключен) и число пользователей
+        self.FLIGHT_RECORDER_RECORDS: int = int(os.getenv('FLIGHT_RECORDER_RECORDS', '0'))
+        self.FLIGHT_RECORDER_USERS: int = int(os.getenv('FLIGHT_RECORDER_USERS', '5000'))
+        
         # Validate required settings
         if not self.BOT_TOKEN:
             token_name = 'MAX_BOT_TOKEN' if messenger_type == 'max' else 'TELEGRAM_BOT_TOKEN'
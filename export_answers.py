@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Выгрузка ответов пользователей из журнала воронки (bot/analytics.py, ANALYTICS_DIR)
+
+Ответы кнопками - зависимость, часовой пояс, город, тип помощи, откуда узнали
+о боте и т.д. - пишутся строками (time, user, step, field, value, dependency,
+timezone) в каталог с партициями по дням:
+    out/date=2025-01-01/part-0000.csv
+
+Журнал читается потоком блоками, в памяти держатся только буферы открытых
+партиций, поэтому выгрузка миллионов событий не требует памяти под них.
+id пользователей заменяются псевдонимами (ключ --salt или EXPORT_SALT;
+без ключа псевдонимы случайны для каждой выгрузки).
+
+Parquet требует pyarrow (pip install pyarrow). Если дней в журнале вперемешку
+больше, чем --max-open, закрытая партиция Parquet продолжается в новом
+part-файле (CSV дописывается в прежний) - тогда стоит увеличить --max-open.
+
+Запуск:
+    python export_answers.py data/analytics -o export
+    python export_answers.py data/analytics -o export --format parquet --since 2025-01-01
+"""
+
+import argparse
+import logging
+import os
+import time
+from datetime import datetime, timezone
+
+from bot.analytics import read_events
+from bot.export import DEFAULT_BATCH_ROWS, DEFAULT_MAX_OPEN_PARTITIONS, FORMATS, events_between, export_answers
+
+
+def parse_date(value: str) -> float:
+    return datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export user answers from the funnel event log')
+    parser.add_argument('paths', nargs='+', help='analytics directories or segment files')
+    parser.add_argument('-o', '--output', required=True, help='output directory')
+    parser.add_argument('--format', choices=FORMATS, default='csv')
+    parser.add_argument('--salt', default=os.getenv('EXPORT_SALT'), help='pseudonymization key (default: $EXPORT_SALT)')
+    parser.add_argument('--since', type=parse_date, help='first day to export, YYYY-MM-DD (UTC)')
+    parser.add_argument('--until', type=parse_date, help='day after the last one to export, YYYY-MM-DD (UTC)')
+    parser.add_argument('--batch-rows', type=int, default=DEFAULT_BATCH_ROWS, help='rows buffered per partition')
+    parser.add_argument('--max-open', type=int, default=DEFAULT_MAX_OPEN_PARTITIONS, help='partition files open at once')
+    args = parser.parse_args()
+    
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s %(message)s')
+    
+    events = events_between(read_events(args.paths), args.since, args.until)
+    
+    started = time.perf_counter()
+    try:
+        stats = export_answers(events, args.output, args.format, args.salt, args.batch_rows, args.max_open)
+    except ValueError as e:
+        parser.error(str(e))
+    elapsed = time.perf_counter() - started
+    
+    print(f"Exported {stats.rows:,} answers into {len(stats.files)} files in {elapsed:.1f}s")
+    for date, rows in sorted(stats.partitions.items()):
+        print(f"  date={date}: {rows:,}")
+
+
+if __name__ == '__main__':
+    main()
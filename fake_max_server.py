@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+"""
+Фейковый сервер MAX Platform API для локальных бенчмарков
+
+Реализует то, чем пользуется MaxBot:
+- GET  /me
+- GET  /updates        (long polling, семантика marker)
+- POST /messages       (отправка, возвращает mid)
+- PUT  /messages       (редактирование по message_id)
+- POST /answers        (ответ на callback)
+
+Поведение настраивается: задержка ответа, доля ошибок 500 и лимит
+запросов в секунду (сверх лимита - 429). Служебные эндпоинты /_fake/*
+не подвержены задержкам и ошибкам:
+- POST /_fake/updates  - добавить updates (готовые или {"user_id", "text"} / {"user_id", "payload"} /
+                         {"user_id", "event": "bot_started"})
+- GET  /_fake/stats    - счетчики запросов и ответов
+- GET  /_fake/messages - отправленные ботом сообщения (?chat_id=)
+- POST /_fake/reset    - сбросить состояние
+
+Запуск:
+    python fake_max_server.py --port 8080 --latency-ms 30 --jitter-ms 10 --error-rate 0.01 --rate-limit 30
+    MAX_API_BASE_URL=http://127.0.0.1:8080 python main_max.py
+"""
+
+import argparse
+import asyncio
+import itertools
+import logging
+import random
+import time
+from collections import Counter, deque
+from dataclasses import dataclass
+from typing import Dict, Any, List, Optional, Callable
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class FakeMaxConfig:
+    """Behaviour of the fake platform."""
+    
+    latency_ms: float = 0.0  # базовая задержка ответа
+    jitter_ms: float = 0.0  # случайная добавка к задержке (равномерно 0..jitter_ms)
+    error_rate: float = 0.0  # доля запросов, на которые отвечаем 500
+    rate_limit: float = 0.0  # запросов в секунду на отправку/редактирование/ответы (0 - без лимита)
+    rate_burst: int = 0  # размер всплеска сверх лимита (0 - равен rate_limit)
+    token: Optional[str] = None  # если задан, проверяется заголовок Authorization
+    max_buffered_updates: int = 100_000
+    max_recorded_messages: int = 10_000
+    seed: Optional[int] = None
+
+
+def make_message_update(user_id: int, text: str, chat_id: Optional[int] = None,
+                        timestamp: Optional[int] = None) -> Dict[str, Any]:
+    """Build a message_created update as MAX sends it."""
+    return {
+        'update_type': 'message_created',
+        'timestamp': timestamp,
+        'message': {
+            'recipient': {'chat_id': chat_id or user_id, 'chat_type': 'dialog'},
+            'sender': {'user_id': user_id, 'first_name': f'User {user_id}', 'is_bot': False},
+            'body': {'mid': f'user.{user_id}.{timestamp}', 'text': text},
+            'timestamp': timestamp,
+        },
+    }
+
+
+def make_bot_started_update(user_id: int, chat_id: Optional[int] = None,
+                            timestamp: Optional[int] = None) -> Dict[str, Any]:
+    """Build a bot_started update (user opened the bot)."""
+    return {
+        'update_type': 'bot_started',
+        'timestamp': timestamp,
+        'chat_id': chat_id or user_id,
+        'user': {'user_id': user_id, 'first_name': f'User {user_id}', 'is_bot': False},
+    }
+
+
+def make_callback_update(user_id: int, payload: str, message_id: Optional[str] = None,
+                         chat_id: Optional[int] = None, timestamp: Optional[int] = None) -> Dict[str, Any]:
+    """Build a message_callback update (button press on message_id)."""
+    return {
+        'update_type': 'message_callback',
+        'timestamp': timestamp,
+        'callback': {
+            'callback_id': f'cb.{user_id}.{timestamp}',
+            'payload': payload,
+            'user': {'user_id': user_id, 'first_name': f'User {user_id}', 'is_bot': False},
+            'timestamp': timestamp,
+        },
+        'message': {
+            'recipient': {'chat_id': chat_id or user_id, 'chat_type': 'dialog'},
+            'body': {'mid': message_id, 'text': ''},
+        },
+    }
+
+
+class TokenBucket:
+    """Rate limiter: rate tokens per second, up to burst stored."""
+    
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+    
+    def take(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class FakeMaxPlatform:
+    """In-memory MAX platform state and request handlers."""
+    
+    def __init__(self, config: Optional[FakeMaxConfig] = None):
+        self.config = config or FakeMaxConfig()
+        self.random = random.Random(self.config.seed)
+        # Вызываются для каждого отправленного или отредактированного сообщения (см. load_generator.py)
+        self.listeners: List[Callable[[Dict[str, Any]], None]] = []
+        self.reset()
+    
+    def reset(self):
+        """Drop all updates, messages and counters."""
+        # Updates хранятся с порядковыми номерами; marker - номер последнего выданного
+        self.updates: deque = deque(maxlen=self.config.max_buffered_updates)
+        self.next_seq = 1
+        self.last_timestamp = 0
+        self._new_updates = asyncio.Event()
+        
+        self.messages: deque = deque(maxlen=self.config.max_recorded_messages)
+        # message_id -> chat_id всех отправленных сообщений
+        self.known_messages: Dict[str, int] = {}
+        self.last_message_by_chat: Dict[int, str] = {}
+        self._message_ids = itertools.count(1)
+        
+        self.requests: Counter = Counter()
+        self.responses: Counter = Counter()
+        self.limiter = TokenBucket(self.config.rate_limit, self.config.rate_burst) if self.config.rate_limit else None
+    
+    def _next_timestamp(self) -> int:
+        # Бот отбрасывает updates с timestamp <= последнего, поэтому они строго возрастают
+        self.last_timestamp = max(int(time.time() * 1000), self.last_timestamp + 1)
+        return self.last_timestamp
+    
+    def add_update(self, update: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Queue an update for /updates.
+        
+        Принимает готовый update или сокращения {"user_id", "text"},
+        {"user_id", "payload"[, "message_id"]} и {"user_id", "event": "bot_started"}.
+        Для нажатия без message_id берется последнее сообщение бота в этом чате.
+        """
+        timestamp = self._next_timestamp()
+        if 'update_type' not in update:
+            user_id = int(update['user_id'])
+            chat_id = update.get('chat_id') or user_id
+            if update.get('event') == 'bot_started':
+                update = make_bot_started_update(user_id, chat_id, timestamp)
+            elif 'payload' in update:
+                message_id = update.get('message_id') or self.last_message_by_chat.get(chat_id)
+                update = make_callback_update(user_id, update['payload'], message_id, chat_id, timestamp)
+            else:
+                update = make_message_update(user_id, update.get('text', ''), chat_id, timestamp)
+        else:
+            update = dict(update, timestamp=timestamp)
+        
+        self.updates.append((self.next_seq, update))
+        self.next_seq += 1
+        self._new_updates.set()
+        return update
+    
+    def _pending(self, marker: int, limit: int) -> List[Dict[str, Any]]:
+        if not self.updates or self.updates[-1][0] <= marker:
+            return []
+        # Номера идут подряд - позицию находим без перебора
+        start = max(0, marker - self.updates[0][0] + 1)
+        return [update for _, update in itertools.islice(self.updates, start, start + limit)]
+    
+    async def _simulate(self, request: web.Request, limited: bool = False) -> Optional[web.Response]:
+        """Apply auth, latency, error rate and rate limit. Returns an error response or None."""
+        route = f'{request.method} {request.path}'
+        self.requests[route] += 1
+        
+        if self.config.token and request.headers.get('Authorization') != self.config.token:
+            return self._respond(route, 401, {'code': 'verify.token', 'message': 'Invalid access_token'})
+        
+        delay = self.config.latency_ms + self.random.uniform(0, self.config.jitter_ms)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+        
+        if limited and self.limiter is not None and not self.limiter.take():
+            return self._respond(route, 429, {'code': 'too.many.requests', 'message': 'Rate limit exceeded'})
+        
+        if self.config.error_rate and self.random.random() < self.config.error_rate:
+            return self._respond(route, 500, {'code': 'internal.error', 'message': 'Simulated failure'})
+        
+        return None
+    
+    def _record(self, record: Dict[str, Any]):
+        self.messages.append(record)
+        for listener in self.listeners:
+            listener(record)
+    
+    def _respond(self, route: str, status: int, body: Dict[str, Any]) -> web.Response:
+        self.responses[f'{route} {status}'] += 1
+        return web.json_response(body, status=status)
+    
+    async def handle_me(self, request: web.Request) -> web.Response:
+        error = await self._simulate(request)
+        if error is not None:
+            return error
+        return self._respond('GET /me', 200, {
+            'user_id': 1, 'name': 'Fake MAX bot', 'username': 'fake_max_bot', 'is_bot': True
+        })
+    
+    async def handle_updates(self, request: web.Request) -> web.Response:
+        error = await self._simulate(request)
+        if error is not None:
+            return error
+        
+        marker = int(request.query.get('marker') or 0)
+        if marker >= self.next_seq:
+            # marker из прошлого запуска сервера (после /_fake/reset) - начинаем сначала
+            marker = 0
+        limit = min(int(request.query.get('limit', 100)), 1000)
+        timeout = min(float(request.query.get('timeout', 30)), 90)
+        
+        updates = self._pending(marker, limit)
+        if not updates and timeout > 0:
+            # Long polling: ждем новые updates до timeout секунд
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            updates = self._pending(marker, limit)
+        
+        # marker указывает на последний выданный update
+        new_marker = marker
+        if updates:
+            new_marker = max(marker, self.updates[0][0] - 1) + len(updates)
+        return self._respond('GET /updates', 200, {'updates': updates, 'marker': new_marker})
+    
+    async def handle_send(self, request: web.Request) -> web.Response:
+        error = await self._simulate(request, limited=True)
+        if error is not None:
+            return error
+        
+        chat_id = int(request.query.get('chat_id') or request.query.get('user_id') or 0)
+        body = await request.json()
+        message_id = f'mid.{next(self._message_ids)}'
+        self.known_messages[message_id] = chat_id
+        self.last_message_by_chat[chat_id] = message_id
+        self._record({'chat_id': chat_id, 'message_id': message_id, 'action': 'send',
+                      'time': time.time(), 'body': body})
+        
+        return self._respond('POST /messages', 200, {'message': {
+            'recipient': {'chat_id': chat_id, 'chat_type': 'dialog'},
+            'body': {'mid': message_id, 'text': body.get('text', '')},
+            'timestamp': self._next_timestamp(),
+        }})
+    
+    async def handle_edit(self, request: web.Request) -> web.Response:
+        error = await self._simulate(request, limited=True)
+        if error is not None:
+            return error
+        
+        message_id = request.query.get('message_id')
+        if message_id not in self.known_messages:
+            return self._respond('PUT /messages', 404, {'code': 'not.found', 'message': 'Message not found'})
+        
+        body = await request.json()
+        self._record({'chat_id': self.known_messages[message_id], 'message_id': message_id, 'action': 'edit',
+                      'time': time.time(), 'body': body})
+        return self._respond('PUT /messages', 200, {'success': True})
+    
+    async def handle_answer(self, request: web.Request) -> web.Response:
+        error = await self._simulate(request, limited=True)
+        if error is not None:
+            return error
+        if not request.query.get('callback_id'):
+            return self._respond('POST /answers', 400, {'code': 'proto.payload', 'message': 'callback_id is required'})
+        return self._respond('POST /answers', 200, {'success': True})
+    
+    async def handle_inject(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        items = data.get('updates', [data]) if isinstance(data, dict) else data
+        added = [self.add_update(item) for item in items]
+        return web.json_response({'added': len(added), 'updates': added})
+    
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            'requests': dict(self.requests),
+            'responses': dict(self.responses),
+            'updates_total': self.next_seq - 1,
+            'updates_buffered': len(self.updates),
+            'messages_recorded': len(self.messages),
+        })
+    
+    async def handle_messages(self, request: web.Request) -> web.Response:
+        chat_id = request.query.get('chat_id')
+        messages = [m for m in self.messages if chat_id is None or str(m['chat_id']) == chat_id]
+        return web.json_response({'messages': messages})
+    
+    async def handle_reset(self, request: web.Request) -> web.Response:
+        self.reset()
+        return web.json_response({'success': True})
+
+
+def create_app(config: Optional[FakeMaxConfig] = None) -> web.Application:
+    """Create aiohttp application serving the fake MAX API."""
+    platform = FakeMaxPlatform(config)
+    app = web.Application()
+    app['platform'] = platform
+    app.router.add_get('/me', platform.handle_me)
+    app.router.add_get('/updates', platform.handle_updates)
+    app.router.add_post('/messages', platform.handle_send)
+    app.router.add_put('/messages', platform.handle_edit)
+    app.router.add_post('/answers', platform.handle_answer)
+    app.router.add_post('/_fake/updates', platform.handle_inject)
+    app.router.add_get('/_fake/stats', platform.handle_stats)
+    app.router.add_get('/_fake/messages', platform.handle_messages)
+    app.router.add_post('/_fake/reset', platform.handle_reset)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake MAX Platform API for local benchmarks')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='base response latency')
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help='random extra latency 0..N ms')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with 500')
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='sends/edits/answers per second (0 - unlimited)')
+    parser.add_argument('--rate-burst', type=int, default=0, help='burst size above the rate limit')
+    parser.add_argument('--token', help='require this Authorization header')
+    parser.add_argument('--seed', type=int, help='random seed for latency and errors')
+    args = parser.parse_args()
+    
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    config = FakeMaxConfig(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        rate_limit=args.rate_limit,
+        rate_burst=args.rate_burst,
+        token=args.token,
+        seed=args.seed,
+    )
+    logger.info(f"Fake MAX API on http://{args.host}:{args.port} with {config}")
+    web.run_app(create_app(config), host=args.host, port=args.port, access_log=None, print=None)
+
+
+if __name__ == '__main__':
+    main()
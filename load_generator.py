@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный генератор для MAX бота
+
+Виртуальные пользователи проходят диалог целиком, как живые: открывают
+бота (bot_started), нажимают кнопки из последней присланной клавиатуры
+и вводят текст там, где бот его ждет. Каждый пользователь идет по своей
+воронке (группы поддержки, специалист, информация + литература и т.д.).
+
+Бот (MaxBotApplication) и фейковый MAX API (fake_max_server.py)
+работают в этом же процессе. Режимы:
+- server: updates кладутся в фейковый сервер, бот забирает их long polling'ом
+  как в продакшене (один цикл опроса) - задержка включает ожидание в очереди
+- direct: process_update вызывается напрямую из каждого пользователя -
+  измеряется чистая стоимость обработки при заданной конкуренции
+
+Запуск:
+    python load_generator.py --users 2000 --ramp-s 20
+    python load_generator.py --users 500 --mode direct --latency-ms 30
+"""
+
+import argparse
+import asyncio
+import logging
+import random
+import time
+from collections import Counter, defaultdict
+from typing import Dict, Any, List, Optional, Tuple
+
+from aiohttp import web
+
+from bot.max_adapter import MaxBot, decode_callback_payload
+from bot.states import BotStates
+from fake_max_server import (
+    FakeMaxConfig,
+    create_app,
+    make_bot_started_update,
+    make_callback_update,
+    make_message_update,
+)
+
+# Воронки: префиксы payload в порядке предпочтения. На каждом шаге выбирается
+# первая подходящая кнопка (среди нескольких подходящих - случайная), каждый
+# префикс срабатывает один раз - так после тупикового экрана (группы, FAQ)
+# пользователь нажимает "Назад" и идет дальше по воронке.
+FUNNELS: Dict[str, Tuple[str, ...]] = {
+    'support_group': ('dep_', 'timezone_', 'city_', 'help_groups_selection', 'back_to_help',
+                      'help_info', 'choose_support', 'sos_support_group',
+                      'continue_to_discovery', 'found_', 'yes_'),
+    'specialist': ('dep_', 'timezone_', 'city_', 'help_specialist', 'gender_', 'ageu_', 'ages_',
+                   'continue_to_discovery', 'found_', 'no_'),
+    'info_literature': ('dep_', 'timezone_', 'city_', 'help_info', 'choose_literature', 'lit_',
+                        'continue_after_literature', 'found_', 'yes_'),
+    'info_support': ('dep_', 'timezone_', 'city_', 'help_info', 'choose_support', 'sos_specialist',
+                     'gender_', 'ageu_', 'ages_', 'continue_to_discovery', 'found_', 'no_'),
+    'faq': ('dep_', 'timezone_', 'city_', 'help_faq', 'back_to_help', 'help_info',
+            'choose_literature', 'lit_', 'continue_after_literature', 'found_', 'no_'),
+}
+
+DEFAULT_FUNNEL_WEIGHTS = {
+    'support_group': 0.3,
+    'specialist': 0.25,
+    'info_literature': 0.2,
+    'info_support': 0.15,
+    'faq': 0.1,
+}
+
+# Кнопки навигации - нажимаются, только если воронка явно их предпочитает
+NAVIGATION_PREFIXES = ('back_', 'restart_conversation', 'cancel_help', 'final_')
+
+# Состояния, в которых бот ждет текст
+TEXT_INPUT_STATES = {
+    BotStates.GROUP_NAME_INPUT.value: 'Группа "Новая жизнь"',
+    BotStates.PSYCHOLOGIST_NAME_INPUT.value: 'Анна Петровна',
+    BotStates.ANONYMOUS_QUESTION_INPUT.value: 'Как понять, что мне нужна помощь?',
+}
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+class KeyboardTracker:
+    """Remembers the latest inline keyboard the bot showed in each chat."""
+    
+    def __init__(self):
+        # chat_id -> (message_id, [payload, ...]) или None, если клавиатуру убрали
+        self.keyboards: Dict[int, Optional[Tuple[str, List[str]]]] = {}
+    
+    def on_message(self, record: Dict[str, Any]):
+        attachments = record['body'].get('attachments')
+        if attachments is None:
+            # Сообщение без клавиатуры не меняет уже показанную
+            return
+        payloads = [
+            button['payload']
+            for attachment in attachments if attachment.get('type') == 'inline_keyboard'
+            for row in attachment['payload']['buttons']
+            for button in row if button.get('type') == 'callback'
+        ]
+        self.keyboards[record['chat_id']] = (record['message_id'], payloads) if payloads else None
+
+
+class LoadGenerator:
+    """Runs virtual users against an in-process bot and collects per-step latencies."""
+    
+    def __init__(self, app, platform, mode: str, think_ms: float, max_steps: int,
+                 step_timeout: float, seed: int):
+        self.app = app
+        self.platform = platform
+        self.mode = mode
+        self.think_ms = think_ms
+        self.max_steps = max_steps
+        self.step_timeout = step_timeout
+        self.random = random.Random(seed)
+        
+        self.keyboards = KeyboardTracker()
+        platform.listeners.append(self.keyboards.on_message)
+        
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.outcomes: Counter = Counter()
+        self.completed_by_funnel: Counter = Counter()
+        self.updates_sent = 0
+        self.timeouts = 0
+        
+        # update_id -> future, завершаемый после обработки update ботом (режим server)
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._timestamp = int(time.time() * 1000)
+        
+        if mode == 'server':
+            original = app.process_update
+            
+            async def process_update(max_update):
+                try:
+                    await original(max_update)
+                finally:
+                    future = self._pending.pop(max_update.update_id, None)
+                    if future is not None and not future.done():
+                        future.set_result(None)
+            
+            app.process_update = process_update
+    
+    def _build(self, kind: str, user_id: int, value: Optional[str] = None,
+               message_id: Optional[str] = None) -> Dict[str, Any]:
+        if self.mode == 'server':
+            shorthand = {'user_id': user_id}
+            if kind == 'started':
+                shorthand['event'] = 'bot_started'
+            elif kind == 'callback':
+                shorthand.update(payload=value, message_id=message_id)
+            else:
+                shorthand['text'] = value
+            return shorthand
+        
+        self._timestamp += 1
+        if kind == 'started':
+            return make_bot_started_update(user_id, timestamp=self._timestamp)
+        if kind == 'callback':
+            return make_callback_update(user_id, value, message_id, timestamp=self._timestamp)
+        return make_message_update(user_id, value, timestamp=self._timestamp)
+    
+    async def _act(self, step: str, update: Dict[str, Any]) -> bool:
+        """Deliver one update and wait until the bot has processed it."""
+        self.updates_sent += 1
+        started = time.perf_counter()
+        
+        if self.mode == 'server':
+            future = asyncio.get_running_loop().create_future()
+            stored = self.platform.add_update(update)
+            self._pending[stored['timestamp']] = future
+            try:
+                await asyncio.wait_for(future, self.step_timeout)
+            except asyncio.TimeoutError:
+                self._pending.pop(stored['timestamp'], None)
+                self.timeouts += 1
+                return False
+        else:
+            await self.app.process_update(MaxBot.parse_update(update))
+        
+        self.latencies[step].append(time.perf_counter() - started)
+        return True
+    
+    def _choose(self, funnel: str, payloads: List[str], used: set) -> Optional[str]:
+        for prefix in FUNNELS[funnel]:
+            if prefix in used:
+                continue
+            matches = [p for p in payloads if decode_callback_payload(p)[0].startswith(prefix)]
+            if matches:
+                used.add(prefix)
+                return self.random.choice(matches)
+        # Воронка не знает этот экран - идем дальше по любой кнопке, кроме навигации
+        forward = [p for p in payloads if not decode_callback_payload(p)[0].startswith(NAVIGATION_PREFIXES)]
+        return self.random.choice(forward) if forward else None
+    
+    async def virtual_user(self, user_id: int, funnel: str):
+        """Walk one conversation from bot_started to the end of the funnel."""
+        if not await self._act('bot_started', self._build('started', user_id)):
+            self.outcomes['timeout'] += 1
+            return
+        
+        used = set()
+        for _ in range(self.max_steps):
+            state = self.app.user_states.get(user_id)
+            if state == BotStates.CONVERSATION_END.value:
+                self.outcomes['completed'] += 1
+                self.completed_by_funnel[funnel] += 1
+                return
+            
+            if self.think_ms:
+                await asyncio.sleep(self.random.uniform(0.5, 1.5) * self.think_ms / 1000)
+            
+            if state in TEXT_INPUT_STATES:
+                update = self._build('text', user_id, TEXT_INPUT_STATES[state])
+            else:
+                keyboard = self.keyboards.keyboards.get(user_id)
+                payload = self._choose(funnel, keyboard[1], used) if keyboard else None
+                if payload is None:
+                    self.outcomes[f'stuck in {state}'] += 1
+                    return
+                update = self._build('callback', user_id, payload, keyboard[0])
+            
+            if not await self._act(state or 'no_state', update):
+                self.outcomes['timeout'] += 1
+                return
+        
+        self.outcomes['step limit'] += 1
+    
+    async def run(self, users: int, ramp_s: float, weights: Dict[str, float]) -> float:
+        """Start users evenly over ramp_s seconds and wait for all of them."""
+        funnels = list(weights)
+        tasks = []
+        started = time.perf_counter()
+        for index in range(users):
+            funnel = self.random.choices(funnels, weights=[weights[f] for f in funnels])[0]
+            tasks.append(asyncio.create_task(self.virtual_user(index + 1, funnel)))
+            if ramp_s:
+                await asyncio.sleep(ramp_s / users)
+        await asyncio.gather(*tasks)
+        return time.perf_counter() - started
+    
+    def report(self, elapsed: float):
+        all_latencies = sorted(value for values in self.latencies.values() for value in values)
+        print(f"\nVirtual users: {sum(self.outcomes.values())}, elapsed {elapsed:.1f}s")
+        print(f"Updates: {self.updates_sent}, processed {len(all_latencies)}, timeouts {self.timeouts}")
+        print(f"Throughput: {len(all_latencies) / elapsed:.0f} updates/s")
+        print(f"Outcomes: {dict(self.outcomes)}")
+        print(f"Completed by funnel: {dict(self.completed_by_funnel)}\n")
+        
+        print(f"{'step':<28} {'count':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+        rows = sorted(self.latencies.items(), key=lambda item: -len(item[1]))
+        for step, values in rows + [('ALL', all_latencies)]:
+            values = sorted(values)
+            print(f"{step:<28} {len(values):>7} {percentile(values, 0.5) * 1000:>8.1f} "
+                  f"{percentile(values, 0.95) * 1000:>8.1f} {percentile(values, 0.99) * 1000:>8.1f} "
+                  f"{(values[-1] if values else 0) * 1000:>8.1f}")
+
+
+async def main_async(args):
+    from main_max import MaxBotApplication
+    
+    config = FakeMaxConfig(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                           error_rate=args.error_rate, rate_limit=args.rate_limit, seed=args.seed)
+    server_app = create_app(config)
+    runner = web.AppRunner(server_app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', args.port).start()
+    
+    app = MaxBotApplication('load-test', f'http://127.0.0.1:{args.port}', verify_ssl=False)
+    generator = LoadGenerator(app, server_app['platform'], args.mode, args.think_ms,
+                              args.max_steps, args.step_timeout, args.seed)
+    
+    bot_task = asyncio.create_task(app.run()) if args.mode == 'server' else None
+    try:
+        elapsed = await generator.run(args.users, args.ramp_s, DEFAULT_FUNNEL_WEIGHTS)
+    finally:
+        if bot_task is not None:
+            app.request_stop()
+            await bot_task
+        elif app.bot.session:
+            await app.bot.session.close()
+        await runner.cleanup()
+    
+    generator.report(elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Synthetic conversation load for the MAX bot')
+    parser.add_argument('--users', type=int, default=1000, help='number of virtual users')
+    parser.add_argument('--ramp-s', type=float, default=10.0, help='spread user arrivals over N seconds')
+    parser.add_argument('--think-ms', type=float, default=500.0, help='mean pause between user actions')
+    parser.add_argument('--mode', choices=('server', 'direct'), default='server')
+    parser.add_argument('--max-steps', type=int, default=30, help='give up on a user after N actions')
+    parser.add_argument('--step-timeout', type=float, default=30.0, help='seconds to wait for a reply')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='fake API latency')
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help='fake API latency jitter')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fake API error rate')
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='fake API sends per second')
+    parser.add_argument('--port', type=int, default=18766)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    
+    # Логи бота на каждый update искажают замер
+    logging.disable(logging.CRITICAL)
+    asyncio.run(main_async(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -26,6 +26,10 @@ from telegram.ext import (
 from config import Config
 from bot.conversation_flow import ConversationFlow
 from bot.handlers import BotHandlers
+from bot.crisis import create_crisis_detector
+from bot.questions import QuestionDigest, QuestionQueue
+from bot.analytics import EventLog, FunnelAnalytics
+from bot.flight_recorder import FlightRecorder
 from bot.utils import setup_logging
 
 # Setup logging
@@ -37,16 +41,57 @@ def main():
     # Initialize configuration
     config = Config()
     
-    # Create the Application
-    application = Application.builder().token(config.BOT_TOKEN).build()
-    
     # Initialize conversation flow and handlers
     conversation_flow = ConversationFlow()
-    bot_handlers = BotHandlers(conversation_flow)
+    bot_handlers = BotHandlers(conversation_flow, create_crisis_detector(config.CRISIS_LEXICON_PATH))
+    bot_handlers.admin_ids = frozenset(config.ADMIN_IDS)
+    if config.ANALYTICS_DIR:
+        bot_handlers.analytics = FunnelAnalytics(EventLog(
+            config.ANALYTICS_DIR,
+            segment_max_bytes=config.ANALYTICS_SEGMENT_MB * 1024 * 1024,
+            flush_interval=config.ANALYTICS_FLUSH_INTERVAL
+        ))
+    if config.FLIGHT_RECORDER_RECORDS > 0:
+        # Здесь в журнал попадают только переходы: updates и отправки пишет адаптер MAX
+        bot_handlers.flight_recorder = FlightRecorder(config.FLIGHT_RECORDER_RECORDS, config.FLIGHT_RECORDER_USERS)
+    
+    # Анонимные вопросы уходят администраторам дайджестами (bot/questions.py)
+    async def post_init(application: Application):
+        if bot_handlers.analytics is not None:
+            await bot_handlers.analytics.start()
+        if config.ADMIN_IDS:
+            await start_question_digest(application)
+    
+    async def post_shutdown(application: Application):
+        if bot_handlers.questions is not None:
+            await bot_handlers.questions.stop()
+        if bot_handlers.analytics is not None:
+            await bot_handlers.analytics.stop()
+    
+    async def start_question_digest(application: Application):
+        async def send(chat_id: int, text: str) -> bool:
+            await application.bot.send_message(chat_id, text)
+            return True
+        
+        bot_handlers.questions = QuestionDigest(
+            QuestionQueue(config.QUESTIONS_PATH),
+            send,
+            config.ADMIN_IDS,
+            interval=config.QUESTION_DIGEST_INTERVAL,
+            min_interval=config.QUESTION_DIGEST_MIN_INTERVAL,
+            batch_size=config.QUESTION_DIGEST_BATCH
+        )
+        bot_handlers.questions.start()
+    
+    # Create the Application
+    application = Application.builder().token(config.BOT_TOKEN).post_init(post_init).post_shutdown(post_shutdown).build()
+    
+    # На сообщения с признаками кризиса экстренные контакты отправляются до обработчиков диалога
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, bot_handlers.crisis_guard), group=-1)
     
     # Add conversation handler
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler('start', bot_handlers.start)],
+        entry_points=[CommandHandler('start', bot_handlers.start_conversation)],
         states=bot_handlers.get_conversation_states(),
         fallbacks=[
             CommandHandler('help', bot_handlers.help_command),
@@ -62,6 +107,10 @@ def main():
     
     # Add other handlers
     application.add_handler(CommandHandler('help', bot_handlers.help_command))
+    application.add_handler(CommandHandler('stats', bot_handlers.stats_command))
+    application.add_handler(CommandHandler('flight', bot_handlers.flight_command))
+    # Трассировка updates есть только в MAX-боте: здесь /traces отвечает, что буфер не включен
+    application.add_handler(CommandHandler('traces', bot_handlers.traces_command))
     
     # Run the bot
     logger.info("Starting Telegram Dependency Counseling Bot...")
@@ -7,7 +7,11 @@ Main entry point for the MAX bot application.
 import logging
 import asyncio
 import os
-from typing import Dict, Any
+import signal
+import time
+from collections.abc import MutableMapping
+from contextlib import nullcontext
+from typing import Callable, Dict, Any, Iterable, Iterator, List, Optional
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -19,6 +23,19 @@ from config import Config
 from bot.conversation_flow import ConversationFlow
 from bot.handlers import BotHandlers
 from bot.utils import setup_logging
+from bot.persistence import SessionStore, WriteBehindSessionWriter, sqlite_path_from_url
+from bot.session import SessionRecord
+from bot.navigation import HISTORY_KEY
+from bot.snapshot import RuntimeSnapshot, save_snapshot, load_snapshot
+from bot.sharding import ShardedSupervisor
+from bot.leader import ReplicaCoordinator, create_coordination_backend
+from bot.runtime import run as run_event_loop, describe_runtime
+from bot.capture import CaptureWriter
+from bot.crisis import create_crisis_detector
+from bot.analytics import EventLog, FunnelAnalytics
+from bot.questions import QuestionDigest, QuestionQueue
+from bot.tracing import Tracer, create_tracer
+from bot.flight_recorder import ERROR, UPDATE, FlightRecorder
 from bot.max_adapter import (
     MaxBot, 
     MaxUpdate, 
@@ -95,28 +112,200 @@ class MaxContextProxy:
         self.bot_data = {}
 
 
+class UserStatesView(MutableMapping):
+    """
+    user_id -> current state, read from and written to context.user_data['current_state'].
+    
+    Состояние хранится только в данных пользователя (их же сохраняют сессии и снимок),
+    словарь - лишь удобный доступ к нему. Для упакованных сессий состояние читается
+    из SessionRecord без распаковки в user_data.
+    """
+    
+    def __init__(self, contexts: Dict[int, MaxContextProxy], get_context: Callable[[int], MaxContextProxy],
+                 packed_sessions: Dict[int, bytes]):
+        self._contexts = contexts
+        self._get_context = get_context
+        self._packed = packed_sessions
+    
+    def __getitem__(self, user_id: int) -> str:
+        context = self._contexts.get(user_id)
+        if context is not None:
+            state = context.user_data.get('current_state')
+        else:
+            packed = self._packed.get(user_id)
+            state = SessionRecord.from_bytes(packed).current_state if packed is not None else None
+        if state is None:
+            raise KeyError(user_id)
+        return state
+    
+    def __setitem__(self, user_id: int, state: str):
+        self._get_context(user_id).user_data['current_state'] = state
+    
+    def __delitem__(self, user_id: int):
+        if user_id in self._packed:
+            self._get_context(user_id)
+        context = self._contexts.get(user_id)
+        if context is None or context.user_data.pop('current_state', None) is None:
+            raise KeyError(user_id)
+    
+    def __iter__(self) -> Iterator[int]:
+        for user_id, context in list(self._contexts.items()):
+            if context.user_data.get('current_state') is not None:
+                yield user_id
+        for user_id, packed in list(self._packed.items()):
+            if SessionRecord.from_bytes(packed).state:
+                yield user_id
+    
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
 class MaxBotApplication:
     """Main application for MAX bot."""
     
-    def __init__(self, token: str, base_url: str = "https://platform-api.max.ru", verify_ssl: bool = True):
+    def __init__(self, token: str, base_url: str = "https://platform-api.max.ru", verify_ssl: bool = True,
+                 session_store: Optional[SessionStore] = None,
+                 session_flush_interval: float = 0.5,
+                 session_flush_max_updates: int = 100,
+                 snapshot_path: Optional[str] = None,
+                 shutdown_timeout: float = 10.0,
+                 crisis_lexicon_path: Optional[str] = None):
         self.token = token
         self.base_url = base_url
         self.bot = MaxBot(token, base_url, verify_ssl=verify_ssl)
         self.conversation_flow = ConversationFlow()
-        self.bot_handlers = BotHandlers(self.conversation_flow)
+        self.bot_handlers = BotHandlers(self.conversation_flow, create_crisis_detector(crisis_lexicon_path))
+        
+        # Команды администраторов: воронка, трассы, последние события пользователя
+        self.admin_commands = {
+            '/stats': self.bot_handlers.stats_command,
+            '/traces': self.bot_handlers.traces_command,
+            '/flight': self.bot_handlers.flight_command,
+        }
         
         # Store user contexts
         self.user_contexts: Dict[int, MaxContextProxy] = {}
         
-        # Store user states
-        self.user_states: Dict[int, str] = {}
+        # Сессии, восстановленные при запуске, хранятся упакованными (SessionRecord.to_bytes,
+        # ~60 байт вместо ~800 у dict) и распаковываются в контекст при первом update пользователя
+        self.packed_sessions: Dict[int, bytes] = {}
+        
+        # Текущие состояния пользователей (хранятся в user_data)
+        self.user_states = UserStatesView(self.user_contexts, self.get_user_context, self.packed_sessions)
+        
+        # Количество callback'ов, отброшенных при объединении нажатий
+        self.coalesced_callbacks = 0
+        
+        # Количество нажатий на кнопки устаревших клавиатур
+        self.stale_callbacks = 0
+        
+        # Дайджесты анонимных вопросов для администраторов (create_question_digest)
+        self.question_digest: Optional[QuestionDigest] = None
+        
+        # Воронка переходов по шагам диалога (create_funnel_analytics)
+        self.analytics: Optional[FunnelAnalytics] = None
+        
+        # Трассировка обработки updates (attach_tracer); по умолчанию выключена
+        self.tracer = Tracer()
+        # Длительность последнего запроса /updates (мс) - атрибут span updates из него
+        self._last_poll_ms = 0.0
+        
+        # Последние события каждого пользователя для /flight (create_flight_recorder)
+        self.flight_recorder: Optional[FlightRecorder] = None
+        
+        # Отложенное сохранение сессий (если настроено хранилище)
+        self.session_writer: Optional[WriteBehindSessionWriter] = None
+        if session_store is not None:
+            self.session_writer = WriteBehindSessionWriter(
+                session_store,
+                self.get_session_snapshot,
+                flush_interval=session_flush_interval,
+                max_pending_updates=session_flush_max_updates,
+                # История ссылается на экраны в кэше процесса - после перезапуска она бесполезна
+                skip_keys=(HISTORY_KEY,)
+            )
+        
+        # Корректная остановка: снимок состояния и время на завершение обработки
+        self.snapshot_path = snapshot_path
+        self.shutdown_timeout = shutdown_timeout
+        self._stopping = asyncio.Event()
+        self._poll_task: Optional[asyncio.Task] = None
+        self._batch_task: Optional[asyncio.Task] = None
+        
+        # Позиция опроса, до которой все updates полностью обработаны
+        self._committed_marker = None
+        self._processed_update_id = 0
+    
+    def attach_tracer(self, tracer: Tracer):
+        """Trace updates, handlers and MAX API calls with the given tracer."""
+        self.tracer = tracer
+        self.bot.tracer = tracer
+        self.bot_handlers.tracer = tracer
     
     def get_user_context(self, user_id: int) -> MaxContextProxy:
         """Get or create context for a user."""
         if user_id not in self.user_contexts:
-            self.user_contexts[user_id] = MaxContextProxy()
+            context = self.user_contexts[user_id] = MaxContextProxy()
+            packed = self.packed_sessions.pop(user_id, None)
+            if packed is not None:
+                context.user_data = SessionRecord.from_bytes(packed).to_user_data()
         return self.user_contexts[user_id]
     
+    def get_session_snapshot(self, user_id: int) -> Dict[str, Any]:
+        """Get current session data of a user for persistence."""
+        context = self.user_contexts.get(user_id)
+        if context is None and user_id in self.packed_sessions:
+            return SessionRecord.from_bytes(self.packed_sessions[user_id]).to_user_data()
+        return dict(context.user_data) if context else {}
+    
+    def _store_session(self, user_id: int, user_data: Dict[str, Any]):
+        # Упаковываются только сессии, которые SessionRecord передает без потерь
+        record = SessionRecord.from_user_data(user_data)
+        if record.to_user_data() == user_data:
+            self.packed_sessions[user_id] = record.to_bytes()
+        else:
+            self.get_user_context(user_id).user_data = user_data
+    
+    def restore_sessions(self, sessions: Dict[int, Dict[str, Any]]):
+        """Restore user contexts and states from persisted session data."""
+        for user_id, session in sessions.items():
+            if user_id in self.user_contexts or user_id in self.packed_sessions:
+                self.get_user_context(user_id).user_data.update(session)
+            else:
+                self._store_session(user_id, dict(session))
+    
+    def build_snapshot(self) -> RuntimeSnapshot:
+        """Collect polling position, sessions and keyboard versions for a restart."""
+        sessions = {user_id: SessionRecord.from_bytes(packed) for user_id, packed in list(self.packed_sessions.items())}
+        sessions.update((user_id, SessionRecord.from_user_data(self.get_session_snapshot(user_id)))
+                        for user_id in list(self.user_contexts))
+        return RuntimeSnapshot(
+            marker=self._committed_marker,
+            last_update_id=self._processed_update_id,
+            sessions=sessions,
+            keyboard_versions=dict(self.bot.keyboard_versions)
+        )
+    
+    def restore_snapshot(self, snapshot: RuntimeSnapshot):
+        """Resume from a snapshot written on the previous shutdown."""
+        # Снимок новее хранилища сессий - его данные заменяют загруженные
+        for user_id, record in snapshot.sessions.items():
+            if user_id in self.user_contexts:
+                self.user_contexts[user_id].user_data = record.to_user_data()
+            else:
+                self.packed_sessions[user_id] = record.to_bytes()
+        
+        self.bot.keyboard_versions.update(snapshot.keyboard_versions)
+        
+        # Повторно запрашиваем пакет, обработка которого была прервана;
+        # уже обработанные из него updates отсеются по last_update_id
+        self.bot.last_marker = snapshot.marker
+        self.bot.last_update_id = snapshot.last_update_id
+        self._committed_marker = snapshot.marker
+        self._processed_update_id = snapshot.last_update_id
+        
+        logger.info(f"Restored snapshot: {len(snapshot.sessions)} sessions, marker={snapshot.marker}")
+    
     async def handle_message(self, update: MaxUpdateProxy, context: MaxContextProxy):
         """Handle incoming message."""
         if not update.message:
@@ -125,16 +314,28 @@ class MaxBotApplication:
         text = update.message.text
         user_id = update.effective_user.get('id')
         
+        # Признаки кризиса - сразу экстренные контакты, в том числе до начала диалога;
+        # затем сообщение обрабатывается как обычно
+        await self.bot_handlers.check_crisis(update, context)
+        
+        # Команды администраторов доступны вне зависимости от шага диалога
+        parts = text.split() if text else []
+        command = parts[0] if parts else ''
+        admin_command = self.admin_commands.get(command)
+        if admin_command is not None:
+            await admin_command(update, context)
+            return
+        
         # If new user (no state) - automatically start conversation
         if user_id not in self.user_states:
             logger.info(f"New user {user_id} connected, automatically starting conversation")
-            new_state = await self.bot_handlers.start(update, context)
+            new_state = await self.bot_handlers.start_conversation(update, context)
             self.user_states[user_id] = new_state
             return
         
         # Handle /start command
         if text == '/start':
-            new_state = await self.bot_handlers.start(update, context)
+            new_state = await self.bot_handlers.start_conversation(update, context)
             self.user_states[user_id] = new_state
         
         # Handle /help command
@@ -144,8 +345,7 @@ class MaxBotApplication:
         # Handle /cancel command
         elif text == '/cancel':
             await self.bot_handlers.cancel(update, context)
-            if user_id in self.user_states:
-                del self.user_states[user_id]
+            self.user_states.pop(user_id, None)
         
         # Handle /back command
         elif text == '/back':
@@ -170,117 +370,333 @@ class MaxBotApplication:
             await update.callback_query.answer("Сессия истекла. Начните заново с /start")
             return
         
-        # Route to appropriate handler based on current state
-        new_state = await self.route_callback_to_handler(update, context, current_state)
+        # Нажатие на кнопку старой клавиатуры отклоняем без запуска обработчика
+        chat_id = update.callback_query.message.get('chat', {}).get('id')
+        if self.bot.is_stale_callback(chat_id, update.callback_query.payload_version):
+            self.stale_callbacks += 1
+            logger.info(f"Rejecting stale callback from user {user_id}: {update.callback_query.data}")
+            if self.flight_recorder is not None:
+                self.flight_recorder.record(ERROR, f"stale keyboard version {update.callback_query.payload_version}")
+            await update.callback_query.answer("Это меню устарело. Воспользуйтесь последним сообщением.")
+            return
         
-        if new_state:
-            self.user_states[user_id] = new_state
+        # Подтверждаем нажатие сразу, не дожидаясь ответа обработчика
+        update.callback_query.acknowledge()
+        
+        try:
+            # Route to appropriate handler based on current state
+            await self.route_callback_to_handler(update, context, current_state)
+        finally:
+            # Дожидаемся подтверждения, даже если обработчик его не вызвал
+            await update.callback_query.answer()
     
     async def route_callback_to_handler(self, update: MaxUpdateProxy, 
                                        context: MaxContextProxy, 
                                        current_state: str) -> str:
-        """Route callback to the appropriate handler based on state."""
-        from bot.states import BotStates
-        
-        # Получаем callback_data
-        callback_data = update.callback_query.data if update.callback_query else None
-        
-        # Глобальные обработчики (не зависят от состояния)
-        global_handlers = {
-            'continue_to_discovery': self.bot_handlers.handle_continue_to_discovery,
-            'choose_support': self.bot_handlers.handle_choose_support,
-            'choose_literature': self.bot_handlers.handle_choose_literature,
-            'skip_both': self.bot_handlers.handle_skip_both,
-            'continue_after_info': self.bot_handlers.handle_continue_after_info,
-            'continue_after_literature': self.bot_handlers.handle_continue_after_literature,
-            'restart_conversation': self.bot_handlers.handle_restart_conversation,
-            'cancel_help': self.bot_handlers.handle_cancel_help,
-            'back_to_final': self.bot_handlers.handle_back_to_final,
-            'back_to_help': self.bot_handlers.handle_back_to_help,
-            'back_to_city': self.bot_handlers.back_to_city,
-            'back_to_timezones': self.bot_handlers.back_to_timezones,
-            'back_to_dependency': self.bot_handlers.back_to_dependency,
-            'final_faq': self.bot_handlers.handle_final_faq,
-            'final_webinars': self.bot_handlers.handle_final_webinars,
+        """Route callback to the handler of the current state (see bot/state_machine.py)."""
+        try:
+            new_state = await self.bot_handlers.dispatch_callback(update, context)
+        except Exception as e:
+            logger.error(f"Error in handler: {e}", exc_info=True)
+            self._record_error(e)
+            await update.callback_query.answer("Произошла ошибка. Попробуйте снова.")
+            return current_state
+        
+        return new_state or current_state
+    
+    async def handle_state_message(self, update: MaxUpdateProxy, 
+                                   context: MaxContextProxy, 
+                                   current_state: str):
+        """Handle text messages based on current state."""
+        try:
+            await self.bot_handlers.dispatch_text(update, context)
+        except Exception as e:
+            logger.error(f"Error in text handler: {e}", exc_info=True)
+            self._record_error(e)
+    
+    def coalesce_updates(self, updates: List[MaxUpdate]) -> List[MaxUpdate]:
+        """
+        Collapse rapid callback clicks of one user within a batch.
+        
+        Если пользователь несколько раз нажал кнопки одного и того же сообщения
+        до того, как бот успел ответить, все нажатия приходят одним пакетом.
+        Обрабатывается только последнее из них: остальные относятся к той же
+        клавиатуре и устарели бы сразу после первого ответа. Текстовое сообщение
+        пользователя разделяет серии нажатий. Порядок обновлений сохраняется.
+        """
+        kept = []
+        # user_id -> mid сообщений, нажатия по которым уже учтены (идем с конца)
+        seen_sources: Dict[int, set] = {}
+        
+        for max_update in reversed(updates):
+            user = max_update.effective_user
+            user_id = user.get('id') if user else None
+            
+            if user_id is None or max_update.update_type != 'message_callback':
+                if user_id is not None:
+                    seen_sources.pop(user_id, None)
+                kept.append(max_update)
+                continue
+            
+            message = (max_update.raw_data or {}).get('message') or {}
+            source_mid = (message.get('body') or {}).get('mid')
+            sources = seen_sources.setdefault(user_id, set())
+            
+            if source_mid in sources:
+                self.coalesced_callbacks += 1
+                logger.info(f"Dropping superseded callback from user {user_id}: "
+                            f"{(max_update.raw_data or {}).get('callback', {}).get('payload')}")
+                continue
+            
+            sources.add(source_mid)
+            kept.append(max_update)
+        
+        kept.reverse()
+        return kept
+    
+    async def process_update(self, max_update: MaxUpdate):
+        """
+        Process a single update from MAX.
+        
+        Все сообщения, отправленные обработчиками, собираются в буфер
+        ответов и отправляются одним пакетом после обработки update.
+        """
+        user = max_update.effective_user
+        attributes = {
+            'update.id': max_update.update_id or 0,
+            'update.type': max_update.update_type or '',
+            'user.id': (user.get('id') if user else None) or 0,
+            'poll_ms': round(self._last_poll_ms, 1),
         }
+        # timestamp MAX - время события у пользователя (мс): сколько update ждал опроса и очереди
+        if max_update.timestamp and max_update.timestamp > 10 ** 12:
+            attributes['queue_ms'] = round(time.time() * 1000 - max_update.timestamp, 1)
         
-        # Проверяем глобальные обработчики
-        if callback_data in global_handlers:
-            try:
-                handler = global_handlers[callback_data]
-                return await handler(update, context)
-            except Exception as e:
-                logger.error(f"Error in global handler: {e}", exc_info=True)
-                return current_state
-        
-        # Маршрутизация по состоянию
-        handlers_map = {
-            # Основные состояния выбора
-            BotStates.DEPENDENCY_SELECTION.value: self.bot_handlers.handle_dependency_selection,
-            BotStates.TIME_ZONE_SELECTION.value: self.bot_handlers.handle_timezone_selection,
-            BotStates.CITY_SELECTION.value: self.bot_handlers.handle_city_selection,
+        if self.flight_recorder is None:
+            recording = nullcontext()
+        else:
+            user_id = attributes['user.id'] or None
+            recording = self.flight_recorder.bind(user_id)
+            self.flight_recorder.record(UPDATE, self._describe_update(max_update), user_id)
+        
+        with recording, self.tracer.trace('update', attributes):
+            async with self.bot.reply_buffer():
+                with self.tracer.span('route'):
+                    await self._dispatch_update(max_update)
+        
+        # Обработчики меняют только context.user_data - сохранение идет в фоне
+        if self.session_writer is not None:
+            user = max_update.effective_user
+            if user and user.get('id'):
+                self.session_writer.mark_dirty(user['id'])
+    
+    @staticmethod
+    def _describe_update(max_update: MaxUpdate) -> str:
+        """Compact description of an update for the flight recorder."""
+        if max_update.update_type == 'message_callback':
+            return f"callback {(max_update.raw_data or {}).get('callback', {}).get('payload', '')}"
+        if max_update.message:
+            text = (max_update.message.get('body') or {}).get('text') or ''
+            # Команды целиком, свободный текст - только длина: в журнале нет того, что пишут пользователи
+            return f"message {text}" if text.startswith('/') else f"message text len={len(text)}"
+        return max_update.update_type or 'unknown'
+    
+    def _record_error(self, error: Exception) -> None:
+        if self.flight_recorder is not None:
+            self.flight_recorder.record(ERROR, f"{type(error).__name__}: {error}")
+    
+    async def _dispatch_update(self, max_update: MaxUpdate):
+        """Route a single update to the appropriate handler."""
+        try:
+            logger.info(f"Processing update: {max_update.update_id}, type: {max_update.update_type}")
             
-            # Состояния помощи
-            BotStates.HELP_TYPE.value: self.bot_handlers.handle_help_type,
-            BotStates.HELP_CHOICE.value: self.bot_handlers.handle_support_choice_after_info,
+            # Обработка события подключения пользователя к боту
+            if max_update.update_type == 'bot_started':
+                logger.info("User started bot, sending welcome message")
+                try:
+                    # Создаем прокси для отправки приветственного сообщения
+                    update = MaxUpdateProxy(max_update, self.bot)
+                    user_id = update.effective_user.get('id') if update.effective_user else None
+                    
+                    if user_id:
+                        context = self.get_user_context(user_id)
+                        # Вызываем метод start для отправки приветствия
+                        new_state = await self.bot_handlers.start_conversation(update, context)
+                        self.user_states[user_id] = new_state
+                        logger.info(f"Welcome message sent to user {user_id}")
+                    else:
+                        logger.warning("bot_started event without user_id")
+                except Exception as e:
+                    logger.error(f"Error handling bot_started: {e}", exc_info=True)
+                    self._record_error(e)
+                
+                return
             
-            # Литература
-            BotStates.LITERATURE_CHOICE.value: self.bot_handlers.handle_literature_choice,
+            # Обрабатываем только новые сообщения и callback'и
+            # Игнорируем message_edited, message_deleted и др.
+            if max_update.update_type not in ['message_created', 'message_callback']:
+                logger.info(f"Skipping update type: {max_update.update_type}")
+                return
             
-            # Поддержка или специалист
-            BotStates.SUPPORT_OR_SPECIALIST.value: self.bot_handlers.handle_support_or_specialist,
+            # Create proxy update
+            update = MaxUpdateProxy(max_update, self.bot)
             
-            # Настройки специалиста
-            BotStates.GENDER_PREFERENCE.value: self.bot_handlers.handle_gender_selection,
-            BotStates.AGE_USER.value: self.bot_handlers.handle_age_user,
-            BotStates.AGE_SPECIALIST_PREFERENCE.value: self.bot_handlers.handle_age_specialist,
+            # Get user context
+            user_id = update.effective_user.get('id') if update.effective_user else None
             
-            # Обнаружение
-            BotStates.HOW_FOUND_US.value: self.bot_handlers.handle_discovery_answer,
+            if not user_id:
+                logger.warning("Update without user_id, skipping")
+                return
             
-            # Анонимный вопрос
-            BotStates.ANONYMOUS_QUESTION_CHOICE.value: self.bot_handlers.handle_anonymous_question_choice,
+            logger.info(f"User ID: {user_id}")
             
-            # Информационные состояния
-            BotStates.FAQ_ANSWERS.value: self.bot_handlers.handle_final_faq,
-            BotStates.WEBINAR_SCHEDULE.value: self.bot_handlers.handle_final_webinars,
-        }
+            context = self.get_user_context(user_id)
+            
+            # Handle callback query or message (callback имеет приоритет!)
+            if update.callback_query:
+                logger.info(f"Handling callback query: {update.callback_query.data}")
+                await self.handle_callback_query(update, context)
+            elif update.message:
+                logger.info(f"Handling message: {update.message.text}")
+                await self.handle_message(update, context)
+            else:
+                logger.warning("Update has no message or callback_query")
+        
+        except Exception as e:
+            logger.error(f"Error processing update: {e}", exc_info=True)
+            self._record_error(e)
+    
+    def request_stop(self):
+        """
+        Begin graceful shutdown.
+        
+        Опрос прерывается сразу, текущему пакету updates дается
+        shutdown_timeout секунд на завершение, после чего он отменяется.
+        """
+        if self._stopping.is_set():
+            return
+        
+        logger.info(f"Shutdown requested, draining in-flight updates (up to {self.shutdown_timeout}s)")
+        self._stopping.set()
+        
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+        
+        if self._batch_task is not None:
+            asyncio.get_running_loop().call_later(self.shutdown_timeout, self._cancel_inflight)
+    
+    def _cancel_inflight(self):
+        """Cancel the batch that did not finish within the shutdown deadline."""
+        if self._batch_task is not None and not self._batch_task.done():
+            logger.warning("Shutdown deadline reached, cancelling in-flight updates")
+            self._batch_task.cancel()
+    
+    def _install_signal_handlers(self) -> List[int]:
+        """Stop gracefully on SIGTERM/SIGINT. Returns installed signals."""
+        loop = asyncio.get_running_loop()
+        installed = []
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, self.request_stop)
+                installed.append(sig)
+            except (NotImplementedError, RuntimeError):
+                # Windows: add_signal_handler недоступен, Ctrl+C придет как KeyboardInterrupt
+                pass
+        return installed
+    
+    async def _poll_updates(self) -> Optional[List[MaxUpdate]]:
+        """Long-poll for updates. Returns None if polling was interrupted by shutdown."""
+        self._poll_task = asyncio.ensure_future(self.bot.get_updates(timeout=30))
+        started = time.perf_counter()
+        try:
+            updates = await self._poll_task
+            self._last_poll_ms = (time.perf_counter() - started) * 1000
+            return updates
+        except asyncio.CancelledError:
+            if self._stopping.is_set():
+                return None
+            raise
+        finally:
+            self._poll_task = None
+    
+    async def _process_batch(self, updates: List[MaxUpdate]):
+        """Process updates of one poll and advance the committed polling position."""
+        for max_update in updates:
+            await self.process_update(max_update)
+            if max_update.update_id:
+                self._processed_update_id = max(self._processed_update_id, max_update.update_id)
         
-        handler = handlers_map.get(current_state)
+        self._committed_marker = self.bot.last_marker
+    
+    async def _run_batch(self, updates: List[MaxUpdate]):
+        """Run a batch as a task so shutdown can wait for it with a deadline."""
+        self._batch_task = asyncio.ensure_future(self._process_batch(updates))
+        try:
+            await self._batch_task
+        except asyncio.CancelledError:
+            if not self._stopping.is_set():
+                raise
+        finally:
+            self._batch_task = None
+    
+    async def start_services(self):
+        """
+        Start background components: session writes, question digests, analytics, trace export.
+        
+        Общая точка запуска для всех режимов (один процесс, воркер шарда,
+        реплика); останавливаются компоненты в stop_services(). Сессии
+        восстанавливает вызывающий код - в каждом режиме свой набор пользователей.
+        """
+        if self.session_writer is not None:
+            self.session_writer.start()
+        
+        if self.question_digest is not None:
+            self.question_digest.start()
+        
+        if self.analytics is not None:
+            await self.analytics.start()
+        
+        self.tracer.start()
+    
+    async def stop_services(self):
+        """Stop components started by start_services(), flushing what they buffered."""
+        if self.question_digest is not None:
+            await self.question_digest.stop()
+        
+        if self.analytics is not None:
+            try:
+                await self.analytics.stop()
+            except Exception as e:
+                logger.error(f"Error flushing analytics on shutdown: {e}", exc_info=True)
         
-        if handler:
+        if self.session_writer is not None:
             try:
-                return await handler(update, context)
+                await self.session_writer.stop()
             except Exception as e:
-                logger.error(f"Error in handler: {e}", exc_info=True)
-                await update.callback_query.answer("Произошла ошибка. Попробуйте снова.")
-                return current_state
+                logger.error(f"Error flushing sessions on shutdown: {e}", exc_info=True)
         
-        return current_state
+        try:
+            await self.tracer.stop()
+        except Exception as e:
+            logger.error(f"Error flushing trace spans on shutdown: {e}", exc_info=True)
     
-    async def handle_state_message(self, update: MaxUpdateProxy, 
-                                   context: MaxContextProxy, 
-                                   current_state: str):
-        """Handle text messages based on current state."""
-        from bot.states import BotStates
-        
-        # Text input handlers for specific states
-        text_handlers = {
-            BotStates.AGE_USER.value: self.bot_handlers.handle_age_user,
-            BotStates.GROUP_NAME_INPUT.value: self.bot_handlers.handle_group_name_input,
-            BotStates.PSYCHOLOGIST_NAME_INPUT.value: self.bot_handlers.handle_psychologist_name_input,
-            BotStates.ANONYMOUS_QUESTION_INPUT.value: self.bot_handlers.handle_anonymous_question_input,
-        }
+    async def shutdown(self):
+        """Flush pending session writes, save snapshot and close the HTTP session."""
+        await self.stop_services()
         
-        handler = text_handlers.get(current_state)
-        if handler:
+        if self.snapshot_path:
             try:
-                user_id = update.effective_user.get('id')
-                new_state = await handler(update, context)
-                if new_state:
-                    self.user_states[user_id] = new_state
+                save_snapshot(self.snapshot_path, self.build_snapshot())
             except Exception as e:
-                logger.error(f"Error in text handler: {e}", exc_info=True)
+                logger.error(f"Error saving snapshot: {e}", exc_info=True)
+        
+        if self.bot.capture is not None:
+            self.bot.capture.close()
+        
+        if self.bot.session:
+            await self.bot.session.close()
+        
+        logger.info("Bot stopped")
     
     async def run(self):
         """Run the bot with long polling."""
@@ -294,83 +710,138 @@ class MaxBotApplication:
             logger.error("Failed to get bot info")
             return
         
+        if self.session_writer is not None:
+            self.restore_sessions(await asyncio.to_thread(self.session_writer.load))
+        await self.start_services()
+        
+        if self.snapshot_path:
+            snapshot = load_snapshot(self.snapshot_path)
+            if snapshot is not None:
+                self.restore_snapshot(snapshot)
+        
+        installed_signals = self._install_signal_handlers()
+        
         # Start polling loop
         try:
-            while True:
+            while not self._stopping.is_set():
                 try:
-                    updates = await self.bot.get_updates(timeout=30)
+                    updates = await self._poll_updates()
+                    if updates is None:
+                        break
                     
                     if updates:
                         logger.info(f"Received {len(updates)} updates")
+                        updates = self.coalesce_updates(updates)
                     
-                    for max_update in updates:
-                        try:
-                            logger.info(f"Processing update: {max_update.update_id}, type: {max_update.update_type}")
-                            
-                            # Обработка события подключения пользователя к боту
-                            if max_update.update_type == 'bot_started':
-                                logger.info("User started bot, sending welcome message")
-                                try:
-                                    # Создаем прокси для отправки приветственного сообщения
-                                    update = MaxUpdateProxy(max_update, self.bot)
-                                    user_id = update.effective_user.get('id') if update.effective_user else None
-                                    
-                                    if user_id:
-                                        context = self.get_user_context(user_id)
-                                        # Вызываем метод start для отправки приветствия
-                                        new_state = await self.bot_handlers.start(update, context)
-                                        self.user_states[user_id] = new_state
-                                        logger.info(f"Welcome message sent to user {user_id}")
-                                    else:
-                                        logger.warning("bot_started event without user_id")
-                                except Exception as e:
-                                    logger.error(f"Error handling bot_started: {e}", exc_info=True)
-                                
-                                continue
-                            
-                            # Обрабатываем только новые сообщения и callback'и
-                            # Игнорируем message_edited, message_deleted и др.
-                            if max_update.update_type not in ['message_created', 'message_callback']:
-                                logger.info(f"Skipping update type: {max_update.update_type}")
-                                continue
-                            
-                            # Create proxy update
-                            update = MaxUpdateProxy(max_update, self.bot)
-                            
-                            # Get user context
-                            user_id = update.effective_user.get('id') if update.effective_user else None
-                            
-                            if not user_id:
-                                logger.warning("Update without user_id, skipping")
-                                continue
-                            
-                            logger.info(f"User ID: {user_id}")
-                            
-                            context = self.get_user_context(user_id)
-                            
-                            # Handle callback query or message (callback имеет приоритет!)
-                            if update.callback_query:
-                                logger.info(f"Handling callback query: {update.callback_query.data}")
-                                await self.handle_callback_query(update, context)
-                            elif update.message:
-                                logger.info(f"Handling message: {update.message.text}")
-                                await self.handle_message(update, context)
-                            else:
-                                logger.warning("Update has no message or callback_query")
-                        
-                        except Exception as e:
-                            logger.error(f"Error processing update: {e}", exc_info=True)
+                    await self._run_batch(updates)
                 
                 except Exception as e:
                     logger.error(f"Error in polling loop: {e}", exc_info=True)
-                    await asyncio.sleep(5)  # Wait before retrying
+                    # Wait before retrying (прерывается запросом остановки)
+                    try:
+                        await asyncio.wait_for(self._stopping.wait(), timeout=5)
+                    except asyncio.TimeoutError:
+                        pass
         
         except KeyboardInterrupt:
             logger.info("Bot stopped by user")
         
         finally:
-            if self.bot.session:
-                await self.bot.session.close()
+            loop = asyncio.get_running_loop()
+            for sig in installed_signals:
+                loop.remove_signal_handler(sig)
+            
+            await self.shutdown()
+
+def create_capture_writer(config: Config) -> Optional[CaptureWriter]:
+    """Traffic capture writer if CAPTURE_DIR is configured."""
+    if not config.CAPTURE_DIR:
+        return None
+    logger.info(f"Capturing updates to {config.CAPTURE_DIR} (redaction {'on' if config.CAPTURE_REDACT else 'off'})")
+    return CaptureWriter(
+        config.CAPTURE_DIR,
+        segment_max_bytes=config.CAPTURE_SEGMENT_MB * 1024 * 1024,
+        redact=config.CAPTURE_REDACT,
+        salt=config.CAPTURE_SALT
+    )
+
+
+def create_question_digest(config: Config, app: MaxBotApplication) -> Optional[QuestionDigest]:
+    """Attach the anonymous question queue and admin digests if ADMIN_IDS is configured."""
+    if not config.ADMIN_IDS:
+        return None
+    if not config.QUESTIONS_PATH:
+        logger.warning("QUESTIONS_PATH is not set: anonymous questions are kept in memory only")
+    
+    # ADMIN_IDS - id пользователей, а не чатов: пишем в диалог по user_id
+    async def send(user_id: int, text: str) -> bool:
+        return bool(await app.bot.send_message_to_user(user_id, text))
+    
+    digest = QuestionDigest(
+        QuestionQueue(config.QUESTIONS_PATH),
+        send,
+        config.ADMIN_IDS,
+        interval=config.QUESTION_DIGEST_INTERVAL,
+        min_interval=config.QUESTION_DIGEST_MIN_INTERVAL,
+        batch_size=config.QUESTION_DIGEST_BATCH
+    )
+    app.question_digest = digest
+    app.bot_handlers.questions = digest
+    return digest
+
+
+def create_funnel_analytics(config: Config, app: MaxBotApplication) -> Optional[FunnelAnalytics]:
+    """Attach funnel analytics with an on-disk event log if ANALYTICS_DIR is configured."""
+    if not config.ANALYTICS_DIR:
+        return None
+    
+    analytics = FunnelAnalytics(EventLog(
+        config.ANALYTICS_DIR,
+        segment_max_bytes=config.ANALYTICS_SEGMENT_MB * 1024 * 1024,
+        flush_interval=config.ANALYTICS_FLUSH_INTERVAL
+    ))
+    app.analytics = analytics
+    app.bot_handlers.analytics = analytics
+    logger.info(f"Funnel analytics enabled: {config.ANALYTICS_DIR}")
+    return analytics
+
+
+def create_flight_recorder(config: Config, app: MaxBotApplication) -> Optional[FlightRecorder]:
+    """Attach the per-user flight recorder if FLIGHT_RECORDER_RECORDS is set."""
+    if config.FLIGHT_RECORDER_RECORDS <= 0:
+        return None
+    
+    recorder = FlightRecorder(config.FLIGHT_RECORDER_RECORDS, config.FLIGHT_RECORDER_USERS)
+    app.flight_recorder = recorder
+    app.bot.flight_recorder = recorder
+    app.bot_handlers.flight_recorder = recorder
+    logger.info(f"Flight recorder enabled: {config.FLIGHT_RECORDER_RECORDS} records "
+                f"for up to {config.FLIGHT_RECORDER_USERS} users")
+    return recorder
+
+
+def create_worker_app(token: str, base_url: str, database_path: Optional[str],
+                      session_flush_interval: float, session_flush_max_updates: int,
+                      shutdown_timeout: float, crisis_lexicon_path: Optional[str] = None,
+                      trace_buffer_spans: int = 0, trace_otlp_dir: Optional[str] = None,
+                      trace_otlp_segment_mb: int = 16, trace_sample_rate: float = 1.0,
+                      admin_ids: Iterable[int] = ()) -> MaxBotApplication:
+    """Create the application inside a worker process of the sharded runtime."""
+    session_store = SessionStore(database_path) if database_path else None
+    app = MaxBotApplication(
+        token,
+        base_url,
+        verify_ssl=True,
+        session_store=session_store,
+        session_flush_interval=session_flush_interval,
+        session_flush_max_updates=session_flush_max_updates,
+        shutdown_timeout=shutdown_timeout,
+        crisis_lexicon_path=crisis_lexicon_path
+    )
+    app.bot_handlers.admin_ids = frozenset(admin_ids)
+    # Имена файлов OTLP содержат pid - воркеры пишут в общий каталог
+    app.attach_tracer(create_tracer(trace_buffer_spans, trace_otlp_dir, trace_otlp_segment_mb, trace_sample_rate))
+    return app
 
 
 async def main():
@@ -383,15 +854,102 @@ async def main():
         logger.info("Please set MAX_BOT_TOKEN in .env file or environment variable")
         return
     
+    # Хранилище сессий (если задан DATABASE_URL вида sqlite:///path.db)
+    database_path = sqlite_path_from_url(config.DATABASE_URL)
+    
+    # Несколько процессов: один опрашивает API, воркеры обрабатывают свои шарды пользователей
+    if config.MAX_WORKERS > 1 and not config.REPLICA_COORDINATION_URL:
+        if not database_path:
+            logger.warning("MAX_WORKERS > 1 without DATABASE_URL: sessions will not survive restarts")
+        supervisor = ShardedSupervisor(
+            config.BOT_TOKEN,
+            config.MAX_API_BASE_URL,
+            workers=config.MAX_WORKERS,
+            app_factory=create_worker_app,
+            app_options={
+                'token': config.BOT_TOKEN,
+                'base_url': config.MAX_API_BASE_URL,
+                'database_path': database_path,
+                'session_flush_interval': config.SESSION_FLUSH_INTERVAL_MS / 1000,
+                'session_flush_max_updates': config.SESSION_FLUSH_MAX_UPDATES,
+                'shutdown_timeout': config.SHUTDOWN_TIMEOUT,
+                'crisis_lexicon_path': config.CRISIS_LEXICON_PATH,
+                'trace_buffer_spans': config.TRACE_BUFFER_SPANS,
+                'trace_otlp_dir': config.TRACE_OTLP_DIR,
+                'trace_otlp_segment_mb': config.TRACE_OTLP_SEGMENT_MB,
+                'trace_sample_rate': config.TRACE_SAMPLE_RATE,
+                'admin_ids': tuple(config.ADMIN_IDS),
+            },
+            snapshot_path=config.SNAPSHOT_PATH,
+            shutdown_timeout=config.SHUTDOWN_TIMEOUT,
+            event_loop=config.EVENT_LOOP,
+            eager_tasks=config.EAGER_TASKS
+        )
+        supervisor.bot.capture = create_capture_writer(config)
+        if config.ADMIN_IDS:
+            # У каждого воркера была бы своя очередь и свои дайджесты
+            logger.warning("Anonymous question digests are not supported with MAX_WORKERS > 1")
+        if config.ANALYTICS_DIR:
+            # Счетчики воронки в каждом воркере покрывали бы только его шард
+            logger.warning("Funnel analytics is not supported with MAX_WORKERS > 1")
+        if config.FLIGHT_RECORDER_RECORDS > 0:
+            # /flight администратора обработал бы воркер его шарда, а не шарда пользователя
+            logger.warning("Flight recorder is not supported with MAX_WORKERS > 1")
+        try:
+            await supervisor.run()
+        except Exception as e:
+            logger.error(f"Fatal error: {e}", exc_info=True)
+        return
+    
+    session_store = None
+    if database_path:
+        session_store = SessionStore(database_path)
+        logger.info(f"Session persistence enabled: {database_path}")
+    
     # Create and run the bot application
     # Используем SSL проверку для официального API MAX
-    app = MaxBotApplication(config.BOT_TOKEN, config.MAX_API_BASE_URL, verify_ssl=True)
+    app = MaxBotApplication(
+        config.BOT_TOKEN,
+        config.MAX_API_BASE_URL,
+        verify_ssl=True,
+        session_store=session_store,
+        session_flush_interval=config.SESSION_FLUSH_INTERVAL_MS / 1000,
+        session_flush_max_updates=config.SESSION_FLUSH_MAX_UPDATES,
+        # Позицию опроса реплик хранит координатор, а не снимок
+        snapshot_path=None if config.REPLICA_COORDINATION_URL else config.SNAPSHOT_PATH,
+        shutdown_timeout=config.SHUTDOWN_TIMEOUT,
+        crisis_lexicon_path=config.CRISIS_LEXICON_PATH
+    )
+    # Команды администраторов (/stats, /traces, /flight) не зависят от включенных функций
+    app.bot_handlers.admin_ids = frozenset(config.ADMIN_IDS)
+    # Опрашивает только лидер - у резервных реплик запись остается пустой
+    app.bot.capture = create_capture_writer(config)
+    create_question_digest(config, app)
+    create_funnel_analytics(config, app)
+    create_flight_recorder(config, app)
+    app.attach_tracer(create_tracer(config.TRACE_BUFFER_SPANS, config.TRACE_OTLP_DIR,
+                                    config.TRACE_OTLP_SEGMENT_MB, config.TRACE_SAMPLE_RATE))
     
     try:
-        await app.run()
+        if config.REPLICA_COORDINATION_URL:
+            # Несколько реплик: опрашивает только лидер, остальные - горячий резерв
+            coordinator = ReplicaCoordinator(
+                app,
+                create_coordination_backend(config.REPLICA_COORDINATION_URL,
+                                            lease_ttl_ms=config.REPLICA_LEASE_TTL_MS),
+                partitions=config.REPLICA_PARTITIONS,
+                max_partitions=config.REPLICA_MAX_PARTITIONS,
+                renew_interval=config.REPLICA_LEASE_TTL_MS / 3000
+            )
+            await coordinator.run()
+        else:
+            await app.run()
     except Exception as e:
         logger.error(f"Fatal error: {e}", exc_info=True)
 
-
 if __name__ == '__main__':
-    asyncio.run(main())
+    # Цикл событий выбирается до создания Config (ей нужен токен), поэтому настройки читаются из окружения
+    event_loop = os.getenv('EVENT_LOOP', 'auto')
+    eager_tasks = os.getenv('EAGER_TASKS', 'true').lower() == 'true'
+    logger.info(f"Event loop: {describe_runtime(event_loop, eager_tasks)}")
+    run_event_loop(main(), event_loop=event_loop, eager_tasks=eager_tasks)
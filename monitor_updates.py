@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
 """
 Мониторинг updates в реальном времени
+
+С --capture DIR updates также записываются (без персональных данных)
+в сжатые сегменты для воспроизведения через replay_capture.py
 """
 
+import argparse
 import asyncio
 import aiohttp
 import os
@@ -10,12 +14,14 @@ import json
 from datetime import datetime
 from dotenv import load_dotenv
 
+from bot.capture import CaptureWriter
+
 load_dotenv()
 
 MAX_TOKEN = os.getenv('MAX_BOT_TOKEN')
 API_BASE = "https://platform-api.max.ru"
 
-async def monitor_updates():
+async def monitor_updates(capture=None, quiet=False):
     """Мониторит updates в реальном времени."""
     
     print("=" * 70)
@@ -51,7 +57,10 @@ async def monitor_updates():
                         
                         updates = data.get('updates', [])
                         
-                        if updates:
+                        if updates and capture is not None:
+                            capture.record(updates)
+                        
+                        if updates and not quiet:
                             print(f"\n{'='*70}")
                             print(f"📨 {datetime.now().strftime('%H:%M:%S')} - Получено {len(updates)} updates!")
                             print(f"{'='*70}")
@@ -78,7 +87,18 @@ async def monitor_updates():
                 await asyncio.sleep(5)
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Мониторинг updates MAX')
+    parser.add_argument('--capture', metavar='DIR', help='записывать updates в каталог')
+    parser.add_argument('--no-redact', action='store_true', help='не удалять персональные данные из записи')
+    parser.add_argument('--quiet', action='store_true', help='не печатать updates (только запись)')
+    args = parser.parse_args()
+    
+    capture = CaptureWriter(args.capture, redact=not args.no_redact) if args.capture else None
     try:
-        asyncio.run(monitor_updates())
+        asyncio.run(monitor_updates(capture, args.quiet))
     except KeyboardInterrupt:
         print("\n✅ Мониторинг завершен")
+    finally:
+        if capture is not None:
+            capture.close()
+            print(f"💾 Записано updates: {capture.updates_written} -> {args.capture}")
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Воспроизведение записанного трафика MAX бота (bot/capture.py)
+
+Updates из записи (CAPTURE_DIR или monitor_updates.py --capture) подаются
+в MaxBotApplication пакетами, как их вернул опрос, с исходными интервалами:
+- --speed 1   в реальном времени
+- --speed 20  в 20 раз быстрее
+- --speed 0   так быстро, как успевает бот
+
+По умолчанию ответы бота уходят в фейковый MAX API (fake_max_server.py) в этом
+же процессе; --base-url направляет их на другой сервер (нужен --token).
+
+Запуск:
+    python replay_capture.py data/capture --speed 0
+    python replay_capture.py data/capture/updates-20250101-120000-1-0000.jsonl.gz --speed 10 --max-gap 5
+"""
+
+import argparse
+import asyncio
+import logging
+
+from aiohttp import web
+
+from bot.capture import read_capture, replay
+from fake_max_server import FakeMaxConfig, create_app
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+async def main_async(args):
+    from main_max import MaxBotApplication
+    
+    runner = None
+    platform = None
+    base_url = args.base_url
+    if base_url is None:
+        server_app = create_app(FakeMaxConfig(latency_ms=args.latency_ms, seed=args.seed))
+        platform = server_app['platform']
+        runner = web.AppRunner(server_app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', args.port).start()
+        base_url = f'http://127.0.0.1:{args.port}'
+    
+    app = MaxBotApplication(args.token, base_url, verify_ssl=not args.insecure)
+    try:
+        stats = await replay(app, read_capture(args.paths), speed=args.speed, max_gap=args.max_gap)
+    finally:
+        if app.bot.session:
+            await app.bot.session.close()
+        if runner is not None:
+            await runner.cleanup()
+    
+    latencies = sorted(stats.latencies)
+    speed = 'as fast as possible' if args.speed == 0 else f'x{args.speed:g}'
+    print(f"\nReplayed {stats.updates} updates in {stats.batches} batches, {speed}, elapsed {stats.elapsed:.1f}s")
+    if stats.elapsed > 0:
+        print(f"Throughput: {stats.updates / stats.elapsed:.0f} updates/s")
+    if args.speed > 0:
+        print(f"Max lag behind schedule: {stats.max_lag * 1000:.0f} ms")
+    print(f"Update types: {dict(stats.update_types)}")
+    if platform is not None:
+        print(f"Bot API calls: {dict(platform.requests)}")
+    print(f"Latency ms: p50 {percentile(latencies, 0.5) * 1000:.1f}, p95 {percentile(latencies, 0.95) * 1000:.1f}, "
+          f"p99 {percentile(latencies, 0.99) * 1000:.1f}, max {(latencies[-1] if latencies else 0) * 1000:.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay captured MAX updates into the bot')
+    parser.add_argument('paths', nargs='+', help='capture directories or segment files')
+    parser.add_argument('--speed', type=float, default=1.0, help='1 - real time, N - N times faster, 0 - no pauses')
+    parser.add_argument('--max-gap', type=float, default=None, help='cap pauses between polls (capture seconds)')
+    parser.add_argument('--base-url', default=None, help='send bot replies here instead of the in-process fake API')
+    parser.add_argument('--token', default='replay', help='bot token for --base-url')
+    parser.add_argument('--insecure', action='store_true', help='do not verify SSL certificates')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='fake API latency')
+    parser.add_argument('--port', type=int, default=18767)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--verbose', action='store_true', help='keep bot logging enabled')
+    args = parser.parse_args()
+    
+    if args.speed < 0:
+        parser.error('--speed must be >= 0')
+    
+    if not args.verbose:
+        # Логи бота на каждый update искажают замер
+        logging.disable(logging.CRITICAL)
+    asyncio.run(main_async(args))
+
+
+if __name__ == '__main__':
+    main()